@@ -0,0 +1,104 @@
+"""
+    Moves closed hat history out of the hot tables into their archive tables, so the
+    hot tables hold little more than the open rows every command reads and stay in
+    cache. Rows are moved in small batches, each in its own short transaction, so
+    commands are never held up behind a long write. Read history through the
+    *_history views, which cover both.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from bot import metrics
+from bot.models import to_epoch_us
+
+logger = logging.getLogger(__name__)
+
+# table -> its columns, in the order the archive table declares them
+ARCHIVED_TABLES = [
+    ('hatlog', ['id', 'hat', 'user_id', 'start_time', 'end_time']),
+    ('hatqueue', ['id', 'hat', 'user_id', 'start_time', 'end_time']),
+    ('hatpool', ['id', 'hat', 'owner_user_id', 'user_id', 'end_time']),
+]
+
+
+def archive_batch(db, table, columns, cutoff, batch_size):
+    """
+        Moves up to batch_size rows that were closed before cutoff (epoch
+        microseconds) into the table's archive. Returns the number moved.
+    """
+    with db.atomic():
+        ids = [row_id for row_id, in db.execute_sql(
+            'SELECT "id" FROM "{}" WHERE "end_time" < ? ORDER BY "end_time" LIMIT ?'.format(table),
+            (cutoff, batch_size))]
+        if not ids:
+            return 0
+        names = ', '.join('"{}"'.format(column) for column in columns)
+        placeholders = ', '.join('?' * len(ids))
+        db.execute_sql('INSERT INTO "{0}_archive" ({1}) SELECT {1} FROM "{0}" '
+                       'WHERE "id" IN ({2})'.format(table, names, placeholders), ids)
+        db.execute_sql('DELETE FROM "{}" WHERE "id" IN ({})'.format(table, placeholders), ids)
+    return len(ids)
+
+
+def archive(db, max_age, batch_size=500, pause=0, now=None, stopped=None):
+    """
+        Archives every row closed more than max_age ago, batch by batch, pausing
+        between batches to let other writers in. Returns {table: rows moved}.
+    """
+    now = now or datetime.now(tz=pytz.utc)
+    cutoff = to_epoch_us(now - max_age)
+    moved = {}
+    for table, columns in ARCHIVED_TABLES:
+        moved[table] = 0
+        while stopped is None or not stopped.is_set():
+            count = archive_batch(db, table, columns, cutoff, batch_size)
+            moved[table] += count
+            if count < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    return moved
+
+
+class Archiver(object):
+    """
+        Runs archive() every `interval` seconds on a background thread
+    """
+
+    def __init__(self, db, max_age=timedelta(days=30), batch_size=500, interval=300,
+                 pause=0.05):
+        self.db = db
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='archiver')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        metrics.set_command('archiver')
+        while not self._stopped.is_set():
+            try:
+                moved = archive(self.db, self.max_age, self.batch_size, self.pause,
+                                stopped=self._stopped)
+                if any(moved.values()):
+                    logger.info('Archived %s', ', '.join(
+                        '{} {} rows'.format(count, table) for table, count in moved.items()))
+            except Exception:
+                logger.exception('Archiving failed')
+            self._stopped.wait(self.interval)
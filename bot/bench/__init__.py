@@ -0,0 +1,4 @@
+"""
+    Benchmarks for the command path. Run them with `python -m bot.bench --help`; they
+    use their own throwaway database and settings, so no bot/settings.py is needed.
+"""
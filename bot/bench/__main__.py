@@ -0,0 +1,90 @@
+"""
+    python -m bot.bench [workload ...] [options]
+
+    Runs each workload (all of them by default) through the bot against a fake Slack
+    client and a throwaway database (or, with --storage memory, no database at all),
+    and prints throughput plus per-command latency percentiles and query counts.
+    --replay runs a recorded event log instead, and --record saves the generated events
+    so a run can be replayed later.
+"""
+import argparse
+import logging
+import random
+import time
+from datetime import datetime
+
+import pytz
+
+from bot.bench.environment import BENCH_BOT_ID, BENCH_CHANNEL_ID, use_bench_settings
+
+
+def main():
+    from bot.bench import workloads
+
+    parser = argparse.ArgumentParser(prog='python -m bot.bench')
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+                        help='one of {}'.format(', '.join(sorted(workloads.WORKLOADS))))
+    parser.add_argument('--size', type=int, default=1000, help='commands per workload')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--history', type=int, default=0,
+                        help='finished holds to seed the database with first')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds each fake Slack API call takes')
+    parser.add_argument('--replay', metavar='PATH', help='replay a JSON lines RTM event log')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay at this multiple of the recorded pace (0 is flat out)')
+    parser.add_argument('--bot-id', default=BENCH_BOT_ID,
+                        help="the bot's user ID in the replayed events")
+    parser.add_argument('--channel', default=BENCH_CHANNEL_ID,
+                        help="the hat's channel ID in the replayed events")
+    parser.add_argument('--record', metavar='PATH', help='save the generated events here')
+    parser.add_argument('--db', metavar='PATH', help='database file (default: a temp file)')
+    parser.add_argument('--storage', choices=['sqlite', 'memory'], default='sqlite',
+                        help='where the bot keeps the hats; see bot.storage')
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in workloads.WORKLOADS:
+            parser.error('unknown workload {}'.format(name))
+    if args.history and args.storage != 'sqlite':
+        parser.error('--history seeds the database, so it needs --storage sqlite')
+
+    use_bench_settings(args.db, BOT_ID=args.bot_id, CHANNEL_ID=args.channel,
+                       STORAGE=args.storage)
+    from bot.bench.fake_slack import FakeSlackClient
+    from bot.bench.runner import BenchRunner, format_summary
+    from bot.models import to_epoch_us
+
+    users = workloads.bench_users(args.users)
+    slack_client = FakeSlackClient([FakeSlackClient.member(user) for user in users],
+                                   latency=args.latency)
+    runner = BenchRunner(slack_client)
+    runner.start()
+    try:
+        if args.history:
+            started = time.time()
+            workloads.seed_history(runner.db, users, args.history, 'deploy',
+                                   random.Random(args.seed),
+                                   to_epoch_us(datetime.now(tz=pytz.utc)))
+            runner.reload_state()
+            print('Seeded {} holds in {:.3f}s'.format(args.history, time.time() - started))
+
+        if args.replay:
+            runs = [(args.replay, workloads.read_event_log(args.replay))]
+        else:
+            runs = [(name, workloads.to_events(
+                workloads.generate(name, users, args.size, args.seed), args.channel, args.bot_id))
+                    for name in args.workloads or sorted(workloads.WORKLOADS)]
+        recorded = []
+        for name, events in runs:
+            recorded.extend(events)
+            print(format_summary(name, runner.run(events, speed=args.speed)))
+        if args.record:
+            workloads.write_event_log(args.record, recorded)
+    finally:
+        runner.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+import types
+
+from peewee import SqliteDatabase
+
+BENCH_BOT_ID = 'UBENCHBOT'
+BENCH_CHANNEL_ID = 'CBENCH'
+
+
+def use_bench_settings(db_file=None, **overrides):
+    """
+        Installs a bot.settings module built from the settings template, pointed at a
+        fresh database, before anything imports the real one. Returns the module.
+    """
+    if 'bot.settings' in sys.modules:
+        raise RuntimeError('bot.settings is already imported; set up the bench first')
+
+    import bot
+    from bot import settings_template
+
+    if db_file is None:
+        db_file = os.path.join(tempfile.mkdtemp(prefix='hatbench'), 'bench.db')
+    settings = types.ModuleType('bot.settings')
+    for name, value in vars(settings_template).items():
+        if name.isupper():
+            setattr(settings, name, value)
+    settings.SLACK_BOT_TOKEN = 'xoxb-bench'
+    settings.BOT_ID = BENCH_BOT_ID
+    settings.BOT_NAME = 'hatbench'
+    settings.DB_FILE = db_file
+    settings.TARGET_CHANNEL = 'bench'
+    settings.CHANNEL_ID = BENCH_CHANNEL_ID
+    # Replies go to an in-process fake, so don't pace them like real Slack
+    settings.CHANNEL_MESSAGE_RATE = 1e9
+    settings.CHANNEL_MESSAGE_BURST = 1e9
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    settings.database = SqliteDatabase(settings.DB_FILE, pragmas=list(settings.DB_PRAGMAS))
+
+    sys.modules['bot.settings'] = settings
+    bot.settings = settings
+    return settings
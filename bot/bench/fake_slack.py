@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import deque
+
+
+class FakeSlackClient(object):
+    """
+        Stands in for SlackClient in-process. rtm_read serves queued events a batch at a
+        time, users.list and users.info answer from `members`, and every
+        chat.postMessage is recorded in `posted` as (time, params).
+    """
+
+    def __init__(self, members=(), batch_size=10, latency=0):
+        self.members = dict((member['id'], member) for member in members)
+        self.batch_size = batch_size
+        # Seconds every API call takes, to stand in for the network
+        self.latency = latency
+        self.events = deque()
+        self.posted = []
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def member(user_id, name=None):
+        return {'id': user_id, 'name': name or user_id.lower(),
+                'profile': {'display_name': name or user_id.lower()}}
+
+    def feed(self, events):
+        self.events.extend(events)
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        batch = []
+        while self.events and len(batch) < self.batch_size:
+            batch.append(self.events.popleft())
+        return batch
+
+    def api_call(self, method, **kwargs):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, '_' + method.replace('.', '_'), None)
+        if handler is None:
+            return {'ok': True}
+        return handler(**kwargs)
+
+    def _users_list(self, limit=200, cursor=None, **kwargs):
+        members = sorted(self.members.values(), key=lambda member: member['id'])
+        start = int(cursor or 0)
+        page = members[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(members) else ''
+        return {'ok': True, 'members': page, 'response_metadata': {'next_cursor': next_cursor}}
+
+    def _users_info(self, user=None, **kwargs):
+        member = self.members.get(user)
+        if member is None:
+            return {'ok': False, 'error': 'user_not_found'}
+        return {'ok': True, 'user': member}
+
+    def _chat_postMessage(self, **kwargs):
+        with self._lock:
+            self.posted.append((time.time(), kwargs))
+        return {'ok': True, 'ts': '{:.6f}'.format(time.time())}
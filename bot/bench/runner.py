@@ -0,0 +1,193 @@
+import logging
+import threading
+import time
+
+import run_bot
+from bot.outbound import ApiCallSender
+from bot.state import HatStates
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class QueryCounter(object):
+    """
+        Counts the SQL statements each thread runs through the database
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._local = threading.local()
+        self._execute_sql = None
+
+    def install(self):
+        self._execute_sql = self.db.execute_sql
+        self.db.execute_sql = self._counting_execute_sql
+
+    def uninstall(self):
+        self.db.execute_sql = self._execute_sql
+
+    def reset(self):
+        self._local.count = 0
+
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def _counting_execute_sql(self, *args, **kwargs):
+        self._local.count = self.count() + 1
+        return self._execute_sql(*args, **kwargs)
+
+
+class CommandStats(object):
+    __slots__ = ('count', 'service_times', 'latencies', 'queries')
+
+    def __init__(self):
+        self.count = 0
+        self.service_times = []
+        self.latencies = []
+        self.queries = 0
+
+
+class BenchRunner(object):
+    """
+        Runs events through the real command path (parse_slack_output, dispatch_command,
+        the engine, handle_command and the outbound dispatcher) against a FakeSlackClient,
+        recording per command how long it took and how many queries it ran.
+    """
+
+    def __init__(self, slack_client):
+        self.slack_client = slack_client
+        self.db = run_bot.db
+        self.queries = QueryCounter(self.db)
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._last_ts = 0
+
+    def start(self):
+        run_bot.slack_client = self.slack_client
+        run_bot.initialize(sender=ApiCallSender(self.slack_client))
+        self.queries.install()
+
+    def stop(self):
+        run_bot.shutdown()
+        self.queries.uninstall()
+
+    def reload_state(self):
+        """
+            Picks up rows written behind the bot's back, e.g. by seed_history
+        """
+        for command in run_bot.this.router.commands:
+            if hasattr(command, 'states'):
+                command.states = HatStates.load(store=command.store)
+
+    def run(self, events, speed=0):
+        """
+            Feeds the events through the bot and waits for every reply to be posted.
+            With a speed, events are paced by their ts (2 is twice as fast as recorded).
+            Returns a summary dict.
+        """
+        self.stats = {}
+        # Workloads reuse the same timestamps, so what an earlier run saw isn't a repeat
+        run_bot.this.recent_events.clear()
+        posted_before = len(self.slack_client.posted)
+        handle_command = run_bot.handle_command
+        run_bot.handle_command = self._measured(handle_command)
+        try:
+            self.slack_client.feed(events)
+            futures = []
+            shed = 0
+            started = time.time()
+            first_ts = None
+            while True:
+                batch = self.slack_client.rtm_read()
+                if not batch:
+                    break
+                for command, channel, user, ts in run_bot.parse_slack_output(batch):
+                    if speed and ts is not None:
+                        first_ts = first_ts if first_ts is not None else float(ts)
+                        delay = (float(ts) - first_ts) / speed - (time.time() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+                    future = run_bot.dispatch_command(command, channel, user,
+                                                      self._now_ts(time.time()))
+                    if future is None:
+                        shed += 1
+                    else:
+                        futures.append(future)
+            # Coalesced commands share a future, and a reply
+            unique = set(futures)
+            for future in unique:
+                future.exception()
+            handled = time.time()
+            while run_bot.this.outbound.queue_depth() or \
+                    len(self.slack_client.posted) - posted_before < len(unique):
+                if time.time() - handled > 30:
+                    logger.warning('Gave up waiting for replies to be posted')
+                    break
+                time.sleep(0.001)
+            finished = time.time()
+        finally:
+            run_bot.handle_command = handle_command
+
+        return {
+            'commands': len(futures) + shed,
+            'shed': shed,
+            'coalesced': len(futures) - len(unique),
+            'failed': sum(1 for future in unique if future.exception() is not None),
+            'replies': len(self.slack_client.posted) - posted_before,
+            'handle_seconds': handled - started,
+            'total_seconds': finished - started,
+            'per_command': self.stats,
+        }
+
+    def _now_ts(self, now):
+        # Commands are timed from when they were dispatched, not from the recorded ts.
+        # The ts is also the message's receipt key, so no two can be the same.
+        self._last_ts = max(now, self._last_ts + 0.000001)
+        return '{:.6f}'.format(self._last_ts)
+
+    def _measured(self, handle_command):
+        def measured(command, channel, user, ts=None, route=None):
+            started = time.time()
+            self.queries.reset()
+            try:
+                return handle_command(command, channel, user, ts, route)
+            finally:
+                finished = time.time()
+                name = route.metric_name if route is not None else run_bot.UNROUTED
+                with self._lock:
+                    stats = self.stats.get(name)
+                    if stats is None:
+                        stats = self.stats[name] = CommandStats()
+                    stats.count += 1
+                    stats.service_times.append(finished - started)
+                    stats.latencies.append(finished - float(ts))
+                    stats.queries += self.queries.count()
+        return measured
+
+
+def format_summary(name, summary):
+    commands = summary['commands']
+    lines = ['{}: {} commands ({} failed) in {:.3f}s, {:.0f} commands/s; {} replies posted '
+             'after {:.3f}s'.format(name, commands, summary['failed'], summary['handle_seconds'],
+                                    commands / summary['handle_seconds']
+                                    if summary['handle_seconds'] else 0,
+                                    summary['replies'], summary['total_seconds'])]
+    if summary['shed'] or summary['coalesced']:
+        lines[0] += '; {} fun commands shed, {} coalesced'.format(summary['shed'],
+                                                                  summary['coalesced'])
+    lines.append('  {:<24} {:>6} {:>9} {:>9} {:>9} {:>11} {:>8}'.format(
+        'command', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'p99 e2e ms', 'queries'))
+    for command, stats in sorted(summary['per_command'].items()):
+        service_times = sorted(stats.service_times)
+        latencies = sorted(stats.latencies)
+        lines.append('  {:<24} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>11.3f} {:>8.1f}'.format(
+            command, stats.count, percentile(service_times, 0.5) * 1000,
+            percentile(service_times, 0.9) * 1000, percentile(service_times, 0.99) * 1000,
+            percentile(latencies, 0.99) * 1000, stats.queries / float(stats.count)))
+    return '\n'.join(lines)
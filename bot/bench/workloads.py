@@ -0,0 +1,217 @@
+"""
+    Synthetic command mixes. Each workload is a function of (users, size, rng) that
+    returns about `size` (text, user_id) commands, following a simple model of the hat
+    so that most of them do real work rather than bouncing off an error.
+"""
+import json
+import random
+
+from bot.bench.environment import BENCH_BOT_ID, BENCH_CHANNEL_ID
+
+US_PER_SECOND = 1000000
+
+
+def bench_users(count):
+    return ['U{:05d}'.format(number) for number in range(1, count + 1)]
+
+
+def to_events(commands, channel=BENCH_CHANNEL_ID, bot_id=BENCH_BOT_ID, start_ts=1500000000.0,
+              interval=0.01):
+    """
+        Wraps commands in RTM message events addressed to the bot
+    """
+    return [{'type': 'message', 'channel': channel, 'user': user,
+             'text': '<@{}> {}'.format(bot_id, text),
+             'ts': '{:.6f}'.format(start_ts + index * interval)}
+            for index, (text, user) in enumerate(commands)]
+
+
+def read_event_log(path):
+    """
+        Reads a recorded event log: one JSON RTM event per line
+    """
+    with open(path) as log:
+        return [json.loads(line) for line in log if line.strip()]
+
+
+def write_event_log(path, events):
+    with open(path, 'w') as log:
+        for event in events:
+            log.write(json.dumps(event) + '\n')
+
+
+def queue_storm(users, size, rng):
+    """
+        Someone takes the hat and everyone piles into the queue at once, checking their
+        place as they go, then they all give up waiting
+    """
+    commands = [('hat on', users[0])]
+    waiting = list(users[1:size // 3 + 1])
+    for user in waiting:
+        commands.append(('hat queue', user))
+        if rng.random() < 0.5:
+            commands.append((rng.choice(['hat queued', 'hat who']), rng.choice(users)))
+    rng.shuffle(waiting)
+    for user in waiting:
+        commands.append(('hat dequeue', user))
+    commands.append(('hat off', users[0]))
+    return commands
+
+
+def handoffs(users, size, rng):
+    """
+        Rapid on/off handoffs: the owner gives up the hat and rejoins the back of the
+        queue, and the head of the queue takes it
+    """
+    queue = list(users[1:min(len(users), 6)])
+    owner = users[0]
+    commands = [('hat on', owner)] + [('hat queue', user) for user in queue]
+    while len(commands) < size:
+        commands.append(('hat off', owner))
+        queue.append(owner)
+        commands.append(('hat queue', owner))
+        owner = queue.pop(0)
+        commands.append(('hat on', owner))
+        if rng.random() < 0.3:
+            commands.append(('hat who', rng.choice(users)))
+    commands.append(('hat off', owner))
+    return commands
+
+
+def pool_churn(users, size, rng):
+    """
+        One owner while people keep joining and leaving the pool
+    """
+    owner = users[0]
+    pooled = set()
+    commands = [('hat on', owner)]
+    while len(commands) < size:
+        user = rng.choice(users[1:])
+        commands.append(('hat unpool' if user in pooled else 'hat pool', user))
+        pooled.symmetric_difference_update([user])
+        if rng.random() < 0.2:
+            commands.append(('hat who', rng.choice(users)))
+    commands.append(('hat off', owner))
+    return commands
+
+
+def mixed(users, size, rng):
+    """
+        What a busy channel looks like: mostly lookups, with handoffs, queueing, pooling
+        and the odd bit of fun
+    """
+    owner = None
+    queue = []
+    # In the order they joined; the first one takes over when the owner leaves
+    pooled = []
+    commands = []
+    while len(commands) < size:
+        user = rng.choice(users)
+        roll = rng.random()
+        if roll < 0.35:
+            commands.append((rng.choice(['hat who', 'hat queued', 'hat stats', 'hat info']), user))
+        elif roll < 0.5:
+            if owner is None:
+                owner = queue.pop(0) if queue else user
+                if owner in queue:
+                    queue.remove(owner)
+                commands.append(('hat on', owner))
+            elif user != owner and user not in queue:
+                queue.append(user)
+                commands.append(('hat queue', user))
+        elif roll < 0.6 and owner is not None:
+            commands.append(('hat off', owner))
+            owner = pooled.pop(0) if pooled else None
+            if owner in queue:
+                queue.remove(owner)
+        elif roll < 0.7 and queue:
+            commands.append(('hat dequeue', queue.pop(rng.randrange(len(queue)))))
+        elif roll < 0.85 and owner is not None and user != owner:
+            if user in pooled:
+                pooled.remove(user)
+                commands.append(('hat unpool', user))
+            else:
+                pooled.append(user)
+                commands.append(('hat pool', user))
+        elif roll < 0.95:
+            commands.append(('hat tip <@{}>'.format(rng.choice(users)), user))
+        else:
+            commands.append((rng.choice(['hat help', 'hat memeify ship it', 'example hi']), user))
+    return commands
+
+
+def history(users, size, rng):
+    """
+        Read-heavy lookups, meant to run against a database seeded with seed_history
+    """
+    commands = []
+    while len(commands) < size:
+        user = rng.choice(users)
+        commands.append((rng.choice(['hat stats', 'hat info', 'hat who', 'hat queued']), user))
+        if rng.random() < 0.01:
+            commands.append(('hat report 90d', user))
+    return commands
+
+
+def incident(users, size, rng):
+    """
+        An incident channel: a crowd piling on with memes and gifs while a few people
+        hand the hat around to ship the fix
+    """
+    fixers = users[:3]
+    owner = None
+    commands = []
+    while len(commands) < size:
+        if rng.random() < 0.1:
+            if owner is None:
+                owner = rng.choice(fixers)
+                commands.append(('hat on', owner))
+            else:
+                commands.append(('hat off', owner))
+                owner = None
+        else:
+            commands.append((rng.choice(['hat gif', 'hat facts', 'hat memeify it was dns',
+                                         'hat memeify ship it']), rng.choice(users)))
+    return commands
+
+
+WORKLOADS = {
+    'queue-storm': queue_storm,
+    'handoffs': handoffs,
+    'pool-churn': pool_churn,
+    'mixed': mixed,
+    'history': history,
+    'incident': incident,
+}
+
+
+def seed_history(db, users, holds, hat, rng, end_us):
+    """
+        Writes `holds` finished hat holds (with their queue waits and pools) ending
+        before end_us, straight into the tables, and rebuilds the stats rollups
+    """
+    from bot.rollups import rebuild
+
+    logs, queued, pools = [], [], []
+    start = end_us - holds * 3600 * US_PER_SECOND
+    for _ in range(holds):
+        user = rng.choice(users)
+        held = rng.randint(60, 3600) * US_PER_SECOND
+        queued.append((hat, user, start - rng.randint(0, 1800) * US_PER_SECOND, start))
+        logs.append((hat, user, start, start + held))
+        for pooled in rng.sample(users, rng.randint(0, 3)):
+            pools.append((hat, user, pooled, start + held))
+        start += 3600 * US_PER_SECOND
+    with db.atomic():
+        cursor = db.get_cursor()
+        cursor.executemany('INSERT INTO "hatlog" ("hat", "user_id", "start_time", "end_time") '
+                           'VALUES (?, ?, ?, ?)', logs)
+        cursor.executemany('INSERT INTO "hatqueue" ("hat", "user_id", "start_time", '
+                           '"end_time") VALUES (?, ?, ?, ?)', queued)
+        cursor.executemany('INSERT INTO "hatpool" ("hat", "owner_user_id", "user_id", '
+                           '"end_time") VALUES (?, ?, ?, ?)', pools)
+    rebuild(db)
+
+
+def generate(name, users, size, seed=0):
+    return WORKLOADS[name](users, size, random.Random(seed))
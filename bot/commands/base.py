@@ -1,13 +1,39 @@
 from types import FunctionType
 
+from bot import storage
+from bot.trie import TokenTrie, tokenize
+
 #Each function in the class is a new command
 
 class BotCommand(object):
     DEFAULT_COMMAND_PREFIX = ''
+    # Commands that change shared state; these are run one at a time, in order
+    MUTATING_COMMANDS = frozenset()
+    # Novelty commands; under load these wait behind everything else, or are refused
+    FUN_COMMANDS = frozenset()
+    # Whether this handles messages that don't start with any registered prefix
+    FALLBACK = False
 
-    def __init__(self, prefix=None):
+    def __init__(self, prefix=None, store=None):
         self.prefix = prefix if prefix is not None else self.DEFAULT_COMMAND_PREFIX
+        # Where mutating commands run their transactions; see bot.storage
+        self.store = store if store is not None else storage.default_store()
         self.command_mappings = self._command_map()
+        # command name -> the name it is reported under in metrics, None for invalid ones
+        self.metric_names = dict((name, '{} {}'.format(self.prefix, name).strip())
+                                 for name in self.command_mappings)
+        self.metric_names[None] = '{} (invalid)'.format(self.prefix).strip()
+        self._command_trie = TokenTrie()
+        for name, function in self.command_mappings.items():
+            self._command_trie.insert(name.split(), (name, function))
+
+    @classmethod
+    def create(cls, **dependencies):
+        """
+            Builds the command for the router. Override this to pick out the
+            dependencies (slack_client, directory, ...) the command needs.
+        """
+        return cls()
 
     def invalid(self, command, channel, user):
         return "You did not provide a valid *{}* command".format(self.prefix)
@@ -16,16 +42,64 @@ class BotCommand(object):
         commands = ['*{}*'.format(name) for name in self.command_mappings.keys()]
         return 'Available *{}* commands are {}'.format(self.prefix, ', '.join(commands))
 
+    def resolve(self, command, tokens=None, start=None):
+        """
+            Returns the (name, function, remainder) for the command, or (None, None, None)
+            if it isn't one of ours. The prefix is optional. Callers that have already
+            tokenized the command can pass the tokens and the index to start matching at.
+        """
+        if tokens is None:
+            tokens = tokenize(command)
+        if start is None:
+            prefix = self.prefix.split()
+            start = len(prefix) if [token for token, _ in tokens[:len(prefix)]] == prefix else 0
+
+        match, end = self._command_trie.longest_match(tokens, start)
+        if match is None:
+            return None, None, None
+        name, function = match
+        remainder = command[tokens[end - 1][1]:].strip()
+        return name, function, remainder
+
+    def is_mutating(self, name):
+        return name in self.MUTATING_COMMANDS
+
+    def is_fun(self, name):
+        return name in self.FUN_COMMANDS
+
+    def run_atomic(self, function, command, channel, user, key=None):
+        """
+            Runs a mutating command in a single transaction, so it commits once and a
+            failure part way through leaves nothing behind. rollback() is called if
+            it fails. Given the message's receipt key, a message that was already
+            carried out isn't run again; it gets the reply it got the first time.
+        """
+        try:
+            with self.store.atomic():
+                self.fence()
+                if key is None:
+                    return function(self, command, channel, user)
+                return self.store.run_once(key, function, self, command, channel, user)
+        except Exception:
+            self.rollback()
+            raise
+
+    def fence(self):
+        """
+            Called first thing in a mutating command's transaction. Override this to
+            refuse to write, by raising, when this replica may no longer do so.
+        """
+
+    def rollback(self):
+        """
+            Called after a mutating command fails and its transaction is rolled back.
+            Override this to throw away any in-memory state it may have changed.
+        """
+
     def handle(self, command, channel, user):
-        parsed_command = command
-        if command.startswith(self.prefix):
-            parsed_command = command.replace(self.prefix, '').strip()
-        
-        for name, function in self.command_mappings.items():
-            first, _, rest = parsed_command.partition(' ')
-            if first == name:
-                remainder = parsed_command.replace(name, '').strip()
-                return function(self, remainder, channel, user)
+        name, function, remainder = self.resolve(command)
+        if function is not None:
+            return function(self, remainder, channel, user)
 
         return self.invalid(command, channel, user)
                 
@@ -33,7 +107,9 @@ class BotCommand(object):
     def _command_map(cls):
         command_mappings = {}
         for name, value in cls.__dict__.items():
-            if not name.startswith('_') and isinstance(value, FunctionType):
+            # Overriding one of our hooks (rollback, invalid, ...) doesn't make it a command
+            hook = name != 'help' and name in BotCommand.__dict__
+            if not name.startswith('_') and not hook and isinstance(value, FunctionType):
                 command_mappings[name.replace("_", " ")] = value
         
         command_mappings['help'] = cls.help
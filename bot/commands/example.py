@@ -3,6 +3,7 @@ from bot.commands.base import BotCommand
 
 class ExampleCommand(BotCommand):
     DEFAULT_COMMAND_PREFIX = 'example'
+    FUN_COMMANDS = frozenset(['hello'])
 
     def hello(self, command, channel, user):
         return "Hello, World"
\ No newline at end of file
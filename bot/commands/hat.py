@@ -2,154 +2,183 @@
 
 import pytz
 import re
-from datetime import datetime
-from dateutil.parser import parse
+import tempfile
+import time
+from datetime import datetime, timedelta
 import random
 
-from peewee import *
-
-from bot import settings
+from bot import metrics, render, replica, rollups, settings
 from bot.commands.base import BotCommand
-from bot.models import HatLog, HatQueue, HatPool, SlackUserInfo
+from bot.directory import UserDirectory
+from bot.state import HatStates, configured_hats
 
 # Each function in the class is a new command
 
 class HatCommand(BotCommand):
     DEFAULT_COMMAND_PREFIX = 'hat'
-
-    def __init__(self, slack_client, prefix=None):
+    MUTATING_COMMANDS = frozenset(['on', 'off', 'queue', 'dequeue', 'pool', 'unpool',
+                                   'force', 'tip', 'bless', 'consistency'])
+    FUN_COMMANDS = frozenset(['memeify', 'facts', 'gif'])
+    FALLBACK = True
+    # Pooled users *hat who* mentions by name before counting the rest
+    POOL_MENTIONS = 20
+
+    def __init__(self, slack_client, prefix=None, states=None, directory=None, hats=None,
+                 elector=None, store=None):
+        super(HatCommand, self).__init__(prefix=prefix, store=store)
         self.slack_client = slack_client
-        super(HatCommand, self).__init__(prefix=prefix)
+        self.states = states if states is not None else HatStates.load(store=self.store)
+        # hat name -> channel ID, and channel ID -> the hats in it
+        self.hats = hats if hats is not None else configured_hats()
+        self.channel_hats = {}
+        for hat, hat_channel in sorted(self.hats.items()):
+            self.channel_hats.setdefault(hat_channel, []).append(hat)
+        self.directory = directory if directory is not None else UserDirectory(
+            slack_client, store=self.store)
+        # The HatReminders watching self.states, if any
+        self.reminders = None
+        # This replica's LeaderElector, when running with standbys
+        self.elector = elector
+
+    @classmethod
+    def create(cls, slack_client=None, directory=None, states=None, elector=None, store=None,
+               **dependencies):
+        return cls(slack_client, states=states, directory=directory, elector=elector,
+                   store=store)
+
+    def fence(self):
+        if self.elector is not None:
+            self.elector.fence()
+
+    def rollback(self):
+        # The failed command may have changed a HatState before its writes were undone.
+        # Its events were undone too, so the journal position still holds.
+        event_id = self.states.event_id
+        self.states = HatStates.load(store=self.store)
+        self.states.event_id = event_id
+        if self.reminders is not None:
+            self.reminders.watch(self.states)
 
     # Helpers need to be defined as "private" using "_"
     def _get_user_info(self, user_id):
-        try:
-            return SlackUserInfo.select().where(SlackUserInfo.user_id == user_id).get()
-        except DoesNotExist:
-            return None
+        return self.store.user_info(user_id)
 
     def _get_user_name(self, user_id):
+        return self.directory.get_name(user_id)
+
+    def _get_or_create_user_info(self, user_id):
         user_info = self._get_user_info(user_id)
-        if user_info:
-            return user_info.name, None
-        else:
-            api_results = self.slack_client.api_call(
-                "users.info", user=user_id.upper())
-            name = api_results['user']['profile']['display_name']
-            entry = SlackUserInfo.create(user_id=user_id, name=name)
-            return name, entry
-
-    def _get_current_hat_owner(self):
-        try:
-            entry = HatLog.select().where(HatLog.end_time.is_null(True)
-                                          ).order_by(HatLog.start_time).get()
-            return entry
-        except DoesNotExist:
-            return None
-
-    def _get_pooled_users(self, current_owner_id):
-        return HatPool.select().where(HatPool.end_time.is_null(True),
-                                      HatPool.owner_user_id == current_owner_id)
-
-    def _get_pooled_user_query(self, user_id):
-        return HatPool.select().where(HatPool.end_time.is_null(True),
-                                      HatPool.user_id == user_id)
-
-    def _get_pooled_user(self, user_id):
-        try:
-            return self._get_pooled_user_query(user_id).get()
-        except DoesNotExist:
-            return None
-
-    def _check_if_already_pooled(self, user_id):
-        return self._get_pooled_user_query(user_id).exists()
-
-    def _remove_user_from_queue(self, user, end_time=None):
-        if end_time is None:
-            end_time = datetime.now(tz=pytz.utc)
-        try:
-            entry = HatQueue.select().where(HatQueue.end_time.is_null(True),
-                                            HatQueue.user_id == user).get()
-            entry.end_time = end_time
-            entry.save()
-            return entry
-        except DoesNotExist:
-            return None
-
-    def _get_user_in_queue(self, user):
-        try:
-            entry = HatQueue.select().where(HatQueue.end_time.is_null(True),
-                                            HatQueue.user_id == user).get()
-            position = HatQueue.select().where(HatQueue.end_time.is_null(
-                True), HatQueue.start_time <= entry.start_time).count()
-            return entry, position
-        except DoesNotExist:
-            return None, None
-
-    def _add_user_to_queue(self, user):
+        if not user_info:
+            # The directory may answer from its cache without storing the user
+            self.store.save_user(user_id, self._get_user_name(user_id))
+            user_info = self._get_user_info(user_id)
+        return user_info
+
+    def _admin_refusal(self, user):
         """
-           Adds specified user to queue and returns the number of entries in front of them
+            Returns the reply refusing an admin command (export, metrics and status) to a
+            user who isn't in ADMIN_USERS, or None if they are
         """
-        now = datetime.now(tz=pytz.utc)
-        HatQueue.create(user_id=user, start_time=now)
-        return HatQueue.select().where(HatQueue.end_time.is_null(True), HatQueue.start_time < now).count()
+        admins = set(user_id.upper() for user_id in getattr(settings, 'ADMIN_USERS', ()))
+        if user.upper() not in admins:
+            return 'Only the bot\'s admins can use that command.'
+        return None
 
-    def _get_active_queue_entries(self):
-        return HatQueue.select().where(HatQueue.end_time.is_null(True)).order_by(HatQueue.start_time)
+    def _get_state(self, command, channel, mutating=False):
+        """
+            Picks the hat a command is about: the hat named by the command, or else the
+            channel's hat. Commands that change a hat can only be used in its channel.
+            Returns (state, None), or (None, reason) if no hat applies.
+        """
+        name = command.strip()
+        if name in self.hats:
+            if mutating and self.hats[name] != channel:
+                return None, 'You cannot use that command in this channel.'
+            return self.states.get(name), None
 
-    def _get_next_user_in_queue(self):
-        try:
-            entry = HatQueue.select().where(HatQueue.end_time.is_null(True)
-                                            ).order_by(HatQueue.start_time).get()
-            return entry
-        except DoesNotExist:
-            return None
+        names = self.channel_hats.get(channel, [])
+        if len(names) == 1:
+            return self.states.get(names[0]), None
+        if len(names) > 1:
+            return None, 'This channel has more than one hat. Add one of {} to the command.'.format(
+                ', '.join('*{}*'.format(name) for name in names))
+        if not mutating and len(self.hats) == 1:
+            return self.states.get(next(iter(self.hats))), None
+        return None, 'You cannot use that command in this channel.'
 
-    def _clear_hat_pool(self, owner_id):
-        end_time = datetime.now(tz=pytz.utc)
-        query = HatPool.update(end_time=end_time).where(HatPool.end_time.is_null(True),
-                            HatPool.owner_user_id == owner_id)
-        query.execute()
+    def _get_current_hat_owner(self, state):
+        return state.owner
 
-    def _change_hat_pool_owner(self, current_owner_id, new_owner_id):
-        query = HatPool.update(owner_user_id=new_owner_id).where(HatPool.end_time.is_null(True),
-                        HatPool.owner_user_id == current_owner_id)
-        query.execute()
+    def _get_pooled_users(self, state, current_owner_id):
+        return state.pooled_users(current_owner_id)
 
+    def _get_pooled_user(self, state, user_id):
+        return state.pooled_entry(user_id)
 
-    def _give_up_hat(self, hat_log_entry, end_time=None):
-        if end_time is None:
-            end_time = datetime.now(tz=pytz.utc)
+    def _check_if_already_pooled(self, state, user_id):
+        return state.pooled_entry(user_id) is not None
 
-        hat_log_entry.end_time = end_time
-        hat_log_entry.save()
+    def _remove_user_from_queue(self, state, user, end_time=None):
+        return state.remove_from_queue(user, end_time=end_time)
 
-        return hat_log_entry
+    def _get_user_in_queue(self, state, user):
+        return state.queue_position(user)
 
-    def _daily_deploy_count(self):
-        today = datetime.now(tz=pytz.timezone('US/Eastern')
-                             ).replace(hour=0, minute=0, second=0)
-        return HatQueue.select().where(HatQueue.start_time > today).count()
+    def _add_user_to_queue(self, state, user):
+        """
+           Adds specified user to queue and returns the number of entries in front of them
+        """
+        return state.enqueue(user)
+
+    def _get_active_queue_page(self, state, start, count):
+        return state.queue_page(start, count)
+
+    def _get_next_user_in_queue(self, state):
+        return state.next_in_queue()
+
+    def _clear_hat_pool(self, state, owner_id):
+        state.clear_pool(owner_id)
+
+    def _change_hat_pool_owner(self, state, current_owner_id, new_owner_id):
+        state.change_pool_owner(current_owner_id, new_owner_id)
+
+    def _give_up_hat(self, state, end_time=None):
+        return state.give_up_hat(end_time=end_time)
+
+    def _force_off(self, state):
+        """
+            Takes the hat off its owner and breaks up their pool. Returns the end of the
+            message saying so: who had it, for how long, and who is next in the queue.
+        """
+        now = datetime.now(tz=pytz.utc)
+        owner_entry = self._give_up_hat(state, end_time=now)
+        self._clear_hat_pool(state, owner_entry.user_id)
+        timedelta = now - owner_entry.start_time
+        queued_user = self._get_next_user_in_queue(state)
+        if queued_user:
+            return '<@{}>. They had it for {}. <@{}> is next in the queue'.format(
+                owner_entry.user_id, timedelta, queued_user.user_id)
+        else:
+            return '<@{}>. They had it for {}.'.format(owner_entry.user_id, timedelta)
+
+    def _daily_deploy_count(self, hat):
+        return self.store.count(rollups.DAILY_DEPLOYS, rollups.daily_bucket(hat))
 
     def _user_deploy_count(self, user_id):
-        return HatQueue.select().where(HatQueue.user_id == user_id).count()
+        return self.store.count(rollups.USER_DEPLOYS, user_id)
 
     def _user_pool_count(self, user_id):
-        return HatPool.select().where(HatPool.user_id == user_id).count()
+        return self.store.count(rollups.USER_POOLS, user_id)
 
-    def _check_channel(self, channel):
-        if channel != settings.CHANNEL_ID:
-            return False
-        else:
-            return True
     #
     # BEGIN REAL COMMANDS (Not helpers)
     #
 
     def on(self, command, channel, user):
-        if not self._check_channel(channel):
-            return 'You cannot use that command in this channel.'
-        owner_entry = self._get_current_hat_owner()
+        state, error = self._get_state(command, channel, mutating=True)
+        if error:
+            return error
+        owner_entry = self._get_current_hat_owner(state)
         if owner_entry:
             if user == owner_entry.user_id:
                 return 'You already have the hat.'
@@ -160,38 +189,37 @@ class HatCommand(BotCommand):
         else:
             # Grab the hat
             now = datetime.now(tz=pytz.utc)
-            HatLog.create(user_id=user, start_time=datetime.now(tz=pytz.utc))
-            queue_entry = self._remove_user_from_queue(user, end_time=now)
+            state.take_hat(user, now)
+            queue_entry = self._remove_user_from_queue(state, user, end_time=now)
             if queue_entry:
-                return 'You have the hat now! You waited for {} in the queue.'.format(now - parse(queue_entry.start_time))
+                return 'You have the hat now! You waited for {} in the queue.'.format(now - queue_entry.start_time)
             else:
                 return 'You have the hat now!'
 
     def off(self, command, channel, user):
-        if not self._check_channel(channel):
-            return 'You cannot use that command in this channel.'
-        owner_entry = self._get_current_hat_owner()
+        state, error = self._get_state(command, channel, mutating=True)
+        if error:
+            return error
+        owner_entry = self._get_current_hat_owner(state)
         if owner_entry:
             if user == owner_entry.user_id:
                 now = datetime.now(tz=pytz.utc)
-                owner_entry = self._give_up_hat(owner_entry, end_time=now)
-                timedelta = now - parse(owner_entry.start_time)
-                pooled_users = self._get_pooled_users(owner_entry.user_id)
-                if pooled_users.count() == 0:
-                    queued_user = self._get_next_user_in_queue()
+                owner_entry = self._give_up_hat(state, end_time=now)
+                timedelta = now - owner_entry.start_time
+                pooled_users = self._get_pooled_users(state, owner_entry.user_id)
+                if not pooled_users:
+                    queued_user = self._get_next_user_in_queue(state)
                     if queued_user:
                         return 'You have given up the hat. You had it for {}. <@{}> is next in the queue'.format(timedelta, queued_user.user_id)
                     else:
                         return 'You have given up the hat. You had it for {}.'.format(timedelta)
                 else:
-                    first_pooled = pooled_users[0]
-                    new_owner_id = first_pooled.user_id
-                    first_pooled.end_time = now
-                    first_pooled.save()
-                    HatLog.create(user_id=new_owner_id, start_time=datetime.now(tz=pytz.utc))
-                    self._remove_user_from_queue(new_owner_id)
+                    new_owner_id = pooled_users[0].user_id
+                    state.remove_from_pool(new_owner_id, end_time=now)
+                    state.take_hat(new_owner_id, now)
+                    self._remove_user_from_queue(state, new_owner_id)
                     self._change_hat_pool_owner(
-                        owner_entry.user_id, new_owner_id
+                        state, owner_entry.user_id, new_owner_id
                     )
                     return 'You have given up the hat. You had it for {}. <@{}> now has the hat.'.format(timedelta, new_owner_id)
             else:
@@ -201,133 +229,249 @@ class HatCommand(BotCommand):
             return 'No one has the hat now.'
 
     def who(self, command, channel, user):
-        owner_entry = self._get_current_hat_owner()
+        state, error = self._get_state(command, channel)
+        if error:
+            return error
+        owner_entry = self._get_current_hat_owner(state)
         if not owner_entry:
             return 'No one has the hat now.'
         else:
-            pooled_users = self._get_pooled_users(owner_entry.user_id)
-            if pooled_users.count() == 0:
+            pooled_users = self._get_pooled_users(state, owner_entry.user_id)
+            if not pooled_users:
                 return '<@{}> has the hat. They\'ve had it since {}'.format(owner_entry.user_id, owner_entry.start_time)
             else:
-                pooled_ids = ['<@{}>'.format(user.user_id)
-                              for user in pooled_users]
+                pooled_ids = ', '.join('<@{}>'.format(user.user_id)
+                                       for user in pooled_users[:self.POOL_MENTIONS])
+                if len(pooled_users) > self.POOL_MENTIONS:
+                    pooled_ids += ' and {} others'.format(len(pooled_users) - self.POOL_MENTIONS)
                 verb = 'is'
-                if len(pooled_ids) > 1:
+                if len(pooled_users) > 1:
                     verb = 'are'
                 return '<@{}> has the hat. They\'ve had it since {}. {} {} also in the hat pool.'.format(
-                    owner_entry.user_id, owner_entry.start_time, ', '.join(pooled_ids), verb)
+                    owner_entry.user_id, owner_entry.start_time, pooled_ids, verb)
 
     def queue(self, command, channel, user):
-        if not self._check_channel(channel):
-            return 'You cannot use that command in this channel.'
-        queued_user, position = self._get_user_in_queue(user)
-        owner_entry = self._get_current_hat_owner()
+        state, error = self._get_state(command, channel, mutating=True)
+        if error:
+            return error
+        queued_user, position = self._get_user_in_queue(state, user)
+        owner_entry = self._get_current_hat_owner(state)
         if owner_entry and owner_entry.user_id == user:
             return 'You can\'t join the queue, you already have the hat.'
         if queued_user:
-            timedelta = datetime.now(tz=pytz.utc) - \
-                parse(queued_user.start_time)
+            timedelta = datetime.now(tz=pytz.utc) - queued_user.start_time
             return 'You are already in the queue. Your position is {}. You have been waiting for {}.'.format(position, timedelta)
         else:
-            position = self._add_user_to_queue(user)
+            position = self._add_user_to_queue(state, user)
             return 'You have joined the queue. There are {} people in front of you'.format(position)
 
     def dequeue(self, command, channel, user):
-        if not self._check_channel(channel):
-            return 'You cannot use that command in this channel.'
-        queued_user, position = self._get_user_in_queue(user)
+        state, error = self._get_state(command, channel, mutating=True)
+        if error:
+            return error
+        queued_user, position = self._get_user_in_queue(state, user)
         if not queued_user:
             return 'You are not in the queue.'
         else:
-            entry = self._remove_user_from_queue(user)
-            timedelta = entry.end_time - parse(entry.start_time)
+            entry = self._remove_user_from_queue(state, user)
+            timedelta = entry.end_time - entry.start_time
             return 'You have left the queue. You waited for {}'.format(timedelta)
 
     def queued(self, command, channel, user):
-        queue_entries = self._get_active_queue_entries()
-        if queue_entries.count() == 0:
+        """
+            Lists the queue a page at a time: *hat queued 2* is the second page
+        """
+        words = command.split()
+        page = 1
+        if words and words[-1].isdigit():
+            page = int(words.pop())
+        elif words and words[0].isdigit():
+            page = int(words.pop(0))
+        state, error = self._get_state(' '.join(words), channel)
+        if error:
+            return error
+        page_size = getattr(settings, 'QUEUE_PAGE_SIZE', 20)
+        start = (max(page, 1) - 1) * page_size
+        queue_entries, length = self._get_active_queue_page(state, start, page_size)
+        if not length:
             return 'No one is in the queue.'
-        else:
-            response = ''
-            counter = 1
-            for entry in queue_entries:
-                name, _ = self._get_user_name(entry.user_id.upper())
-                response += '*{}*. {}\n'.format(counter, name)
-                counter += 1
-            return response
+        pages = (length + page_size - 1) // page_size
+        if not queue_entries:
+            return 'The queue only has {} {}.'.format(pages, 'page' if pages == 1 else 'pages')
+        lines = ['*{}*. {}'.format(position, self._get_user_name(entry.user_id))
+                 for position, entry in enumerate(queue_entries, start + 1)]
+        footer = None
+        if pages > 1:
+            footer = 'Page {} of {}.'.format(page, pages)
+            if page < pages:
+                footer += ' Use *{} queued {}* for more.'.format(self.prefix, page + 1)
+        title = '{} {} in the queue'.format(length, 'person is' if length == 1 else 'people are')
+        if len(self.hats) > 1:
+            title += ' for *{}*'.format(state.hat)
+        return render.listing(title + ':', lines, footer,
+                              blocks=getattr(settings, 'REPLY_BLOCKS', False))
 
     def force(self, command, channel, user):
-        if not self._check_channel(channel):
-            return 'You cannot use that command in this channel.'
-        if command == "off":
-            owner_entry = self._get_current_hat_owner()
-            if owner_entry:
-                now = datetime.now(tz=pytz.utc)
-                owner_entry = self._give_up_hat(owner_entry, end_time=now)
-                self._clear_hat_pool(owner_entry.user_id)
-                timedelta = now - parse(owner_entry.start_time)
-                queued_user = self._get_next_user_in_queue()
-                if queued_user:
-                    return 'The hat has been forced off of <@{}>. They had it for {}. <@{}> is next in the queue'.format(
-                        owner_entry.user_id, timedelta, queued_user.user_id)
-                else:
-                    return 'The hat has been forced off of <@{}>. They had it for {}.'.format(owner_entry.user_id, timedelta)
+        action, _, hat = command.partition(' ')
+        state, error = self._get_state(hat, channel, mutating=True)
+        if error:
+            return error
+        if action == "off":
+            if self._get_current_hat_owner(state):
+                return 'The hat has been forced off of {}'.format(self._force_off(state))
             else:
                 return 'No one has the hat now.'
         else:
             return 'Valid *hat force* commands are: *off*'
 
     def pool(self, command, channel, user):
-        if not self._check_channel(channel):
-            return 'You cannot use that command in this channel.'
-        owner_entry = self._get_current_hat_owner()
+        state, error = self._get_state(command, channel, mutating=True)
+        if error:
+            return error
+        owner_entry = self._get_current_hat_owner(state)
         if not owner_entry:
             return 'No one has the hat, so you can\'t pool.'
         else:
             if owner_entry.user_id == user:
                 return 'You can\'t *hat pool* with yourself.'
 
-            if self._check_if_already_pooled(user):
+            if self._check_if_already_pooled(state, user):
                 return 'You are already in the pool.'
             # Create pool record
-            HatPool.create(owner_user_id=owner_entry.user_id, user_id=user)
-            queued_user, position = self._get_user_in_queue(user)
+            state.add_to_pool(owner_entry.user_id, user)
+            queued_user, position = self._get_user_in_queue(state, user)
             if queued_user:
-                entry = self._remove_user_from_queue(user)
-                timedelta = entry.end_time - parse(entry.start_time)
+                entry = self._remove_user_from_queue(state, user)
+                timedelta = entry.end_time - entry.start_time
                 return '<@{}> is now pooling with <@{}>. You waited in the queue for {}'.format(user, owner_entry.user_id, timedelta)
             else:
                 return '<@{}> is now pooling with <@{}>'.format(user, owner_entry.user_id)
     
     def unpool(self, command, channel, user):
-        if not self._check_channel(channel):
-            return 'You cannot use that command in this channel.'
-        owner_entry = self._get_current_hat_owner()
+        state, error = self._get_state(command, channel, mutating=True)
+        if error:
+            return error
+        owner_entry = self._get_current_hat_owner(state)
         if not owner_entry:
             return 'No one has the hat, so you can\'t unpool.'
         else:
-            pooled_user = self._get_pooled_user(user)
+            pooled_user = state.remove_from_pool(user)
             if pooled_user:
-                pooled_user.end_time = datetime.now(tz=pytz.utc)
-                pooled_user.save()
                 return '<@{}> is no longer pooling'.format(user)
             else:
                 return '<@{}> is not in the pool'.format(user)
 
     def stats(self, command, channel, user):
-        count = self._daily_deploy_count()
+        state, error = self._get_state(command, channel)
+        if error:
+            return error
+        count = self._daily_deploy_count(state.hat)
         return 'There have been {} deploys today.'.format(count)
 
     def info(self, command, channel, user):
-        user_info = self._get_user_info(user)
-        if not user_info:
-            name, user_info = self._get_user_name(user)
+        user_info = self._get_or_create_user_info(user)
+        tips = user_info.tip if user_info is not None else 0
 
         deploy_count = self._user_deploy_count(user)
         pool_count = self._user_pool_count(user)
 
         return 'You have deployed {} times, and been in {} deploy pools. You have been tipped {} times'.format(
-            deploy_count, pool_count, user_info.tip)
+            deploy_count, pool_count, tips)
+
+    def report(self, command, channel, user):
+        if self.store.db is None:
+            return 'There is no history to report on: the hats are only kept in memory.'
+        # numpy is slow to import, so only load it once someone asks for a report
+        from bot.report import DEFAULT_WINDOW, build_report, format_report, parse_window
+
+        window = DEFAULT_WINDOW
+        names = []
+        for word in command.split():
+            try:
+                parsed = parse_window(word)
+            except ValueError as error:
+                return '{}. Use *hat report* with a window like *12h*, *30d* or *8w*.'.format(
+                    error)
+            if parsed is not None:
+                window = parsed
+            else:
+                names.append(word)
+        state, error = self._get_state(' '.join(names), channel)
+        if error:
+            return error
+        return format_report(build_report(self.store.db, state.hat, window))
+
+    def export(self, command, channel, user):
+        """
+            hat export <hatlog|hatqueue|hatpool|users|events> [csv|jsonl] [after <id>]
+            uploads the rows to the channel as a file, up to EXPORT_MAX_ROWS at a time
+        """
+        refusal = self._admin_refusal(user)
+        if refusal:
+            return refusal
+        if self.store.db is None:
+            return 'There is nothing to export: the hats are only kept in memory.'
+        from bot.export import EXPORTS, FORMATS, export
+
+        words = command.split()
+        if not words or words[0] not in EXPORTS:
+            return 'Use *hat export* with one of {}, then optionally {} and *after* an id'.format(
+                ', '.join('*{}*'.format(name) for name in sorted(EXPORTS)),
+                ' or '.join('*{}*'.format(name) for name in FORMATS))
+        name = words[0]
+        output_format = next((word for word in words[1:] if word in FORMATS), 'csv')
+        after = 0
+        if 'after' in words[1:-1]:
+            try:
+                after = int(words[words.index('after') + 1])
+            except ValueError:
+                return 'The id after *after* must be a number'
+        limit = getattr(settings, 'EXPORT_MAX_ROWS', 50000)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.' + output_format, newline='') as out:
+            count, last = export(self.store.db, name, out, output_format, after, limit)
+            if not count:
+                return 'There are no {} rows after {}.'.format(name, after)
+            out.flush()
+            with open(out.name, 'rb') as upload:
+                result = self.slack_client.api_call(
+                    'files.upload', channels=channel, file=upload,
+                    filename='{}-after-{}.{}'.format(name, after, output_format),
+                    title='{} rows {} to {}'.format(name, after + 1, last))
+        if not result.get('ok'):
+            return 'The export could not be uploaded: {}'.format(result.get('error'))
+        if count == limit:
+            return 'Exported {} {} rows. Use *hat export {} {} after {}* for the rest.'.format(
+                count, name, name, output_format, last)
+        return 'Exported {} {} rows.'.format(count, name)
+
+    def metrics(self, command, channel, user):
+        refusal = self._admin_refusal(user)
+        if refusal:
+            return refusal
+        return metrics.summary()
+
+    def status(self, command, channel, user):
+        refusal = self._admin_refusal(user)
+        if refusal:
+            return refusal
+        if self.elector is None:
+            return 'Replication is off, so this is the only replica.'
+        (holder, term, acquired, expires), replicas = replica.replicas(self.store.db)
+        now = time.time()
+        if holder is not None and expires > now:
+            lines = ['*{}* is active, and has been for {} (term {}).'.format(
+                holder, timedelta(seconds=int(now - acquired)), term)]
+        else:
+            lines = ['No replica is active right now.']
+        for name, role, heartbeat, event_id in replicas:
+            if name == holder:
+                continue
+            if now - heartbeat > 2 * self.elector.ttl:
+                lines.append('*{}* has not been seen for {:.0f}s.'.format(name, now - heartbeat))
+            else:
+                lines.append('*{}* is a standby at journal event {}.'.format(name, event_id))
+        return '\n'.join(lines)
 
     def tip(self, command, channel, user):
         # Get user to tip from command
@@ -340,16 +484,24 @@ class HatCommand(BotCommand):
         if tipped_user_id == user and user != 'U41TGMU3G':
             return 'You can\'t tip yourself. Cheater.'
 
-        user_info = self._get_user_info(tipped_user_id)
-        if not user_info:
-            name, user_info = self._get_user_name(tipped_user_id)
-        user_info.tip = user_info.tip + 1
-        user_info.save()
+        self._get_or_create_user_info(tipped_user_id)
+        self.store.tip(tipped_user_id)
         if user == 'U41TGMU3G' and tipped_user_id == user:
             return 'You can\'t tip yourself. Cheater.'
         else:
             return '<@{}> has tipped <@{}>!'.format(user, tipped_user_id)
 
+    def consistency(self, command, channel, user):
+        problems = []
+        for hat in self.states.hats():
+            problems.extend('{}: {}'.format(hat, problem)
+                            for problem in self.states.get(hat).check())
+        if not problems:
+            return 'The hat state in memory matches the database.'
+        else:
+            return 'The hat state in memory does not match the database: {}'.format(
+                '; '.join(problems))
+
     def bless(self, command, channel, user):
         return '{}{}'.format(self.tip(command, channel, user), ' :pray: ')
 
@@ -396,9 +548,8 @@ class HatCommand(BotCommand):
     def help(self, command, channel, user):
         commands = ['*{}*'.format(name)
                     for name in self.command_mappings.keys()]
-        # Hide some commands
-        commands.remove('*memeify*')
-        commands.remove('*facts*')
-        commands.remove('*gif*')
+        # Hide the fun commands
+        for name in self.FUN_COMMANDS:
+            commands.remove('*{}*'.format(name))
 
         return 'Available *{}* commands are {}'.format(self.prefix, ', '.join(commands))
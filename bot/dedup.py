@@ -0,0 +1,63 @@
+"""
+    Drops Slack events we have already seen. The RTM replays recent messages after a
+    reconnect and the Events API retries deliveries it isn't sure about, so the same
+    message can arrive twice; this catches repeats before they are dispatched, and
+    command receipts (bot.receipts) catch any that get through.
+"""
+import time
+from collections import OrderedDict
+
+
+def event_key(event):
+    """
+        What identifies a message: its client_msg_id if the client gave it one,
+        otherwise its channel and timestamp
+    """
+    client_msg_id = event.get('client_msg_id')
+    if client_msg_id:
+        return client_msg_id
+    return '{}:{}'.format(event.get('channel'), event.get('ts'))
+
+
+class RecentEvents(object):
+    """
+        The keys of the events seen in the last `window` seconds, up to max_size of
+        them, oldest first. Not thread safe; it is only used by the read loop.
+    """
+
+    def __init__(self, window=600, max_size=10000, clock=time.monotonic):
+        self.window = window
+        self.max_size = max_size
+        self.clock = clock
+        self._seen = OrderedDict()
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def clear(self):
+        self._seen.clear()
+
+    def seen(self, key):
+        """
+            Returns whether key was seen within the window, remembering it if not
+        """
+        now = self.clock()
+        expired = now - self.window
+        while self._seen:
+            oldest, seen_at = next(iter(self._seen.items()))
+            if seen_at >= expired:
+                break
+            del self._seen[oldest]
+
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[key] = now
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def register_metrics(self, registry):
+        registry.callback('hatman_duplicate_events', 'Repeated events that were dropped',
+                          'counter', lambda: self.duplicates)
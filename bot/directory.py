@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from bot import storage
+
+logger = logging.getLogger(__name__)
+
+
+def display_name(member):
+    profile = member.get('profile', {})
+    return profile.get('display_name') or profile.get('real_name') or member.get('name', '')
+
+
+class UserDirectory(object):
+    """
+        Slack user names, bulk loaded from users.list and kept in an LRU cache backed by
+        the store's users (the SlackUserInfo table, with the default store). Entries
+        older than `ttl` seconds are still served, but are refreshed in the background.
+        Concurrent misses for the same user share a single users.info call.
+    """
+
+    def __init__(self, slack_client, ttl=3600, max_size=5000, page_size=200, store=None):
+        self.slack_client = slack_client
+        self.store = store if store is not None else storage.default_store()
+        self.ttl = ttl
+        self.max_size = max_size
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        # user_id -> (name, fetched_at), least recently used first
+        self._entries = OrderedDict()
+        # user_id -> Future for the users.info call in flight
+        self._inflight = {}
+        self._refresher = ThreadPoolExecutor(max_workers=1)
+
+    def load(self):
+        """
+            Pages through users.list and caches every member. Returns the number loaded.
+        """
+        names = {}
+        cursor = None
+        while True:
+            kwargs = {'limit': self.page_size}
+            if cursor:
+                kwargs['cursor'] = cursor
+            results = self.slack_client.api_call('users.list', **kwargs)
+            if not results.get('ok'):
+                logger.warning('users.list failed: %s', results.get('error'))
+                break
+            for member in results.get('members', []):
+                names[member['id'].upper()] = display_name(member)
+            cursor = results.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+        self.store.save_users(names)
+        fetched_at = time.time()
+        with self._lock:
+            for user_id, name in names.items():
+                self._put(user_id, name, fetched_at)
+        return len(names)
+
+    def load_in_background(self):
+        """
+            Runs load() on the refresh thread, for when the cache is already warm
+        """
+        return self._refresher.submit(self.load)
+
+    def close(self):
+        """
+            Waits for background refreshes to finish
+        """
+        self._refresher.shutdown(wait=True)
+
+    def entries(self):
+        """
+            Returns the cached (user_id, name, fetched_at) entries, least recently used first
+        """
+        with self._lock:
+            return [(user_id, name, fetched_at)
+                    for user_id, (name, fetched_at) in self._entries.items()]
+
+    def restore(self, entries):
+        """
+            Fills the cache from entries() saved earlier. Stale entries are served and
+            refreshed as usual.
+        """
+        with self._lock:
+            for user_id, name, fetched_at in entries:
+                self._put(user_id, name, fetched_at)
+
+    def follow(self, after_id=0):
+        """
+            Caches the stored users with ids above after_id: on a standby, the users
+            the active replica has just looked up. Returns the highest id there is.
+        """
+        rows = self.store.users_after(after_id)
+        fetched_at = time.time()
+        with self._lock:
+            for after_id, user_id, name in rows:
+                self._put(user_id, name, fetched_at)
+        return after_id
+
+    def get_name(self, user_id):
+        user_id = user_id.upper()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        if entry is not None:
+            name, fetched_at = entry
+            if time.time() - fetched_at > self.ttl:
+                self.refresh(user_id)
+            return name
+
+        user_info = self.store.user_info(user_id)
+        if user_info is not None:
+            # We don't know how old the stored name is, so serve it and refresh it
+            with self._lock:
+                self._put(user_id, user_info.name, 0)
+            self.refresh(user_id)
+            return user_info.name
+
+        return self._fetch(user_id).result()
+
+    def refresh(self, user_id):
+        """
+            Re-fetches the user's name in the background, unless a fetch is already running
+        """
+        with self._lock:
+            if user_id in self._inflight:
+                return
+        self._refresher.submit(self._fetch, user_id)
+
+    def _fetch(self, user_id):
+        with self._lock:
+            future = self._inflight.get(user_id)
+            if future is not None:
+                return future
+            future = self._inflight[user_id] = Future()
+
+        try:
+            api_results = self.slack_client.api_call('users.info', user=user_id)
+            name = display_name(api_results['user'])
+            self.store.save_user(user_id, name)
+            with self._lock:
+                self._put(user_id, name, time.time())
+            future.set_result(name)
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self._lock:
+                del self._inflight[user_id]
+        return future
+
+    def _put(self, user_id, name, fetched_at):
+        self._entries[user_id] = (name, fetched_at)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,169 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first. STATE commands change hat state and have the
+# ordered lane to themselves; QUERY and FUN share the concurrent lane, where queries
+# always go first. FUN commands are the novelty ones, shed first under load.
+STATE = 0
+QUERY = 1
+FUN = 2
+PRIORITY_NAMES = ('state', 'query', 'fun')
+
+
+class Overloaded(Exception):
+    """
+        Raised by submit() for a FUN command that was shed because too many commands
+        are already waiting
+    """
+
+
+class _Lane(object):
+    """
+        Worker threads taking the most urgent waiting command, oldest first within a
+        priority class
+    """
+
+    def __init__(self, name, workers, on_start):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._on_start = on_start
+        # priority -> commands waiting in it
+        self.waiting = [0] * len(PRIORITY_NAMES)
+        self._threads = [threading.Thread(target=self._run, name='{}-{}'.format(name, index),
+                                          daemon=True)
+                         for index in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, priority, future, function, args, coalesce):
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError('cannot schedule new commands after shutdown')
+            heapq.heappush(self._heap, (priority, next(self._sequence), time.perf_counter(),
+                                        future, function, args, coalesce))
+            self.waiting[priority] += 1
+            self._condition.notify()
+
+    def stop(self, wait=True):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap and not self._stopping:
+                    self._condition.wait()
+                if not self._heap:
+                    return
+                priority, _, queued_at, future, function, args, coalesce = \
+                    heapq.heappop(self._heap)
+                self.waiting[priority] -= 1
+            metrics.COMMAND_WAIT_SECONDS.labels(PRIORITY_NAMES[priority]).observe(
+                time.perf_counter() - queued_at)
+            self._on_start(coalesce)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as error:
+                future.set_exception(error)
+
+
+class CommandEngine(object):
+    """
+        Runs commands off of the main loop so a slow query or Slack API call can't stall
+        the bot. Commands that change hat state (STATE) go through a single ordered lane,
+        so they are applied one at a time in the order they arrived. Everything else
+        runs concurrently, with at most `concurrency` commands in flight, queries ahead
+        of FUN commands.
+
+        At most `max_pending` commands can be waiting or running; past that submit()
+        blocks, which pushes back on whatever is feeding the bot events. FUN commands
+        never get that far: once `shed_depth` commands are waiting on the concurrent
+        lane they are refused with Overloaded, and one that is the same as a FUN command
+        already waiting (by its coalesce key) shares that command's future.
+    """
+
+    def __init__(self, concurrency=4, max_pending=1000, shed_depth=50):
+        self.concurrency = concurrency
+        self.shed_depth = shed_depth
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # coalesce key -> future of the FUN command waiting under it
+        self._coalescing = {}
+        self.coalesced = 0
+        self._writer = _Lane('command-writer', 1, self._started)
+        self._readers = _Lane('command-reader', concurrency, self._started)
+
+    def submit(self, priority, function, *args, coalesce=None):
+        """
+            Queues function(*args) in the priority class and returns its Future. For FUN
+            commands, coalesce is a key identifying identical ones, e.g. (channel, text).
+        """
+        if priority == FUN:
+            with self._lock:
+                future = self._coalescing.get(coalesce) if coalesce is not None else None
+                if future is not None:
+                    self.coalesced += 1
+                    return future
+                if sum(self._readers.waiting) >= self.shed_depth:
+                    raise Overloaded()
+                future = Future()
+                if coalesce is not None:
+                    self._coalescing[coalesce] = future
+        else:
+            future = Future()
+
+        self._slots.acquire()
+        lane = self._writer if priority == STATE else self._readers
+        try:
+            lane.put(priority, future, function, args, coalesce)
+        except Exception:
+            self._slots.release()
+            self._started(coalesce)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def waiting(self, priority):
+        lane = self._writer if priority == STATE else self._readers
+        return lane.waiting[priority]
+
+    def shutdown(self, wait=True):
+        self._writer.stop(wait=wait)
+        self._readers.stop(wait=wait)
+
+    def register_metrics(self, registry):
+        for priority, name in enumerate(PRIORITY_NAMES):
+            registry.callback('hatman_commands_waiting_{}'.format(name),
+                              'Commands of the {} class waiting to run'.format(name), 'gauge',
+                              lambda priority=priority: self.waiting(priority))
+        registry.callback('hatman_commands_coalesced',
+                          'Fun commands merged into an identical one already waiting',
+                          'counter', lambda: self.coalesced)
+
+    def _started(self, coalesce):
+        # Once a FUN command is running, a new identical one gets a reply of its own
+        if coalesce is not None:
+            with self._lock:
+                self._coalescing.pop(coalesce, None)
+
+    def _done(self, future):
+        self._slots.release()
+        error = future.exception()
+        if error is not None:
+            logger.error('Command failed', exc_info=(type(error), error, error.__traceback__))
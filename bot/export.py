@@ -0,0 +1,101 @@
+"""
+    Streams history out of the database as CSV or JSON lines for audits. Rows are read
+    as plain tuples a page at a time, keyed on the primary key, so memory use stays the
+    same however big the tables are, and an export can be resumed from the last id it
+    wrote.
+"""
+import csv
+import heapq
+import json
+
+from bot.models import from_epoch_us
+
+# name -> (tables holding its rows, columns). History is split between a hot table
+# and its archive, with ids unique across both.
+EXPORTS = {
+    'hatlog': (['hatlog_archive', 'hatlog'], ['id', 'hat', 'user_id', 'start_time', 'end_time']),
+    'hatqueue': (['hatqueue_archive', 'hatqueue'],
+                 ['id', 'hat', 'user_id', 'start_time', 'end_time']),
+    'hatpool': (['hatpool_archive', 'hatpool'], ['id', 'hat', 'owner_user_id', 'user_id',
+                                                 'end_time']),
+    'users': (['slackuserinfo'], ['id', 'user_id', 'name', 'tip']),
+    'events': (['hat_event'], ['id', 'hat', 'kind', 'user_id', 'other_user_id', 'entry_id',
+                               'time', 'cause', 'command_key']),
+}
+
+FORMATS = ('csv', 'jsonl')
+
+PAGE_SIZE = 1000
+
+
+def _pages(db, table, columns, after, page_size):
+    names = ', '.join('"{}"'.format(column) for column in columns)
+    while True:
+        rows = db.execute_sql('SELECT {} FROM "{}" WHERE "id" > ? ORDER BY "id" LIMIT ?'.format(
+            names, table), (after, page_size)).fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
+
+
+def rows(db, name, after=0, page_size=PAGE_SIZE):
+    """
+        Yields the export's rows with ids above `after`, in id order. Each table is
+        paged separately and the pages merged, since ordering a view over several
+        tables would sort everything past the cursor for every page. Read them in a
+        transaction: otherwise rows the archiver moves between page fetches, out of a
+        hot table already paged past them and into an archive table not yet, are missed.
+    """
+    tables, columns = EXPORTS[name]
+    return heapq.merge(*[_pages(db, table, columns, after, page_size) for table in tables])
+
+
+def _readable(columns):
+    """
+        Returns a function making a row readable: times become ISO 8601 UTC
+    """
+    times = [index for index, column in enumerate(columns)
+             if column == 'time' or column.endswith('_time')]
+    if not times:
+        return tuple
+
+    def readable(row):
+        row = list(row)
+        for index in times:
+            if row[index] is not None:
+                row[index] = from_epoch_us(row[index]).isoformat()
+        return row
+    return readable
+
+
+def export(db, name, out, output_format='csv', after=0, limit=None, header=True):
+    """
+        Writes the export's rows with ids above `after` to the file out, at most `limit`
+        of them. Returns (rows written, id of the last one), or (0, after) if there were
+        none; pass the id as `after` to carry on from there.
+    """
+    _, columns = EXPORTS[name]
+    readable = _readable(columns)
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        if header:
+            writer.writerow(columns)
+        write = writer.writerow
+    elif output_format == 'jsonl':
+        def write(row):
+            out.write(json.dumps(dict(zip(columns, row))) + '\n')
+    else:
+        raise ValueError('Unknown export format {}'.format(output_format))
+
+    count, last = 0, after
+    # Every page is read from the same snapshot of the database
+    with db.atomic():
+        for row in rows(db, name, after):
+            if limit is not None and count >= limit:
+                break
+            write(readable(row))
+            count += 1
+            last = row[0]
+    return count, last
@@ -0,0 +1,158 @@
+"""
+    The hat_event journal: every change to a hat, appended by HatState in the same
+    transaction as the change. Together with the snapshots in hat_snapshot it gives
+    the hat state as of any event, so startup rebuilds the state from the latest
+    snapshot plus the events after it, and a dump of the journal can be replayed
+    offline to see exactly how a handoff played out.
+"""
+import json
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+import pytz
+
+from bot.models import to_epoch_us
+from bot.state import HatStates
+
+logger = logging.getLogger(__name__)
+
+Event = namedtuple('Event', 'id hat kind user_id other_user_id entry_id time cause command_key')
+
+EVENT_COLUMNS = ', '.join('"{}"'.format(field) for field in Event._fields)
+
+# Events are read this many at a time
+CHUNK_SIZE = 1000
+
+
+def last_event_id(db):
+    return db.execute_sql('SELECT MAX("id") FROM "hat_event"').fetchone()[0] or 0
+
+
+def latest_snapshot(db, at_or_before=None):
+    """
+        Returns (event_id, rows) for the newest snapshot taken at or before the given
+        event (or the oldest there is, if none was), or (None, None) if there are none
+    """
+    row = None
+    if at_or_before is not None:
+        row = db.execute_sql('SELECT "event_id", "state" FROM "hat_snapshot" '
+                             'WHERE "event_id" <= ? ORDER BY "event_id" DESC LIMIT 1',
+                             (at_or_before,)).fetchone()
+    if row is None:
+        row = db.execute_sql('SELECT "event_id", "state" FROM "hat_snapshot" ORDER BY '
+                             '"event_id" {} LIMIT 1'.format(
+                                 'DESC' if at_or_before is None else 'ASC')).fetchone()
+    if row is None:
+        return None, None
+    return row[0], json.loads(row[1])
+
+
+def events_after(db, event_id, until=None, hat=None, chunk_size=CHUNK_SIZE):
+    """
+        Yields the events after event_id (up to and including until), in order. They
+        are read a chunk at a time by id, so memory use doesn't grow with the journal.
+    """
+    conditions = '"id" > ?'
+    if until is not None:
+        conditions += ' AND "id" <= {:d}'.format(until)
+    if hat is not None:
+        conditions += ' AND "hat" = ?'
+    while True:
+        parameters = (event_id, hat) if hat is not None else (event_id,)
+        rows = db.execute_sql('SELECT {} FROM "hat_event" WHERE {} ORDER BY "id" LIMIT {:d}'
+                              .format(EVENT_COLUMNS, conditions, chunk_size),
+                              parameters).fetchall()
+        for row in rows:
+            yield Event(*row)
+        if len(rows) < chunk_size:
+            return
+        event_id = rows[-1][0]
+
+
+def restore(db):
+    """
+        Rebuilds every hat's state from the latest snapshot and the events after it.
+        Returns None if the journal has no snapshot to start from.
+    """
+    event_id, rows = latest_snapshot(db)
+    if rows is None:
+        return None
+    states = HatStates.from_rows(rows)
+    states.event_id = event_id
+    replayed = follow(db, states)
+    logger.info('Restored hat state from the snapshot at event %d and %d events after it',
+                event_id, replayed)
+    return states
+
+
+def follow(db, states):
+    """
+        Applies the events after states.event_id to the states, which must have been
+        built from the journal, and moves event_id on. Returns how many there were.
+    """
+    replayed = 0
+    for event in events_after(db, states.event_id):
+        states.get(event.hat).replay(event)
+        states.event_id = event.id
+        replayed += 1
+    return replayed
+
+
+def take_snapshot(db, states, keep=100):
+    """
+        Saves the states as of the latest event, unless nothing has happened since the
+        last snapshot, and drops all but the newest `keep` snapshots. Run it where no
+        command can change the states meanwhile, i.e. on the engine's ordered lane.
+        Returns the event id of the snapshot taken, or None.
+    """
+    with db.atomic():
+        event_id = last_event_id(db)
+        latest, _ = latest_snapshot(db)
+        if latest is not None and latest >= event_id:
+            return None
+        db.execute_sql('INSERT INTO "hat_snapshot" ("event_id", "taken_time", "state") '
+                       'VALUES (?, ?, ?)', (event_id, to_epoch_us(datetime.now(tz=pytz.utc)),
+                                            json.dumps(states.to_rows())))
+        db.execute_sql('DELETE FROM "hat_snapshot" WHERE "id" NOT IN (SELECT "id" FROM '
+                       '"hat_snapshot" ORDER BY "event_id" DESC LIMIT ?)', (keep,))
+    return event_id
+
+
+#
+# Dumps: a snapshot line, then one line per event, as JSON
+#
+
+def dump(db, out, since=None, until=None, hat=None):
+    """
+        Writes the journal from `since` (an event id; by default the latest snapshot)
+        to `until` to the file out, starting with the snapshot it builds on. Returns
+        the number of events written.
+    """
+    event_id, rows = latest_snapshot(db, since)
+    if rows is None:
+        raise ValueError('The journal has no snapshots')
+    if hat is not None:
+        rows = dict((name, [row for row in entries if row[1] == hat])
+                    for name, entries in rows.items())
+    out.write(json.dumps({'snapshot': rows, 'event_id': event_id}) + '\n')
+    count = 0
+    for event in events_after(db, event_id, until, hat):
+        out.write(json.dumps(event._asdict()) + '\n')
+        count += 1
+    return count
+
+
+def read_dump(lines):
+    """
+        Reads a dump. Returns (event id of the snapshot, its rows, iterator of events).
+    """
+    lines = iter(lines)
+    header = json.loads(next(lines))
+    return header['event_id'], header['snapshot'], (
+        _event(json.loads(line)) for line in lines if line.strip())
+
+
+def _event(fields):
+    # Dumps from before command keys were journalled don't have them
+    return Event(**dict(dict.fromkeys(Event._fields), **fields))
@@ -0,0 +1,317 @@
+"""
+    In-process metrics: fixed-bucket histograms and counters, rendered in the
+    Prometheus text format. Recording a value takes a bucket search and a lock and
+    allocates nothing, so it is cheap enough for every query and API call. A metric's
+    per-label child is only created the first time that label is seen.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast in-memory query up to a slow Slack call
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# What queries are attributed to when they don't run inside a command
+BACKGROUND = 'background'
+
+_context = threading.local()
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, fraction):
+        """
+            The upper bound of the bucket holding the given quantile, or None if nothing
+            has been observed (or it is above every bucket)
+        """
+        counts, _, count = self.snapshot()
+        if not count:
+            return None
+        target = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return None
+
+
+class Counter(object):
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Metric(object):
+    """
+        A named metric with one child Histogram or Counter per label value
+    """
+
+    def __init__(self, name, documentation, kind, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.label = label
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, value=None):
+        child = self._children.get(value)
+        if child is None:
+            with self._lock:
+                child = self._children.get(value)
+                if child is None:
+                    child = Histogram(self.buckets) if self.kind == 'histogram' else Counter()
+                    self._children[value] = child
+        return child
+
+    def children(self):
+        with self._lock:
+            return sorted(self._children.items(), key=lambda item: str(item[0]))
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        # (name, documentation, kind, function) sampled when metrics are rendered
+        self._callbacks = []
+
+    def histogram(self, name, documentation, label=None, buckets=LATENCY_BUCKETS):
+        metric = Metric(name, documentation, 'histogram', label, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label=None):
+        metric = Metric(name, documentation, 'counter', label)
+        self._metrics.append(metric)
+        return metric
+
+    def callback(self, name, documentation, kind, function):
+        """
+            Reports function()'s value as a gauge or counter whenever metrics are rendered
+        """
+        self._callbacks = [entry for entry in self._callbacks if entry[0] != name]
+        self._callbacks.append((name, documentation, kind, function))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for value, child in metric.children():
+                labels = [] if metric.label is None else [(metric.label, value)]
+                if metric.kind == 'counter':
+                    lines.append('{}_total{} {}'.format(metric.name, _labels(labels), child.value))
+                    continue
+                counts, total, count = child.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(
+                        metric.name, _labels(labels + [('le', le)]), cumulative))
+                lines.append('{}_sum{} {!r}'.format(metric.name, _labels(labels), total))
+                lines.append('{}_count{} {}'.format(metric.name, _labels(labels), count))
+        for name, documentation, kind, function in self._callbacks:
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{}{} {}'.format(name, '_total' if kind == 'counter' else '', function()))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = REGISTRY.histogram(
+    'hatman_command_seconds', 'Time spent handling a command, excluding posting the reply',
+    'command')
+QUERY_SECONDS = REGISTRY.histogram(
+    'hatman_db_query_seconds', 'Time spent in each database query, by the command that ran it',
+    'command')
+SLACK_API_SECONDS = REGISTRY.histogram(
+    'hatman_slack_api_seconds', 'Time spent in each Slack API call, by method', 'method')
+REPLY_SECONDS = REGISTRY.histogram(
+    'hatman_reply_seconds', 'Time from a Slack event to chat.postMessage returning for its reply')
+COMMAND_WAIT_SECONDS = REGISTRY.histogram(
+    'hatman_command_wait_seconds', 'Time commands spent queued before running, by priority class',
+    'priority')
+COMMANDS_SHED = REGISTRY.counter(
+    'hatman_commands_shed', 'Fun commands turned away under load, by what was backed up',
+    'backlog')
+COMMAND_ERRORS = REGISTRY.counter(
+    'hatman_command_errors', 'Commands that raised an exception', 'command')
+
+
+#
+# Attribution
+#
+
+def set_command(name):
+    """
+        Marks the current thread as running the named command until clear_command()
+    """
+    _context.command = name
+
+
+def clear_command():
+    _context.command = BACKGROUND
+
+
+def current_command():
+    return getattr(_context, 'command', BACKGROUND)
+
+
+#
+# Instrumentation
+#
+
+def instrument_database(db):
+    """
+        Times every statement the database runs, attributed to the current command
+    """
+    execute_sql = db.execute_sql
+
+    def timed_execute_sql(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return execute_sql(*args, **kwargs)
+        finally:
+            QUERY_SECONDS.labels(current_command()).observe(time.perf_counter() - started)
+
+    db.execute_sql = timed_execute_sql
+    return db
+
+
+def instrument_slack_client(slack_client):
+    """
+        Times every api_call the client makes, by method
+    """
+    api_call = slack_client.api_call
+
+    def timed_api_call(method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return api_call(method, *args, **kwargs)
+        finally:
+            SLACK_API_SECONDS.labels(method).observe(time.perf_counter() - started)
+
+    slack_client.api_call = timed_api_call
+    return slack_client
+
+
+#
+# Reporting
+#
+
+def _milliseconds(seconds):
+    return '>{:g}s'.format(LATENCY_BUCKETS[-1]) if seconds is None \
+        else '{:g}ms'.format(seconds * 1000)
+
+
+def summary(limit=10):
+    """
+        A short text summary of the busiest commands and Slack API methods
+    """
+    queries = dict(QUERY_SECONDS.children())
+    commands = sorted(COMMAND_SECONDS.children(), key=lambda item: -item[1].count)[:limit]
+    lines = ['*Commands* (count, p50, p99, queries per command)']
+    for name, histogram in commands:
+        query_count = queries[name].count if name in queries else 0
+        lines.append('{}: {}, {}, {}, {:.1f}'.format(
+            name, histogram.count, _milliseconds(histogram.quantile(0.5)),
+            _milliseconds(histogram.quantile(0.99)), query_count / float(histogram.count)))
+    lines.append('*Slack API* (count, p50, p99)')
+    for method, histogram in sorted(SLACK_API_SECONDS.children(), key=lambda item: -item[1].count):
+        lines.append('{}: {}, {}, {}'.format(method, histogram.count,
+                                              _milliseconds(histogram.quantile(0.5)),
+                                              _milliseconds(histogram.quantile(0.99))))
+    waits = [(name, histogram) for name, histogram in COMMAND_WAIT_SECONDS.children()
+             if histogram.count]
+    if waits:
+        lines.append('*Queue wait* (count, p50, p99)')
+        for name, histogram in waits:
+            lines.append('{}: {}, {}, {}'.format(name, histogram.count,
+                                                  _milliseconds(histogram.quantile(0.5)),
+                                                  _milliseconds(histogram.quantile(0.99))))
+    if REPLY_SECONDS.labels().count:
+        lines.append('*Event to reply* p50 {}, p99 {}'.format(
+            _milliseconds(REPLY_SECONDS.labels().quantile(0.5)),
+            _milliseconds(REPLY_SECONDS.labels().quantile(0.99))))
+    return '\n'.join(lines)
+
+
+def serve(port, host='127.0.0.1'):
+    """
+        Serves the metrics at http://host:port/metrics from a background thread and
+        returns the server
+    """
+    # Imported here so that only a bot that serves metrics pays for http.server
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        registry = REGISTRY
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on http://%s:%d/metrics', host, server.server_port)
+    return server
@@ -0,0 +1,327 @@
+"""
+    Versioned schema migrations. Each migration runs once, in order, inside its own
+    transaction, and the versions that have been applied are recorded in the
+    schema_version table. Migrations use raw SQL rather than the models so that they
+    keep working as the models change underneath them.
+
+    To change the schema, add a new function decorated with @migration using the next
+    version number. Never edit a migration that has already shipped.
+"""
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+import pytz
+from peewee import OperationalError
+
+from bot.models import (CommandReceipt, HatEvent, HatLog, HatQueue, HatPool, HatSnapshot,
+                        SlackUserInfo, SchemaVersion, StatRollup, to_epoch_us)
+from bot.state import legacy_hat
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return function
+    return register
+
+
+def _execute_all(db, statements):
+    for statement in statements:
+        db.execute_sql(statement)
+
+
+@migration(1, 'Create the original tables')
+def create_tables(db):
+    _execute_all(db, [
+        'CREATE TABLE IF NOT EXISTS "hatlog" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" VARCHAR(255) NOT NULL, "start_time" DATETIME NOT NULL, "end_time" DATETIME)',
+        'CREATE TABLE IF NOT EXISTS "hatqueue" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" VARCHAR(255) NOT NULL, "start_time" DATETIME NOT NULL, "end_time" DATETIME)',
+        'CREATE TABLE IF NOT EXISTS "hatpool" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"owner_user_id" VARCHAR(255) NOT NULL, "user_id" VARCHAR(255) NOT NULL, '
+        '"end_time" DATETIME)',
+        'CREATE TABLE IF NOT EXISTS "slackuserinfo" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" VARCHAR(255) NOT NULL, "name" VARCHAR(255) NOT NULL, "tip" INTEGER NOT NULL)',
+    ])
+
+
+@migration(2, 'Copy SlackUserInfo out of the peewee.db fallback database')
+def import_legacy_user_info(db):
+    # SlackUserInfo used to have no Meta.database, so peewee kept it in ./peewee.db
+    path = os.path.abspath('peewee.db')
+    if not os.path.exists(path) or path == os.path.abspath(db.database):
+        return
+    legacy = sqlite3.connect(path)
+    try:
+        rows = legacy.execute('SELECT user_id, name, tip FROM slackuserinfo').fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        legacy.close()
+    for row in rows:
+        db.execute_sql('INSERT INTO slackuserinfo (user_id, name, tip) VALUES (?, ?, ?)', row)
+    logger.info('Copied %d users from %s', len(rows), path)
+
+
+@migration(3, 'Index the hot hat queries')
+def add_hot_query_indexes(db):
+    # peewee binds IS NULL as "IS ?", which SQLite can't match against a partial index's
+    # WHERE clause, so end_time is an index column instead. IS ? is an equality lookup.
+    _execute_all(db, [
+        # Open rows, which is what HatState loads
+        'CREATE INDEX IF NOT EXISTS "hatlog_end_start" ON "hatlog" ("end_time", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatqueue_end_start" ON "hatqueue" ("end_time", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatqueue_user_end" ON "hatqueue" ("user_id", "end_time")',
+        'CREATE INDEX IF NOT EXISTS "hatpool_owner_end" ON "hatpool" ("owner_user_id", "end_time")',
+        'CREATE INDEX IF NOT EXISTS "hatpool_user_end" ON "hatpool" ("user_id", "end_time")',
+        # History lookups for stats and info
+        'CREATE INDEX IF NOT EXISTS "hatqueue_start" ON "hatqueue" ("start_time")',
+        'CREATE INDEX IF NOT EXISTS "slackuserinfo_user" ON "slackuserinfo" ("user_id")',
+    ])
+
+
+@migration(4, 'Key hat rows by hat so one bot can serve several hats')
+def add_hat_column(db):
+    # Everything so far belongs to the hat in CHANNEL_ID
+    default = legacy_hat().replace("'", "''")
+    _execute_all(db, [
+        'ALTER TABLE "hatlog" ADD COLUMN "hat" VARCHAR(255) NOT NULL DEFAULT \'{}\''.format(default),
+        'ALTER TABLE "hatqueue" ADD COLUMN "hat" VARCHAR(255) NOT NULL DEFAULT \'{}\''.format(default),
+        'ALTER TABLE "hatpool" ADD COLUMN "hat" VARCHAR(255) NOT NULL DEFAULT \'{}\''.format(default),
+        # The (end_time, ...) indexes stay for loading every hat's open rows at once
+        'DROP INDEX IF EXISTS "hatpool_owner_end"',
+        'DROP INDEX IF EXISTS "hatqueue_start"',
+        'CREATE INDEX IF NOT EXISTS "hatpool_end" ON "hatpool" ("end_time")',
+        'CREATE INDEX IF NOT EXISTS "hatlog_hat_end_start" ON "hatlog" '
+        '("hat", "end_time", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatqueue_hat_end_start" ON "hatqueue" '
+        '("hat", "end_time", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatqueue_hat_start" ON "hatqueue" ("hat", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatpool_hat_owner_end" ON "hatpool" '
+        '("hat", "owner_user_id", "end_time")',
+    ])
+
+
+@migration(5, 'Store timestamps as integer epoch microseconds')
+def convert_timestamps_to_epoch(db):
+    # Columns keep their DATETIME declaration; SQLite stores the integers as integers.
+    from dateutil.parser import parse
+
+    for table, columns in [('hatlog', ['start_time', 'end_time']),
+                           ('hatqueue', ['start_time', 'end_time']),
+                           ('hatpool', ['end_time'])]:
+        for column in columns:
+            cursor = db.execute_sql(
+                'SELECT "id", "{0}" FROM "{1}" WHERE typeof("{0}") = \'text\''.format(
+                    column, table))
+            updates = [(to_epoch_us(parse(value)), row_id)
+                       for row_id, value in cursor.fetchall()]
+            for update in updates:
+                db.execute_sql('UPDATE "{}" SET "{}" = ? WHERE "id" = ?'.format(table, column),
+                               update)
+            if updates:
+                logger.info('Converted %d %s.%s values', len(updates), table, column)
+
+
+@migration(6, 'Add the stats rollup table and backfill it')
+def add_stat_rollups(db):
+    from bot.rollups import rebuild
+
+    _execute_all(db, [
+        'CREATE TABLE IF NOT EXISTS "stat_rollup" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"metric" VARCHAR(255) NOT NULL, "bucket" VARCHAR(255) NOT NULL, '
+        '"value" INTEGER NOT NULL)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "stat_rollup_metric_bucket" ON "stat_rollup" '
+        '("metric", "bucket")',
+    ])
+    logger.info('Backfilled %d stats rollups', rebuild(db, 'hatqueue', 'hatpool'))
+
+
+@migration(7, 'Index the report window scans')
+def add_report_indexes(db):
+    _execute_all(db, [
+        'CREATE INDEX IF NOT EXISTS "hatlog_hat_start" ON "hatlog" ("hat", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatpool_hat_end" ON "hatpool" ("hat", "end_time")',
+    ])
+
+
+@migration(8, 'Add archive tables for closed history and views across both')
+def add_history_archive(db):
+    # Archived rows keep their ids, so an id is unique across a table and its archive
+    _execute_all(db, [
+        'CREATE TABLE IF NOT EXISTS "hatlog_archive" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"hat" VARCHAR(255) NOT NULL, "user_id" VARCHAR(255) NOT NULL, '
+        '"start_time" INTEGER NOT NULL, "end_time" INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS "hatqueue_archive" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"hat" VARCHAR(255) NOT NULL, "user_id" VARCHAR(255) NOT NULL, '
+        '"start_time" INTEGER NOT NULL, "end_time" INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS "hatpool_archive" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"hat" VARCHAR(255) NOT NULL, "owner_user_id" VARCHAR(255) NOT NULL, '
+        '"user_id" VARCHAR(255) NOT NULL, "end_time" INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS "hatlog_archive_hat_start" ON "hatlog_archive" '
+        '("hat", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatqueue_archive_hat_start" ON "hatqueue_archive" '
+        '("hat", "start_time")',
+        'CREATE INDEX IF NOT EXISTS "hatqueue_archive_user" ON "hatqueue_archive" ("user_id")',
+        'CREATE INDEX IF NOT EXISTS "hatpool_archive_hat_end" ON "hatpool_archive" '
+        '("hat", "end_time")',
+        'CREATE INDEX IF NOT EXISTS "hatpool_archive_user" ON "hatpool_archive" ("user_id")',
+        'CREATE VIEW IF NOT EXISTS "hatlog_history" AS '
+        'SELECT "id", "hat", "user_id", "start_time", "end_time" FROM "hatlog" UNION ALL '
+        'SELECT "id", "hat", "user_id", "start_time", "end_time" FROM "hatlog_archive"',
+        'CREATE VIEW IF NOT EXISTS "hatqueue_history" AS '
+        'SELECT "id", "hat", "user_id", "start_time", "end_time" FROM "hatqueue" UNION ALL '
+        'SELECT "id", "hat", "user_id", "start_time", "end_time" FROM "hatqueue_archive"',
+        'CREATE VIEW IF NOT EXISTS "hatpool_history" AS '
+        'SELECT "id", "hat", "owner_user_id", "user_id", "end_time" FROM "hatpool" UNION ALL '
+        'SELECT "id", "hat", "owner_user_id", "user_id", "end_time" FROM "hatpool_archive"',
+    ])
+
+
+@migration(9, 'Add the hat event journal and its snapshots')
+def add_hat_journal(db):
+    _execute_all(db, [
+        'CREATE TABLE IF NOT EXISTS "hat_event" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"hat" VARCHAR(255) NOT NULL, "kind" VARCHAR(255) NOT NULL, '
+        '"user_id" VARCHAR(255) NOT NULL, "other_user_id" VARCHAR(255), "entry_id" INTEGER, '
+        '"time" INTEGER NOT NULL, "cause" VARCHAR(255))',
+        'CREATE INDEX IF NOT EXISTS "hat_event_hat" ON "hat_event" ("hat", "id")',
+        'CREATE TABLE IF NOT EXISTS "hat_snapshot" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"event_id" INTEGER NOT NULL, "taken_time" INTEGER NOT NULL, "state" TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS "hat_snapshot_event" ON "hat_snapshot" ("event_id")',
+    ])
+    # The journal starts from a snapshot of the state now, in HatStates.to_rows() form
+    state = {
+        'owners': [list(row) for row in db.execute_sql(
+            'SELECT "id", "hat", "user_id", "start_time" FROM "hatlog" '
+            'WHERE "end_time" IS NULL ORDER BY "start_time" DESC')],
+        'queued': [list(row) for row in db.execute_sql(
+            'SELECT "id", "hat", "user_id", "start_time" FROM "hatqueue" '
+            'WHERE "end_time" IS NULL ORDER BY "start_time"')],
+        'pooled': [list(row) for row in db.execute_sql(
+            'SELECT "id", "hat", "owner_user_id", "user_id" FROM "hatpool" '
+            'WHERE "end_time" IS NULL ORDER BY "id"')],
+    }
+    db.execute_sql('INSERT INTO "hat_snapshot" ("event_id", "taken_time", "state") '
+                   'VALUES (0, ?, ?)', (to_epoch_us(datetime.now(tz=pytz.utc)),
+                                        json.dumps(state)))
+
+
+@migration(10, 'Add command receipts and the command behind each hat event')
+def add_command_receipts(db):
+    _execute_all(db, [
+        'CREATE TABLE IF NOT EXISTS "command_receipt" ("key" VARCHAR(255) NOT NULL PRIMARY KEY, '
+        '"time" INTEGER NOT NULL, "response" TEXT)',
+        'CREATE INDEX IF NOT EXISTS "command_receipt_time" ON "command_receipt" ("time")',
+        'ALTER TABLE "hat_event" ADD COLUMN "command_key" VARCHAR(255)',
+    ])
+
+
+@migration(11, 'Add the leader lease and replica heartbeats')
+def add_leader_lease(db):
+    _execute_all(db, [
+        'CREATE TABLE IF NOT EXISTS "leader_lease" ("name" VARCHAR(255) NOT NULL PRIMARY KEY, '
+        '"holder" VARCHAR(255), "term" INTEGER NOT NULL, "acquired_time" INTEGER NOT NULL, '
+        '"expires_time" INTEGER NOT NULL)',
+        'INSERT OR IGNORE INTO "leader_lease" ("name", "term", "acquired_time", "expires_time") '
+        'VALUES (\'leader\', 0, 0, 0)',
+        'CREATE TABLE IF NOT EXISTS "replica" ("name" VARCHAR(255) NOT NULL PRIMARY KEY, '
+        '"role" VARCHAR(255) NOT NULL, "heartbeat_time" INTEGER NOT NULL, "event_id" INTEGER)',
+    ])
+
+
+def current_version(db):
+    try:
+        row = db.execute_sql('SELECT MAX("version") FROM "schema_version"').fetchone()
+    except OperationalError:
+        return 0
+    return row[0] or 0
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def migrate(db):
+    """
+        Applies every migration newer than the database's schema version and returns
+        the resulting version.
+    """
+    version = current_version(db)
+    if version == 0:
+        SchemaVersion.create_table(True)
+    for number, description, function in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info('Applying migration %d: %s', number, description)
+        with db.atomic():
+            function(db)
+            SchemaVersion.create(version=number, applied_time=datetime.now(tz=pytz.utc))
+        version = number
+    return version
+
+
+def hot_queries():
+    """
+        The queries that run on (or right behind) command hot paths, by name
+    """
+    return [
+        ('hat owners', HatLog.select().where(HatLog.end_time.is_null(True))
+         .order_by(HatLog.start_time.desc())),
+        ('hat owner', HatLog.select().where(HatLog.hat == '', HatLog.end_time.is_null(True))
+         .order_by(HatLog.start_time.desc())),
+        ('hat queues', HatQueue.select().where(HatQueue.end_time.is_null(True))
+         .order_by(HatQueue.start_time)),
+        ('hat queue', HatQueue.select().where(HatQueue.hat == '',
+                                              HatQueue.end_time.is_null(True))
+         .order_by(HatQueue.start_time)),
+        ('hat pools', HatPool.select().where(HatPool.end_time.is_null(True))
+         .order_by(HatPool.id)),
+        ('pooled users', HatPool.select().where(HatPool.hat == '',
+                                                HatPool.owner_user_id == '',
+                                                HatPool.end_time.is_null(True))),
+        ('stats rollup', StatRollup.select(StatRollup.value).where(StatRollup.metric == '',
+                                                                    StatRollup.bucket == '')),
+        ('user info', SlackUserInfo.select().where(SlackUserInfo.user_id == '')),
+        # Rebuilding hat state from the journal
+        ('latest snapshot', HatSnapshot.select().where(HatSnapshot.event_id <= 0)
+         .order_by(HatSnapshot.event_id.desc()).limit(1)),
+        ('journal tail', HatEvent.select().where(HatEvent.id > 0).order_by(HatEvent.id)
+         .limit(1)),
+        ('command receipt', CommandReceipt.select().where(CommandReceipt.key == '')),
+        ('expired receipts', CommandReceipt.select(CommandReceipt.key)
+         .where(CommandReceipt.time < 0).limit(1)),
+        # What the archiver looks for
+        ('closed hat log', HatLog.select(HatLog.id).where(HatLog.end_time < 0)
+         .order_by(HatLog.end_time).limit(1)),
+        ('closed hat queue', HatQueue.select(HatQueue.id).where(HatQueue.end_time < 0)
+         .order_by(HatQueue.end_time).limit(1)),
+        ('closed hat pool', HatPool.select(HatPool.id).where(HatPool.end_time < 0)
+         .order_by(HatPool.end_time).limit(1)),
+    ]
+
+
+def explain(db, query):
+    sql, params = query.sql()
+    return [row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+
+def check_query_plans(db, queries=None):
+    """
+        Runs EXPLAIN QUERY PLAN over the hot queries and returns (name, plan, uses_index)
+        for each. A query that scans a table without an index doesn't use one.
+    """
+    results = []
+    for name, query in (queries if queries is not None else hot_queries()):
+        plan = explain(db, query)
+        uses_index = not any(step.startswith('SCAN') and 'INDEX' not in step for step in plan)
+        results.append((name, plan, uses_index))
+    return results
@@ -1,28 +1,66 @@
+from datetime import datetime, timedelta
+
+import pytz
 from peewee import *
 from bot import settings
 
 db = settings.database
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def to_epoch_us(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_epoch_us(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+class EpochMicrosecondField(BigIntegerField):
+    """
+        Stores datetimes as integer microseconds since the epoch and returns them as
+        UTC datetimes, so nothing is parsed on the way out and range queries compare
+        integers. Naive datetimes are taken to be UTC.
+    """
+
+    def db_value(self, value):
+        if value is None or isinstance(value, int):
+            return value
+        return to_epoch_us(value)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return from_epoch_us(value)
+
+
 class HatLog(Model):
+    hat = CharField(null = False)
     user_id = CharField(null = False)
-    start_time = DateTimeField(null = False)
-    end_time = DateTimeField(null = True)
+    start_time = EpochMicrosecondField(null = False)
+    end_time = EpochMicrosecondField(null = True)
 
     class Meta:
         database = db
 
 class HatQueue(Model):
+    hat = CharField(null = False)
     user_id = CharField(null = False)
-    start_time = DateTimeField(null = False)
-    end_time = DateTimeField(null = True)
+    start_time = EpochMicrosecondField(null = False)
+    end_time = EpochMicrosecondField(null = True)
 
     class Meta:
         database = db
 
 class HatPool(Model):
+    hat = CharField(null = False)
     owner_user_id = CharField(null = False)
     user_id = CharField(null = False)
-    end_time = DateTimeField(null = True)
+    end_time = EpochMicrosecondField(null = True)
 
     class Meta:
         database = db
@@ -32,3 +70,67 @@ class SlackUserInfo(Model):
     name = CharField(null = False)
     tip = IntegerField(default = 0)
 
+    class Meta:
+        database = db
+
+class StatRollup(Model):
+    metric = CharField(null = False)
+    bucket = CharField(null = False)
+    value = IntegerField(default = 0)
+
+    class Meta:
+        database = db
+        db_table = 'stat_rollup'
+
+class HatEvent(Model):
+    """
+        One change to a hat, in the order they were made. See bot.state for the kinds.
+    """
+    hat = CharField(null = False)
+    kind = CharField(null = False)
+    user_id = CharField(null = False)
+    other_user_id = CharField(null = True)
+    entry_id = IntegerField(null = True)
+    time = EpochMicrosecondField(null = False)
+    # The command (or background job) that made the change
+    cause = CharField(null = True)
+    # The receipt key of the message that made the change, if a message did
+    command_key = CharField(null = True)
+
+    class Meta:
+        database = db
+        db_table = 'hat_event'
+
+class HatSnapshot(Model):
+    """
+        Every hat's open entries as of the event with id event_id, as JSON
+    """
+    event_id = IntegerField(null = False)
+    taken_time = EpochMicrosecondField(null = False)
+    state = TextField(null = False)
+
+    class Meta:
+        database = db
+        db_table = 'hat_snapshot'
+
+class CommandReceipt(Model):
+    """
+        A message whose command has been carried out, keyed on where and when it was
+        sent, with the reply it got
+    """
+    key = CharField(primary_key = True)
+    time = EpochMicrosecondField(null = False)
+    response = TextField(null = True)
+
+    class Meta:
+        database = db
+        db_table = 'command_receipt'
+
+class SchemaVersion(Model):
+    version = IntegerField(null = False)
+    applied_time = DateTimeField(null = False)
+
+    class Meta:
+        database = db
+        db_table = 'schema_version'
+
@@ -0,0 +1,328 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+from queue import Queue, Empty, Full
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bot.engine import QUERY
+from bot.metrics import REPLY_SECONDS, SLACK_API_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SLACK_API_URL = 'https://slack.com/api/'
+
+
+class SlackWebSender(object):
+    """
+        Calls the Slack Web API over a single pooled, keep-alive HTTP session. post()
+        returns (result, retry_after) where retry_after is the number of seconds Slack
+        asked us to wait, or None if we weren't rate limited.
+    """
+
+    def __init__(self, token, timeout=10, pool_size=4):
+        self.token = token
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer {}'.format(token)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def post(self, method, **params):
+        data = dict((key, value if isinstance(value, str) else json.dumps(value))
+                    for key, value in params.items())
+        started = time.perf_counter()
+        try:
+            response = self.session.post(SLACK_API_URL + method, data=data, timeout=self.timeout)
+        finally:
+            SLACK_API_SECONDS.labels(method).observe(time.perf_counter() - started)
+        if response.status_code == 429:
+            return {'ok': False, 'error': 'ratelimited'}, \
+                float(response.headers.get('Retry-After', 1))
+        response.raise_for_status()
+        return response.json(), None
+
+
+class ApiCallSender(object):
+    """
+        Sends through a SlackClient's api_call. It can't see response headers, so a
+        ratelimited error waits `retry_after` seconds.
+    """
+
+    def __init__(self, slack_client, retry_after=1.0):
+        self.slack_client = slack_client
+        self.retry_after = retry_after
+
+    def post(self, method, **params):
+        result = self.slack_client.api_call(method, **params)
+        if result.get('error') == 'ratelimited':
+            return result, self.retry_after
+        return result, None
+
+
+class TokenBucket(object):
+    """
+        Allows `rate` messages a second with bursts of up to `capacity`. reserve() always
+        takes a token, going into debt if it has to, and returns the time at which the
+        caller may use it, so callers are served in the order they reserved.
+    """
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = now if now is not None else time.time()
+
+    def reserve(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return now
+        return now + -self._tokens / self.rate
+
+
+class OutboundMessage(object):
+    __slots__ = ('channel', 'params', 'queued_at', 'event_time', 'attempts', 'priority',
+                 'sequence')
+
+    def __init__(self, channel, params, event_time=None, priority=QUERY, sequence=0):
+        self.channel = channel
+        self.params = params
+        self.queued_at = time.time()
+        # When the Slack event this replies to happened
+        self.event_time = event_time
+        self.attempts = 0
+        # The engine priority class of the command it answers; lower goes first
+        self.priority = priority
+        self.sequence = sequence
+
+
+class OutboundDispatcher(object):
+    """
+        Posts replies from a background thread so command handling never waits on the
+        network. Messages go through a bounded queue, are paced by a token bucket per
+        channel and are retried with exponential backoff, honouring Retry-After in the
+        channel Slack rate limits us in. When a channel has a backlog, each time its
+        bucket allows a message the most urgent one waiting goes, so a hat handoff isn't
+        stuck behind a pile of gifs. On stop, what is still waiting is posted as the buckets allow for
+        up to drain_timeout seconds; anything left after that is logged and dropped.
+    """
+    STOP = object()
+
+    def __init__(self, sender, max_queue=1000, enqueue_timeout=5, rate=1.0, burst=4,
+                 max_retries=5, backoff=0.5, drain_timeout=10):
+        self.sender = sender
+        self.drain_timeout = drain_timeout
+        self.enqueue_timeout = enqueue_timeout
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = Queue(maxsize=max_queue)
+        # channel -> heap of (priority, sequence, message) waiting to be posted there
+        self._waiting = {}
+        # How many messages the heaps hold. Only the sender thread changes it, so other
+        # threads can read it without walking heaps that are being changed.
+        self._waiting_count = 0
+        # (send_at, sequence, channel) for each channel with messages waiting, when its
+        # bucket (or a retry) lets it post the next one
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._buckets = {}
+        # channel -> when Slack said we could post there again
+        self._paused_until = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=1000)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='outbound')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._queue.put(self.STOP)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def send(self, channel, text, event_time=None, priority=QUERY, **params):
+        """
+            Queues a chat.postMessage. Returns False if the queue stayed full. If it is
+            a reply, event_time is when the event it replies to happened and priority
+            the class of the command it answers.
+        """
+        params.update(channel=channel, text=text)
+        try:
+            self._queue.put(OutboundMessage(channel, params, event_time, priority,
+                                            next(self._sequence)),
+                            timeout=self.enqueue_timeout)
+            return True
+        except Full:
+            self.dropped += 1
+            logger.error('Outbound queue is full, dropping message to %s', channel)
+            return False
+
+    def queue_depth(self):
+        return self._queue.qsize() + self._waiting_count
+
+    def waiting(self, channel):
+        """
+            Messages waiting for their turn in the channel (not counting any still on
+            their way in)
+        """
+        return len(self._waiting.get(channel, ()))
+
+    def register_metrics(self, registry):
+        registry.callback('hatman_outbound_queue_depth', 'Replies waiting to be posted',
+                          'gauge', self.queue_depth)
+        for name in ('sent', 'failed', 'retried', 'dropped'):
+            registry.callback('hatman_outbound_{}'.format(name), 'Replies {}'.format(name),
+                              'counter', lambda name=name: getattr(self, name))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+        return {
+            'queue_depth': self.queue_depth(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'latency_p50': percentile(0.5),
+            'latency_p90': percentile(0.9),
+            'latency_p99': percentile(0.99),
+        }
+
+    def _schedule(self, channel):
+        """
+            Takes a token from the channel's bucket for its next message
+        """
+        now = time.time()
+        bucket = self._buckets.get(channel)
+        if bucket is None:
+            bucket = self._buckets[channel] = TokenBucket(self.rate, self.burst, now)
+        send_at = max(bucket.reserve(now), self._paused_until.get(channel, 0))
+        heapq.heappush(self._delayed, (send_at, next(self._sequence), channel))
+
+    def _add(self, message):
+        waiting = self._waiting.setdefault(message.channel, [])
+        self._waiting_count += 1
+        heapq.heappush(waiting, (message.priority, message.sequence, message))
+        if len(waiting) == 1:
+            self._schedule(message.channel)
+
+    def _run(self):
+        # Once stopping, when to give up on what is still waiting
+        drain_until = None
+        while True:
+            now = time.time()
+            if self._delayed and self._delayed[0][0] <= now:
+                _, _, channel = heapq.heappop(self._delayed)
+                waiting = self._waiting[channel]
+                _, _, message = heapq.heappop(waiting)
+                self._waiting_count -= 1
+                try:
+                    self._deliver(message)
+                except Exception:
+                    # Never let one bad message take the thread down with it
+                    self.failed += 1
+                    logger.exception('Failed to post message to %s', channel)
+                if waiting:
+                    self._schedule(channel)
+                else:
+                    del self._waiting[channel]
+                continue
+
+            if drain_until is not None:
+                if not self._delayed or now >= drain_until:
+                    break
+                time.sleep(min(self._delayed[0][0], drain_until) - now)
+                continue
+
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            try:
+                message = self._queue.get(timeout=timeout)
+            except Empty:
+                continue
+            if message is self.STOP:
+                drain_until = now + self.drain_timeout
+                continue
+            self._add(message)
+        self._drop_waiting()
+
+    def _drop_waiting(self):
+        """
+            Logs and drops the messages that couldn't be posted before stopping
+        """
+        left = [message for waiting in self._waiting.values() for _, _, message in waiting]
+        while True:
+            try:
+                message = self._queue.get_nowait()
+            except Empty:
+                break
+            if message is not self.STOP:
+                left.append(message)
+        for message in sorted(left, key=lambda message: message.sequence):
+            self.dropped += 1
+            logger.error('Stopped before posting message to %s: %s', message.channel,
+                         message.params.get('text'))
+        self._waiting = {}
+        self._waiting_count = 0
+        self._delayed = []
+
+    def _retry_later(self, message):
+        waiting = self._waiting.setdefault(message.channel, [])
+        self._waiting_count += 1
+        heapq.heappush(waiting, (message.priority, message.sequence, message))
+
+    def _deliver(self, message):
+        now = time.time()
+        if now < self._paused_until.get(message.channel, 0):
+            self._retry_later(message)
+            return
+
+        message.attempts += 1
+        retry_after = None
+        try:
+            result, retry_after = self.sender.post('chat.postMessage', **message.params)
+            if retry_after is None and not result.get('ok'):
+                # Slack rejected the message itself, retrying won't help
+                self.failed += 1
+                logger.error('chat.postMessage to %s failed: %s', message.channel,
+                             result.get('error'))
+                return
+        except requests.RequestException as error:
+            logger.warning('chat.postMessage to %s failed: %s', message.channel, error)
+            retry_after = self.backoff * 2 ** (message.attempts - 1)
+
+        if retry_after is None:
+            self.sent += 1
+            now = time.time()
+            self.latencies.append(now - message.queued_at)
+            if message.event_time is not None:
+                REPLY_SECONDS.labels().observe(now - message.event_time)
+        elif message.attempts > self.max_retries:
+            self.failed += 1
+            logger.error('Giving up on message to %s after %d attempts', message.channel,
+                         message.attempts)
+        else:
+            self.retried += 1
+            # Slack rate limits each channel on its own, so only this one waits
+            self._paused_until[message.channel] = max(
+                self._paused_until.get(message.channel, 0), time.time() + retry_after)
+            self._retry_later(message)
@@ -0,0 +1,92 @@
+"""
+    Command receipts make mutating commands idempotent. A message Slack delivers twice
+    (after a reconnect, or a retry by an at-least-once transport) has the same channel
+    and timestamp both times, so that is the key. Its receipt is written in the
+    command's own transaction: either the command and its receipt both commit or
+    neither does, and a second delivery gets the first one's reply back without running
+    the command again.
+
+    The key of the command running on a thread is also stored on each hat_event it
+    makes, so the journal shows which message every change came from.
+"""
+import json
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytz
+
+from bot.models import to_epoch_us
+
+_context = threading.local()
+
+LOOKUP = 'SELECT "response" FROM "command_receipt" WHERE "key" = ?'
+RECORD = 'INSERT INTO "command_receipt" ("key", "time", "response") VALUES (?, ?, ?)'
+
+
+def message_key(channel, ts):
+    """
+        The receipt key of the message sent to channel at ts, or None without a ts
+    """
+    if ts is None:
+        return None
+    return '{}:{}'.format(channel, ts)
+
+
+def current_key():
+    return getattr(_context, 'key', None)
+
+
+@contextmanager
+def carrying_out(key):
+    """
+        Makes key the current_key() on this thread while the command with it runs
+    """
+    _context.key = key
+    try:
+        yield
+    finally:
+        _context.key = None
+
+
+def lookup(db, key):
+    """
+        Returns (True, the reply) if the command with this key has been carried out,
+        or (False, None) if it hasn't
+    """
+    row = db.execute_sql(LOOKUP, (key,)).fetchone()
+    if row is None:
+        return False, None
+    return True, json.loads(row[0])
+
+
+def run_once(db, key, function, *args):
+    """
+        Calls function(*args) and records its reply under key, unless a command with
+        this key has already been carried out, in which case that reply is returned.
+        Call it inside the transaction the function's changes are made in.
+    """
+    done, response = lookup(db, key)
+    if done:
+        return response
+    with carrying_out(key):
+        response = function(*args)
+    db.execute_sql(RECORD, (key, to_epoch_us(datetime.now(tz=pytz.utc)), json.dumps(response)))
+    return response
+
+
+def prune(db, older_than, batch_size=1000):
+    """
+        Deletes receipts from before older_than (a datetime), a batch at a time so the
+        write lock is never held for long. Returns how many were deleted.
+    """
+    cutoff = to_epoch_us(older_than)
+    deleted = 0
+    while True:
+        with db.atomic():
+            count = db.execute_sql(
+                'DELETE FROM "command_receipt" WHERE "key" IN (SELECT "key" FROM '
+                '"command_receipt" WHERE "time" < ? LIMIT ?)', (cutoff, batch_size)).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
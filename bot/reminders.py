@@ -0,0 +1,204 @@
+"""
+    Time-driven hat housekeeping: warning and then expiring a hat that has been held
+    too long, pinging whoever is at the head of the queue when the hat has been left
+    free, and dropping queue entries that have been abandoned.
+
+    Timers are set and cancelled as HatState reports changes, so nothing polls the
+    tables. When a timer fires, its action runs on the engine's ordered lane like a
+    mutating command, first checking that the state it was set for still holds.
+"""
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+
+from bot import metrics
+from bot.replica import LeaseLost
+from bot.models import to_epoch_us
+from bot.state import DEQUEUED, QUEUED
+
+logger = logging.getLogger(__name__)
+
+WARN = 'warn'
+EXPIRE = 'expire'
+NUDGE = 'nudge'
+CLAIM = 'claim'
+WAIT = 'wait'
+
+
+def _epoch(moment):
+    return to_epoch_us(moment) / 1000000.0
+
+
+class HatReminders(object):
+    """
+        Keeps the scheduler's timers in step with a HatCommand's states. The scheduler
+        should hand due timers to the ordered lane. Messages are sent with
+        post(channel, text). Each setting is a timedelta, or None to turn it off:
+
+        - warn_after: remind the owner they still have the hat
+        - expire_after: take the hat off its owner, like *hat force off*
+        - nudge_after: ping whoever is at the head of the queue if the hat has been
+          free this long since they got there
+        - claim_timeout: drop the head of the queue if they still haven't taken the
+          hat this long after being pinged
+        - max_wait: drop anyone who has been in the queue this long
+    """
+
+    def __init__(self, command, scheduler, post, warn_after=None, expire_after=None,
+                 nudge_after=None, claim_timeout=None, max_wait=None):
+        self.command = command
+        self.scheduler = scheduler
+        self.post = post
+        self.warn_after = warn_after
+        self.expire_after = expire_after
+        self.nudge_after = nudge_after
+        self.claim_timeout = claim_timeout
+        self.max_wait = max_wait
+        # hat -> the id of the owner entry the owner timers were set for
+        self._owners = {}
+        # hat -> the id of the queue entry the nudge timer was set for
+        self._nudged = {}
+        self._keys = set()
+
+    def watch(self, states):
+        """
+            Starts following states, setting every timer it needs from scratch. Called
+            again whenever the command reloads its states.
+        """
+        for key in self._keys:
+            self.scheduler.cancel(key)
+        self._keys.clear()
+        self._owners.clear()
+        self._nudged.clear()
+        states.listener = self.changed
+        for hat in states.hats():
+            state = states.get(hat)
+            for entry in state.queue_entries():
+                self._set_wait(state, entry)
+            self._sync(state)
+
+    def changed(self, state, event, entry):
+        if event == QUEUED:
+            self._set_wait(state, entry)
+        elif event == DEQUEUED:
+            self._cancel((WAIT, state.hat, entry.id))
+        self._sync(state)
+
+    def _sync(self, state):
+        hat = state.hat
+        owner = state.owner
+        owner_id = owner.id if owner is not None else None
+        if self._owners.get(hat) != owner_id:
+            self._owners[hat] = owner_id
+            self._cancel((WARN, hat))
+            self._cancel((EXPIRE, hat))
+            if owner is not None:
+                start = _epoch(owner.start_time)
+                if self.warn_after is not None:
+                    self._schedule((WARN, hat), start + self.warn_after.total_seconds(),
+                                   self._warn, hat, owner.id)
+                if self.expire_after is not None:
+                    self._schedule((EXPIRE, hat), start + self.expire_after.total_seconds(),
+                                   self._expire, hat, owner.id)
+
+        head = state.next_in_queue() if owner is None else None
+        head_id = head.id if head is not None else None
+        if self._nudged.get(hat) != head_id:
+            self._nudged[hat] = head_id
+            self._cancel((CLAIM, hat))
+            if head is not None and self.nudge_after is not None:
+                self._schedule((NUDGE, hat), self.scheduler.clock() +
+                               self.nudge_after.total_seconds(), self._nudge, hat, head.id)
+            else:
+                self._cancel((NUDGE, hat))
+
+    def _set_wait(self, state, entry):
+        if self.max_wait is not None:
+            self._schedule((WAIT, state.hat, entry.id),
+                           _epoch(entry.start_time) + self.max_wait.total_seconds(),
+                           self._drop_waiting, state.hat, entry.user_id, entry.id)
+
+    def _schedule(self, key, when, action, *args):
+        self._keys.add(key)
+        self.scheduler.schedule(key, when, self._run, key, action, *args)
+
+    def _cancel(self, key):
+        self._keys.discard(key)
+        self.scheduler.cancel(key)
+
+    def _run(self, key, action, hat, *args):
+        """
+            Runs a fired timer's action in a transaction and posts what it has to say
+            in the hat's channel
+        """
+        self._keys.discard(key)
+        metrics.set_command('reminders')
+        try:
+            with self.command.store.atomic():
+                self.command.fence()
+                message = action(self.command.states.get(hat), *args)
+        except LeaseLost as error:
+            # The new active replica has timers of its own
+            self.command.rollback()
+            logger.warning('Dropped the %s timer for %s: %s', action.__name__, hat, error)
+            return
+        except Exception:
+            self.command.rollback()
+            raise
+        finally:
+            metrics.clear_command()
+        channel = self.command.hats.get(hat)
+        if message and channel:
+            self.post(channel, message)
+
+    #
+    # Actions
+    #
+
+    def _warn(self, state, owner_id):
+        owner = state.owner
+        if owner is None or owner.id != owner_id:
+            return None
+        return '<@{}>, you have had the *{}* hat for {}. Use *hat off* when you are ' \
+               'done.'.format(owner.user_id, state.hat, _held(owner.start_time))
+
+    def _expire(self, state, owner_id):
+        owner = state.owner
+        if owner is None or owner.id != owner_id:
+            return None
+        logger.info('Expiring %s hat held by %s', state.hat, owner.user_id)
+        return 'The *{}* hat has expired and been taken off {}'.format(
+            state.hat, self.command._force_off(state))
+
+    def _nudge(self, state, entry_id):
+        head = state.next_in_queue()
+        if state.owner is not None or head is None or head.id != entry_id:
+            return None
+        if self.claim_timeout is not None:
+            self._schedule((CLAIM, state.hat), self.scheduler.clock() +
+                           self.claim_timeout.total_seconds(), self._drop_head, state.hat,
+                           entry_id)
+        return '<@{}>, the *{}* hat is free and you are next in the queue. ' \
+               'Use *hat on* to take it.'.format(head.user_id, state.hat)
+
+    def _drop_head(self, state, entry_id):
+        head = state.next_in_queue()
+        if state.owner is not None or head is None or head.id != entry_id:
+            return None
+        state.remove_from_queue(head.user_id)
+        return '<@{}> has been dropped from the *{}* queue for not taking the hat ' \
+               'within {}.'.format(head.user_id, state.hat, self.claim_timeout)
+
+    def _drop_waiting(self, state, user_id, entry_id):
+        entry, _ = state.queue_position(user_id)
+        if entry is None or entry.id != entry_id:
+            return None
+        state.remove_from_queue(user_id)
+        return '<@{}> has been dropped from the *{}* queue after waiting for {}.'.format(
+            user_id, state.hat, self.max_wait)
+
+
+def _held(start_time):
+    held = datetime.now(tz=pytz.utc) - start_time
+    return held - timedelta(microseconds=held.microseconds)
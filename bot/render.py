@@ -0,0 +1,81 @@
+"""
+    Builds replies that fit in a Slack message. Slack cuts off message text past 40,000
+    characters and recommends staying under 4,000, and Block Kit allows 50 blocks with
+    at most 3,000 characters in a section, so lists are cut short to fit, saying so.
+
+    A reply is either text, or a dict of chat.postMessage arguments: the Block Kit
+    blocks plus the text Slack shows in notifications and older clients.
+"""
+MAX_TEXT = 4000
+MAX_BLOCKS = 50
+MAX_SECTION_TEXT = 3000
+
+
+def _fit(lines, limit, more):
+    """
+        Returns as many of the lines as fit in limit characters once joined with
+        newlines, followed by more(how many were left out) if any had to go
+    """
+    if sum(len(line) for line in lines) + len(lines) - 1 <= limit:
+        return lines
+    # The suffix is longest when everything is left out
+    room = limit - len(more(len(lines))) - 1
+    kept = []
+    length = -1
+    for line in lines:
+        if length + 1 + len(line) > room:
+            break
+        kept.append(line)
+        length += 1 + len(line)
+    if not kept:
+        # One huge line; keep what we can of it
+        kept = [lines[0][:room - 1] + '…']
+    left_out = len(lines) - len(kept)
+    return kept + [more(left_out)] if left_out else kept
+
+
+def truncate(text, limit=MAX_TEXT):
+    """
+        Cuts text down to limit characters, at a line break where there is one
+    """
+    if len(text) <= limit:
+        return text
+    return '\n'.join(_fit(text.split('\n'), limit,
+                          lambda missing: '…and {} more lines'.format(missing)))
+
+
+def listing(title, lines, footer=None, blocks=False):
+    """
+        A reply listing lines under a title, with an optional footer. With blocks, it
+        is a Block Kit message: the title, the lines in as few sections as fit, and
+        the footer as context.
+    """
+    text = truncate('\n'.join([title] + list(lines) + ([footer] if footer else [])))
+    if not blocks:
+        return text
+
+    sections = []
+    current = []
+    length = 0
+    for line in lines:
+        if current and length + len(line) + 1 > MAX_SECTION_TEXT:
+            sections.append(current)
+            current, length = [], 0
+        current.append(line)
+        length += len(line) + 1
+    if current:
+        sections.append(current)
+    # Room for the title and the footer
+    room = MAX_BLOCKS - 1 - (1 if footer else 0)
+    if len(sections) > room:
+        left_out = sum(len(section) for section in sections[room - 1:])
+        sections = sections[:room - 1] + [['…and {} more'.format(left_out)]]
+
+    message_blocks = [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': title}}]
+    for section in sections:
+        message_blocks.append({'type': 'section', 'text': {
+            'type': 'mrkdwn', 'text': truncate('\n'.join(section), MAX_SECTION_TEXT)}})
+    if footer:
+        message_blocks.append({'type': 'context', 'elements': [
+            {'type': 'mrkdwn', 'text': footer}]})
+    return {'text': text, 'blocks': message_blocks}
@@ -0,0 +1,200 @@
+"""
+    Active/standby replicas sharing one database. Whichever replica holds the lease in
+    leader_lease is active: it answers commands and runs the background work. It renews
+    the lease several times a lease period, and stops renewing when its read loop
+    stalls (say, stuck reconnecting), so a hung replica loses the lease just like a dead
+    one. Standbys try to take the lease whenever it has expired, which is at most one
+    lease period after the active replica stopped renewing it.
+
+    Every replica also keeps its row in the replica table up to date, which is what
+    *hat status* shows.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LEASE = 'leader'
+ACTIVE = 'active'
+STANDBY = 'standby'
+
+# Replicas not heard from for this many seconds are forgotten by the next leader
+FORGET_AFTER = 3600
+
+
+class LeaseLost(Exception):
+    """
+        Raised by LeaderElector.fence() when this replica no longer holds the lease
+    """
+
+
+def default_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def _us(seconds):
+    return int(seconds * 1000000)
+
+
+class LeaderElector(object):
+    """
+        Campaigns for the lease on a thread of its own. on_elected(term) is called when
+        this replica takes the lease, on_deposed() when it loses it, and on_standby() on
+        every tick it spends as a standby; all of them on the elector's thread.
+        position() gives the replica's journal position, for the status.
+    """
+
+    def __init__(self, db, name, ttl=0.8, stall_timeout=30, on_elected=None, on_deposed=None,
+                 on_standby=None, position=None, clock=time.time):
+        self.db = db
+        self.name = name
+        self.ttl = ttl
+        self.interval = ttl / 4
+        self.stall_timeout = stall_timeout
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.on_standby = on_standby
+        self.position = position
+        self.clock = clock
+        self.term = None
+        self._valid_until = 0
+        self._beat = clock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        """
+            Whether this replica holds the lease. It stops believing so as soon as the
+            lease could have expired, even before it notices it lost it.
+        """
+        return self.term is not None and self.clock() < self._valid_until
+
+    def fence(self):
+        """
+            Call first thing in a transaction that writes as the active replica. Takes
+            the database's write lock and checks, under it, that this replica's lease is
+            still current, raising LeaseLost if it isn't. A standby can only take the
+            lease once it has the write lock, so it can't take over before the
+            transaction commits. Waiting for the lock (up to busy_timeout) happens
+            before the check, so a lease that runs out while this waits is noticed.
+        """
+        term = self.term
+        if term is None:
+            raise LeaseLost('{} is not the active replica'.format(self.name))
+        # A write that changes nothing, to wait for and take the lock
+        self.db.execute_sql('UPDATE "leader_lease" SET "term" = "term" WHERE "name" = ?',
+                            (LEASE,))
+        holder, current_term, expires = self.db.execute_sql(
+            'SELECT "holder", "term", "expires_time" FROM "leader_lease" WHERE "name" = ?',
+            (LEASE,)).fetchone()
+        if (holder, current_term) != (self.name, term) or expires <= _us(self.clock()):
+            raise LeaseLost('{} no longer holds the lease of term {}'.format(self.name, term))
+
+    def heartbeat(self):
+        """
+            Called by the read loop each time round, to show it isn't stuck
+        """
+        self._beat = self.clock()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='leader-elector', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+            Stops campaigning. If this replica is active, the lease is given up so a
+            standby can take over straight away.
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self.db.atomic():
+            if self.term is not None:
+                self.db.execute_sql('UPDATE "leader_lease" SET "expires_time" = 0 '
+                                    'WHERE "name" = ? AND "holder" = ? AND "term" = ?',
+                                    (LEASE, self.name, self.term))
+            self.db.execute_sql('DELETE FROM "replica" WHERE "name" = ?', (self.name,))
+        self.term = None
+
+    def tick(self):
+        """
+            Renews or campaigns for the lease once. Returns whether this replica is
+            active afterwards.
+        """
+        now = self.clock()
+        was_leader = self.term is not None
+        stalled = now - self._beat > self.stall_timeout
+        with self.db.atomic():
+            if was_leader:
+                if stalled:
+                    logger.warning('The read loop has stalled for %.1fs; giving up the lease',
+                                   now - self._beat)
+                    self.db.execute_sql('UPDATE "leader_lease" SET "expires_time" = 0 '
+                                        'WHERE "name" = ? AND "holder" = ? AND "term" = ?',
+                                        (LEASE, self.name, self.term))
+                    renewed = False
+                else:
+                    renewed = self.db.execute_sql(
+                        'UPDATE "leader_lease" SET "expires_time" = ? '
+                        'WHERE "name" = ? AND "holder" = ? AND "term" = ?',
+                        (_us(now + self.ttl), LEASE, self.name, self.term)).rowcount == 1
+                if not renewed:
+                    self.term = None
+            elif not stalled:
+                elected = self.db.execute_sql(
+                    'UPDATE "leader_lease" SET "holder" = ?, "term" = "term" + 1, '
+                    '"acquired_time" = ?, "expires_time" = ? '
+                    'WHERE "name" = ? AND "expires_time" < ?',
+                    (self.name, _us(now), _us(now + self.ttl), LEASE, _us(now))).rowcount == 1
+                if elected:
+                    self.term = self.db.execute_sql(
+                        'SELECT "term" FROM "leader_lease" WHERE "name" = ?',
+                        (LEASE,)).fetchone()[0]
+                    self.db.execute_sql('DELETE FROM "replica" WHERE "heartbeat_time" < ?',
+                                        (_us(now - FORGET_AFTER),))
+            self.db.execute_sql(
+                'INSERT OR REPLACE INTO "replica" ("name", "role", "heartbeat_time", "event_id") '
+                'VALUES (?, ?, ?, ?)', (self.name, ACTIVE if self.term is not None else STANDBY,
+                                        _us(now), self.position() if self.position else None))
+        if self.term is not None:
+            self._valid_until = now + self.ttl
+
+        if self.term is not None and not was_leader:
+            logger.info('%s is now the active replica (term %d)', self.name, self.term)
+            if self.on_elected is not None:
+                self.on_elected(self.term)
+        elif was_leader and self.term is None:
+            logger.warning('%s lost the lease and is now a standby', self.name)
+            if self.on_deposed is not None:
+                self.on_deposed()
+        elif self.term is None and self.on_standby is not None:
+            self.on_standby()
+        return self.term is not None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Leader election failed')
+            self._stopping.wait(self.interval)
+
+
+def replicas(db):
+    """
+        Returns the lease as (holder, term, acquired_time, expires_time), all times in
+        epoch seconds, and every replica's (name, role, heartbeat_time, event_id)
+    """
+    holder, term, acquired, expires = db.execute_sql(
+        'SELECT "holder", "term", "acquired_time", "expires_time" FROM "leader_lease" '
+        'WHERE "name" = ?', (LEASE,)).fetchone()
+    rows = db.execute_sql('SELECT "name", "role", "heartbeat_time", "event_id" FROM "replica" '
+                          'ORDER BY "name"').fetchall()
+    return ((holder, term, acquired / 1000000.0, expires / 1000000.0),
+            [(name, role, heartbeat / 1000000.0, event_id)
+             for name, role, heartbeat, event_id in rows])
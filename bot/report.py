@@ -0,0 +1,167 @@
+"""
+    Deploy analytics over a window of hat history. Only the columns a figure needs are
+    selected, and they are read in chunks straight into NumPy arrays, so the report
+    never builds a model instance per row and stays fast on years of history. History
+    is read through the views that cover both the hot and archive tables.
+"""
+import re
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+
+from bot.models import to_epoch_us
+from bot.rollups import STATS_TIMEZONE_NAME, US_PER_HOUR, stats_timezone
+
+PERCENTILES = (50, 90, 99)
+DEFAULT_WINDOW = timedelta(days=30)
+# Longer windows would reach back before any history, or past what a datetime can hold
+MAX_WINDOW = timedelta(days=100 * 365)
+CHUNK_SIZE = 10000
+
+_WINDOW_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+_WINDOW_HOURS = {'h': 1, 'd': 24, 'w': 24 * 7}
+
+
+def parse_window(text):
+    """
+        Parses a window like "12h", "30d", "8w" or "30" (days). Returns None if the text
+        isn't one, and raises ValueError if it is longer than MAX_WINDOW.
+    """
+    match = re.match(r'^(\d+)([hdw]?)$', text.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        return None
+    count, unit = int(match.group(1)), match.group(2) or 'd'
+    # Checked before building the timedelta, which overflows on huge counts
+    if count * _WINDOW_HOURS[unit] > MAX_WINDOW.total_seconds() / 3600:
+        raise ValueError('Reports go back at most {} days'.format(MAX_WINDOW.days))
+    return timedelta(**{_WINDOW_UNITS[unit]: count})
+
+
+def load_columns(db, sql, params=(), columns=1, chunk_size=CHUNK_SIZE):
+    """
+        Runs the query and returns its integer columns as an (n, columns) int64 array,
+        fetching chunk_size rows at a time
+    """
+    cursor = db.execute_sql(sql, params)
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64))
+    if not chunks:
+        return np.empty((0, columns), dtype=np.int64)
+    return np.concatenate(chunks)
+
+
+def percentiles(values):
+    if not len(values):
+        return None
+    return dict(zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+
+
+def local_hours(times):
+    """
+        Hour of day in the stats timezone for each epoch microsecond time. The timezone is
+        only consulted once per distinct UTC hour, since offsets change on the hour.
+    """
+    utc_hours, inverse = np.unique(times // US_PER_HOUR, return_inverse=True)
+    zone = stats_timezone()
+    hours = np.array([datetime.fromtimestamp(int(hour) * 3600, tz=pytz.utc)
+                      .astimezone(zone).hour for hour in utc_hours], dtype=np.int64)
+    return hours[inverse]
+
+
+def build_report(db, hat, window=DEFAULT_WINDOW, now=None, chunk_size=CHUNK_SIZE):
+    """
+        Returns the hat's figures for the window ending now: hold and queue wait
+        percentiles (in seconds) over the visits that finished in it, pool sizes per hold
+        and holds started per local hour of day.
+    """
+    now = now or datetime.now(tz=pytz.utc)
+    until = to_epoch_us(now)
+    since = to_epoch_us(now - window)
+
+    holds = load_columns(
+        db, 'SELECT "start_time", COALESCE("end_time", ?) FROM "hatlog_history" '
+            'WHERE "hat" = ? AND "start_time" >= ? AND "start_time" < ? ORDER BY "start_time"',
+        (until, hat, since, until), columns=2, chunk_size=chunk_size)
+    waits = load_columns(
+        db, 'SELECT "end_time" - "start_time" FROM "hatqueue_history" WHERE "hat" = ? '
+            'AND "start_time" >= ? AND "start_time" < ? AND "end_time" IS NOT NULL',
+        (hat, since, until), chunk_size=chunk_size)[:, 0]
+    # Open pool rows are only ever in the hot table
+    pool_ends = np.concatenate([
+        load_columns(db, 'SELECT "end_time" FROM "hatpool_history" WHERE "hat" = ? '
+                         'AND "end_time" >= ?', (hat, since), chunk_size=chunk_size)[:, 0],
+        load_columns(db, 'SELECT ? FROM "hatpool" WHERE "hat" = ? AND "end_time" IS NULL',
+                     (until, hat), chunk_size=chunk_size)[:, 0]])
+
+    starts, ends = holds[:, 0], holds[:, 1]
+    finished = ends < until
+    # Pool rows don't say which hold they were part of; each one ends during (or when)
+    # the hold it belonged to ends. Holds don't overlap, so ends are sorted like starts.
+    hold_index = np.searchsorted(ends, pool_ends, side='left')
+    belongs = hold_index < len(ends)
+    belongs[belongs] &= starts[hold_index[belongs]] <= pool_ends[belongs]
+    pool_sizes = np.bincount(hold_index[belongs], minlength=len(ends))
+
+    hours = local_hours(starts) if len(starts) else np.empty(0, dtype=np.int64)
+    return {
+        'hat': hat,
+        'window': window,
+        'holds': len(starts),
+        'hold_seconds': percentiles((ends[finished] - starts[finished]) / 1e6),
+        'waits': len(waits),
+        'wait_seconds': percentiles(waits / 1e6),
+        'pool_sizes': percentiles(pool_sizes),
+        'max_pool_size': int(pool_sizes.max()) if len(pool_sizes) else 0,
+        'by_hour': np.bincount(hours, minlength=24),
+    }
+
+
+def _window(window):
+    if window.seconds:
+        return '{} hours'.format(window.days * 24 + window.seconds // 3600)
+    return '{} days'.format(window.days)
+
+
+def _duration(seconds):
+    return str(timedelta(seconds=int(round(seconds))))
+
+
+def _describe(values, formatter):
+    return ', '.join('p{} {}'.format(percentile, formatter(value))
+                     for percentile, value in sorted(values.items()))
+
+
+def format_report(report):
+    lines = ['*{}* over the last {}'.format(report['hat'], _window(report['window']))]
+    if not report['holds'] and not report['waits']:
+        lines.append('Nothing happened.')
+        return '\n'.join(lines)
+
+    if report['hold_seconds']:
+        lines.append('Held {} times: {}'.format(
+            report['holds'], _describe(report['hold_seconds'], _duration)))
+    else:
+        lines.append('Held {} times'.format(report['holds']))
+    if report['wait_seconds']:
+        lines.append('Waited in the queue {} times: {}'.format(
+            report['waits'], _describe(report['wait_seconds'], _duration)))
+    if report['pool_sizes']:
+        lines.append('Pool size: {}, max {}'.format(
+            _describe(report['pool_sizes'], lambda value: '{:g}'.format(value)),
+            report['max_pool_size']))
+
+    by_hour = report['by_hour']
+    # Bars are at most 20 characters wide
+    scale = max(1, -(-int(by_hour.max()) // 20))
+    lines.append('Deploys by hour ({}):'.format(STATS_TIMEZONE_NAME))
+    lines.append('```')
+    for hour, count in enumerate(by_hour):
+        if count:
+            lines.append('{:02d}:00 {:<20} {}'.format(hour, '#' * -(-int(count) // scale), count))
+    lines.append('```')
+    return '\n'.join(lines)
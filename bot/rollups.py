@@ -0,0 +1,88 @@
+"""
+    Counters behind `hat stats` and `hat info`, kept in the store (the stat_rollup
+    table, with the default store) so that reading one is a single lookup however much
+    history there is. HatState bumps them in the same transaction as the transition
+    they count; rebuild() recomputes them all from the database's history.
+"""
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+import pytz
+
+from bot.models import from_epoch_us
+
+# Days are counted in this timezone, so "today" starts at midnight Eastern
+STATS_TIMEZONE_NAME = 'US/Eastern'
+
+DAILY_DEPLOYS = 'daily_deploys'
+USER_DEPLOYS = 'user_deploys'
+USER_POOLS = 'user_pools'
+
+US_PER_HOUR = 3600 * 1000000
+
+
+@lru_cache(maxsize=None)
+def stats_timezone():
+    # Loaded on first use: reading the zone file was most of this module's import time
+    return pytz.timezone(STATS_TIMEZONE_NAME)
+
+
+def stats_day(moment):
+    return moment.astimezone(stats_timezone()).strftime('%Y-%m-%d')
+
+
+def daily_bucket(hat, moment=None):
+    return '{}/{}'.format(hat, stats_day(moment or datetime.now(tz=pytz.utc)))
+
+
+def record_deploy(store, hat, user_id, start_time):
+    """
+        Counts a deploy. Call it inside the transaction that queues it, like record_pool.
+    """
+    store.increment(DAILY_DEPLOYS, daily_bucket(hat, start_time))
+    store.increment(USER_DEPLOYS, user_id)
+
+
+def record_pool(store, user_id):
+    store.increment(USER_POOLS, user_id)
+
+
+def rebuild(db, queue_source='hatqueue_history', pool_source='hatpool_history'):
+    """
+        Recomputes every counter from the queue and pool history in one streaming pass
+        over each table and replaces the stored rollups with the result. Returns the
+        number of counters written.
+
+        It all happens in one transaction that takes the write lock before scanning, so
+        it can run while the bot is up: nothing can land between the scan and the
+        replacement and be counted twice or not at all.
+    """
+    # IMMEDIATE only applies when this is the outermost transaction; in a migration's
+    # it is a savepoint, and the migration already holds the lock
+    with db.atomic('IMMEDIATE'):
+        counts = Counter()
+        # Converting each row's time is slow, so look the day up once per UTC hour. An
+        # hour that spans midnight in the stats timezone (as some do in zones that are
+        # off by a half or three quarters of an hour) is left as None and done per row.
+        day_of_hour = {}
+        cursor = db.execute_sql('SELECT "hat", "user_id", "start_time" FROM "{}"'.format(
+            queue_source))
+        for hat, user_id, start_time in cursor:
+            hour = start_time // US_PER_HOUR
+            if hour not in day_of_hour:
+                first = stats_day(from_epoch_us(hour * US_PER_HOUR))
+                last = stats_day(from_epoch_us((hour + 1) * US_PER_HOUR - 1))
+                day_of_hour[hour] = first if first == last else None
+            day = day_of_hour[hour] or stats_day(from_epoch_us(start_time))
+            counts[DAILY_DEPLOYS, '{}/{}'.format(hat, day)] += 1
+            counts[USER_DEPLOYS, user_id] += 1
+        for user_id, in db.execute_sql('SELECT "user_id" FROM "{}"'.format(pool_source)):
+            counts[USER_POOLS, user_id] += 1
+
+        # Raw SQL, so migrations can run this against the schema as it was when they shipped
+        db.execute_sql('DELETE FROM "stat_rollup"')
+        for (metric, bucket), value in counts.items():
+            db.execute_sql('INSERT INTO "stat_rollup" ("metric", "bucket", "value") '
+                           'VALUES (?, ?, ?)', (metric, bucket, value))
+    return len(counts)
@@ -0,0 +1,131 @@
+import importlib
+import logging
+import pkgutil
+from collections import namedtuple
+
+from bot.commands.base import BotCommand
+from bot.engine import FUN, QUERY, STATE
+from bot.trie import TokenTrie, tokenize
+
+logger = logging.getLogger(__name__)
+
+
+class Route(namedtuple('Route', ['command', 'instance', 'name', 'function', 'remainder'])):
+    """
+        Where a message was routed. name and function are None when the prefix matched
+        but the rest of the message isn't one of the instance's commands.
+    """
+
+    @property
+    def mutating(self):
+        return self.instance.is_mutating(self.name)
+
+    @property
+    def priority(self):
+        """
+            The command's priority class in the engine
+        """
+        if self.mutating:
+            return STATE
+        return FUN if self.instance.is_fun(self.name) else QUERY
+
+    @property
+    def metric_name(self):
+        return self.instance.metric_names[self.name]
+
+    def run(self, channel, user, key=None):
+        """
+            Runs the command. key is the message's receipt key, if it has one; see
+            bot.receipts.
+        """
+        if self.function is None:
+            return self.instance.invalid(self.command, channel, user)
+        if self.mutating:
+            return self.instance.run_atomic(self.function, self.remainder, channel, user, key)
+        return self.function(self.instance, self.remainder, channel, user)
+
+
+def discover_commands(package):
+    """
+        Imports every module in the package and returns the BotCommand subclasses
+        defined in them
+    """
+    classes = []
+    for _, module_name, _ in pkgutil.iter_modules(package.__path__):
+        module = importlib.import_module('{}.{}'.format(package.__name__, module_name))
+        for value in vars(module).values():
+            if isinstance(value, type) and issubclass(value, BotCommand) \
+                    and value is not BotCommand and value.__module__ == module.__name__:
+                classes.append(value)
+    return sorted(classes, key=lambda cls: cls.__name__)
+
+
+class CommandRouter(object):
+    """
+        Compiles command prefixes into a token trie once at startup, so routing a message
+        costs O(tokens) regardless of how many commands are registered. Messages without
+        a known prefix go to the fallback command, if there is one.
+
+        Registrations that would make a command unreachable are logged and collected in
+        `problems` as they are found.
+    """
+
+    def __init__(self):
+        self._prefixes = TokenTrie()
+        self.commands = []
+        self.fallback = None
+        self.problems = []
+
+    @classmethod
+    def load(cls, package, **dependencies):
+        router = cls()
+        for command_class in discover_commands(package):
+            router.register(command_class.create(**dependencies))
+        router.check()
+        return router
+
+    def register(self, instance):
+        prefix = instance.prefix.split()
+        if prefix:
+            previous = self._prefixes.insert(prefix, instance)
+            if previous is not None:
+                self._report("prefix '{}' is registered by both {} and {}".format(
+                    instance.prefix, type(previous).__name__, type(instance).__name__))
+        if instance.FALLBACK:
+            if self.fallback is not None:
+                self._report('both {} and {} want to be the fallback command'.format(
+                    type(self.fallback).__name__, type(instance).__name__))
+            else:
+                self.fallback = instance
+        self.commands.append(instance)
+
+    def check(self):
+        """
+            Reports fallback commands that can never be reached without their prefix
+            because another command's prefix captures them first
+        """
+        if self.fallback is None:
+            return
+        for name in self.fallback.command_mappings:
+            tokens = tokenize(name)
+            owner, end = self._prefixes.longest_match(tokens)
+            if owner is not None and owner is not self.fallback:
+                self._report("'{}' is shadowed by the '{}' prefix of {}; use '{} {}'".format(
+                    name, owner.prefix, type(owner).__name__, self.fallback.prefix, name))
+
+    def route(self, command):
+        """
+            Returns the Route for the message, or None if nothing handles it
+        """
+        tokens = tokenize(command)
+        instance, start = self._prefixes.longest_match(tokens)
+        if instance is None:
+            instance, start = self.fallback, 0
+            if instance is None:
+                return None
+        name, function, remainder = instance.resolve(command, tokens, start)
+        return Route(command, instance, name, function, remainder)
+
+    def _report(self, problem):
+        logger.warning('Ambiguous command registration: %s', problem)
+        self.problems.append(problem)
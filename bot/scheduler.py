@@ -0,0 +1,104 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+        Runs functions at given times from a heap of timers, so scheduling or cancelling
+        one costs O(log n) however many are pending, and the thread only wakes when the
+        earliest is due. Each timer has a key; scheduling a key that is already pending
+        replaces its timer. Due timers are handed to `submit` (by default they run on
+        the scheduler's thread), which should return quickly.
+    """
+
+    def __init__(self, submit=None, clock=time.time):
+        self.submit = submit or (lambda function, *args: function(*args))
+        self.clock = clock
+        self._condition = threading.Condition()
+        # [when, sequence, key, function, args]; function is None once cancelled
+        self._heap = []
+        self._timers = {}
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._stopped = False
+        self._thread = None
+
+    def schedule(self, key, when, function, *args):
+        with self._condition:
+            self._cancel(key)
+            timer = [when, next(self._sequence), key, function, args]
+            self._timers[key] = timer
+            heapq.heappush(self._heap, timer)
+            if self._heap[0] is timer:
+                self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            return self._cancel(key)
+
+    def pending(self):
+        with self._condition:
+            return len(self._timers)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run_due(self, now=None):
+        """
+            Hands every timer due by now to submit() and returns how many there were
+        """
+        now = self.clock() if now is None else now
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                timer = heapq.heappop(self._heap)
+                if timer[3] is None:
+                    self._cancelled -= 1
+                    continue
+                del self._timers[timer[2]]
+                due.append(timer)
+        for when, _, key, function, args in due:
+            try:
+                self.submit(function, *args)
+            except Exception:
+                logger.exception('Timer %s failed', key)
+        return len(due)
+
+    def _cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        # Cancelled timers are left in the heap and skipped when they come up, unless
+        # they have come to outnumber the live ones
+        timer[3] = timer[4] = None
+        self._cancelled += 1
+        if self._cancelled > len(self._timers) and self._cancelled > 100:
+            self._heap = [timer for timer in self._heap if timer[3] is not None]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (
+                        not self._heap or self._heap[0][0] > self.clock()):
+                    self._condition.wait(self._heap[0][0] - self.clock() if self._heap else None)
+                if self._stopped:
+                    return
+            self.run_due()
@@ -0,0 +1,15 @@
+from peewee import SqliteDatabase
+
+# Fill these in
+SLACK_BOT_TOKEN=''
+BOT_ID='UBOT'
+BOT_NAME=''
+DB_FILE='/tmp/hat.db'
+TARGET_CHANNEL=''
+CHANNEL_ID="C1"
+CHANNEL_MESSAGE_RATE=100
+CHANNEL_MESSAGE_BURST=100
+
+# Don't change stuff down here
+database = SqliteDatabase(DB_FILE)
+
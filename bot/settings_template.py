@@ -7,7 +7,56 @@ BOT_NAME=''
 DB_FILE=''
 TARGET_CHANNEL=''
 CHANNEL_ID=''
+# To run several hats from one bot, map each hat's name to the channel ID it lives in,
+# e.g. {'web': 'C0123', 'api': 'C0123', 'data': 'C0456'}. When empty there is a single
+# hat in CHANNEL_ID.
+HATS={}
+# 'rtm' for the RTM websocket, or 'events' to receive the Events API over HTTP on
+# EVENTS_PORT (point the app's Request URL at http://host:EVENTS_PORT/slack/events)
+TRANSPORT='rtm'
+SLACK_SIGNING_SECRET=''  # needed for 'events'
+EVENTS_PORT=3000
+
+# Optional tuning
+COMMAND_CONCURRENCY=4  # read-only commands that may run at once
+COMMAND_QUEUE_SIZE=1000  # commands waiting to run before we stop taking events
+FUN_SHED_DEPTH=50  # commands waiting before fun ones (memeify, facts, gif) are turned away
+EVENT_QUEUE_SIZE=1000  # received events waiting to be dispatched ('events' only)
+USER_CACHE_TTL=3600  # seconds before a cached user name is refreshed
+USER_CACHE_SIZE=5000
+SEND_QUEUE_SIZE=1000  # replies waiting to be posted
+CHANNEL_MESSAGE_RATE=1.0  # replies per second per channel...
+CHANNEL_MESSAGE_BURST=4  # ...with bursts of up to this many
+ARCHIVE_AFTER_DAYS=30  # move closed history this old to the archive tables; None to keep it
+ARCHIVE_BATCH_SIZE=500
+ARCHIVE_INTERVAL=300  # seconds between archiver runs
+METRICS_PORT=None  # serve Prometheus metrics on this local port, e.g. 9108
+HAT_WARN_AFTER=None  # minutes before whoever has the hat is reminded; None for never
+HAT_EXPIRE_AFTER=None  # minutes before the hat is taken off its owner
+QUEUE_NUDGE_AFTER=5  # minutes the hat can sit free before the head of the queue is pinged
+QUEUE_CLAIM_TIMEOUT=None  # minutes after that before they are dropped from the queue
+QUEUE_MAX_WAIT=None  # minutes before anyone still in the queue is dropped
+JOURNAL_SNAPSHOT_INTERVAL=600  # seconds between snapshots of hat state in the journal
+ADMIN_USERS=[]  # user IDs allowed *hat export*, *hat metrics* and *hat status*; nobody when empty
+EXPORT_MAX_ROWS=50000  # rows per *hat export* upload
+STATE_SNAPSHOT_FILE=None  # save warm state here on shutdown and restore it at start
+DEDUP_WINDOW=600  # seconds a message is remembered, so a repeated delivery is dropped
+DEDUP_SIZE=10000  # messages remembered at most
+RECEIPT_RETENTION=24  # hours a carried out command is remembered, so it never runs twice
+REPLICATION=False  # run several copies against DB_FILE, one active and the rest on standby
+REPLICA_NAME=None  # how this copy shows up in *hat status*; host:pid by default
+LEADER_LEASE_TTL=0.8  # seconds before a standby takes over from a silent active copy
+LEADER_STALL_TIMEOUT=30  # seconds the active copy can go without reading events
+QUEUE_PAGE_SIZE=20  # people *hat queued* lists per page
+REPLY_BLOCKS=False  # send lists as Block Kit sections rather than plain text
+STORAGE='sqlite'  # 'memory' keeps the hats in this process only, and loses them on exit
 
 # Don't change stuff down here
-database = SqliteDatabase(DB_FILE)
+DB_PRAGMAS = [
+    ('journal_mode', 'wal'),  # readers never block the writer, or the writer readers
+    ('synchronous', 'normal'),  # with WAL a commit doesn't fsync; a crash can't corrupt
+    ('busy_timeout', 5000),  # milliseconds to wait for another writer
+    ('cache_size', -16000),  # 16MB of page cache per connection
+]
+database = SqliteDatabase(DB_FILE, pragmas=DB_PRAGMAS)
 
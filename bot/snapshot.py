@@ -0,0 +1,85 @@
+"""
+    A snapshot of the bot's warm state (every hat's owner, queue and pool, and the user
+    name cache) written at shutdown and restored at boot, so a restarted bot answers
+    its first command without loading anything.
+
+    The hat state is only restored if the database files are exactly as they were when
+    the snapshot was taken; otherwise it is rebuilt from the journal as usual. Cached user
+    names don't depend on the database, so they are always restored.
+"""
+import json
+import logging
+import os
+from collections import namedtuple
+
+from bot.state import HatStates
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+
+# schema_version and states are None unless the database is unchanged since the snapshot
+Snapshot = namedtuple('Snapshot', 'schema_version states users')
+
+
+def database_fingerprint(db_file):
+    """
+        Identifies the database's contents without reading them: the size and
+        modification time of the file, and the size of its write-ahead log
+    """
+    try:
+        stat = os.stat(db_file)
+    except OSError:
+        return None
+    try:
+        wal_size = os.stat(db_file + '-wal').st_size
+    except OSError:
+        wal_size = 0
+    return [stat.st_size, stat.st_mtime_ns, wal_size]
+
+
+def save(path, db, states, directory, schema_version):
+    """
+        Writes the snapshot to path. Call it once nothing else will write to the
+        database, since any later change makes the hat state unusable.
+    """
+    # Fold the log into the database file first; an empty log is what a fresh
+    # connection expects to find at the next boot
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    snapshot = {
+        'format': FORMAT,
+        'fingerprint': database_fingerprint(db.database),
+        'schema_version': schema_version,
+        'users': directory.entries(),
+    }
+    snapshot.update(states.to_rows())
+    # Write it alongside and swap it in, so a crash never leaves half a snapshot
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temporary, path)
+    logger.info('Saved a snapshot of %d hats and %d users to %s', len(states.hats()),
+                len(snapshot['users']), path)
+
+
+def load(path, db_file):
+    """
+        Reads the snapshot at path, or returns None if there isn't a usable one
+    """
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError) as error:
+        if not isinstance(error, FileNotFoundError):
+            logger.warning('Ignoring snapshot %s: %s', path, error)
+        return None
+    if snapshot.get('format') != FORMAT:
+        logger.warning('Ignoring snapshot %s: unknown format', path)
+        return None
+
+    users = [tuple(entry) for entry in snapshot['users']]
+    if snapshot['fingerprint'] != database_fingerprint(db_file):
+        logger.info('The database has changed since snapshot %s; restoring only users', path)
+        return Snapshot(None, None, users)
+
+    return Snapshot(snapshot['schema_version'], HatStates.from_rows(snapshot), users)
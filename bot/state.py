@@ -0,0 +1,414 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+
+from bot import metrics, receipts, rollups, settings, storage
+from bot.models import HatLog, HatQueue, HatPool, from_epoch_us, to_epoch_us
+
+DEFAULT_HAT = 'deploy'
+
+# What HatState tells its listener about
+TAKEN = 'taken'
+GIVEN_UP = 'given up'
+QUEUED = 'queued'
+DEQUEUED = 'dequeued'
+
+# The kinds of event in the hat_event journal
+ON = 'on'
+OFF = 'off'
+QUEUE = 'queue'
+DEQUEUE = 'dequeue'
+POOL = 'pool'
+UNPOOL = 'unpool'
+POOL_CLEAR = 'pool clear'  # user_id's whole pool was broken up
+POOL_MOVE = 'pool move'  # other_user_id's pool was handed to user_id
+
+def configured_hats():
+    """
+        Returns hat name -> the channel ID where it can be taken. Without a HATS setting
+        there is a single hat in CHANNEL_ID.
+    """
+    hats = getattr(settings, 'HATS', None)
+    if hats:
+        return dict(hats)
+    return {DEFAULT_HAT: settings.CHANNEL_ID}
+
+
+def legacy_hat():
+    """
+        The hat that rows from before there were several hats belong to
+    """
+    for hat, channel in configured_hats().items():
+        if channel == settings.CHANNEL_ID:
+            return hat
+    return DEFAULT_HAT
+
+
+class HatState(object):
+    """
+        One hat's live state (owner, queue and pool) kept in memory. Reads never touch the
+        store; every change is written through to it (the HatLog/HatQueue/HatPool tables,
+        with the default store) before it is applied here, so the store keeps the
+        durable copy. Each change is also appended to the journal, and changes counted
+        in the stats rollups update them, in the same transaction.
+
+        Changes of owner and queue are reported to `listener(state, event, entry)`, if
+        there is one, with event one of TAKEN, GIVEN_UP, QUEUED or DEQUEUED.
+    """
+
+    def __init__(self, hat, listener=None, store=None):
+        self.hat = hat
+        self.listener = listener
+        self.store = store if store is not None else storage.default_store()
+        self._lock = threading.RLock()
+        self.owner = None
+        self._queue = []
+        # user_id -> index in self._queue, so queue positions are a dict lookup
+        self._queue_index = {}
+        # owner_user_id -> OrderedDict(user_id -> HatPool entry)
+        self._pools = {}
+        # user_id -> HatPool entry, across every owner
+        self._pooled = {}
+
+    @classmethod
+    def load(cls, hat, store=None):
+        return HatStates.load(hat, store).get(hat)
+
+    #
+    # Owner
+    #
+
+    def take_hat(self, user_id, now=None):
+        now = now or datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            entry = self.store.start_hold(self.hat, user_id, now)
+            self._record(ON, user_id, entry.id, now)
+            self.owner = entry
+            self._changed(TAKEN, entry)
+            return entry
+
+    def give_up_hat(self, end_time=None):
+        end_time = end_time or datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            entry = self.owner
+            self.store.end_hold(entry, end_time)
+            self._record(OFF, entry.user_id, entry.id, end_time)
+            self.owner = None
+            self._changed(GIVEN_UP, entry)
+            return entry
+
+    #
+    # Queue
+    #
+
+    def queue_entries(self):
+        with self._lock:
+            return list(self._queue)
+
+    def queue_page(self, start, count):
+        """
+            Returns (up to `count` entries from position start + 1 on, the queue's length)
+        """
+        with self._lock:
+            return self._queue[start:start + count], len(self._queue)
+
+    def next_in_queue(self):
+        with self._lock:
+            return self._queue[0] if self._queue else None
+
+    def queue_position(self, user_id):
+        """
+            Returns the user's queue entry and their 1-based position, or (None, None)
+        """
+        with self._lock:
+            index = self._queue_index.get(user_id)
+            if index is None:
+                return None, None
+            return self._queue[index], index + 1
+
+    def enqueue(self, user_id, now=None):
+        """
+           Adds the user to the queue and returns the number of entries in front of them
+        """
+        now = now or datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            entry = self.store.start_queued(self.hat, user_id, now)
+            rollups.record_deploy(self.store, self.hat, user_id, now)
+            self._record(QUEUE, user_id, entry.id, now)
+            self._append_to_queue(entry)
+            self._changed(QUEUED, entry)
+            return len(self._queue) - 1
+
+    def remove_from_queue(self, user_id, end_time=None):
+        end_time = end_time or datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            index = self._queue_index.get(user_id)
+            if index is None:
+                return None
+            entry = self._queue[index]
+            self.store.end_queued(entry, end_time)
+            self._record(DEQUEUE, user_id, entry.id, end_time)
+            self._remove_queued(user_id)
+            self._changed(DEQUEUED, entry)
+            return entry
+
+    def _changed(self, event, entry):
+        if self.listener is not None:
+            self.listener(self, event, entry)
+
+    def _append_to_queue(self, entry):
+        self._queue_index[entry.user_id] = len(self._queue)
+        self._queue.append(entry)
+
+    def _remove_queued(self, user_id):
+        index = self._queue_index.pop(user_id)
+        del self._queue[index]
+        for later in self._queue[index:]:
+            self._queue_index[later.user_id] -= 1
+
+    #
+    # Pool
+    #
+
+    def pooled_users(self, owner_id):
+        with self._lock:
+            return list(self._pools.get(owner_id, {}).values())
+
+    def pooled_entry(self, user_id):
+        with self._lock:
+            return self._pooled.get(user_id)
+
+    def add_to_pool(self, owner_id, user_id):
+        now = datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            entry = self.store.start_pooled(self.hat, owner_id, user_id)
+            rollups.record_pool(self.store, user_id)
+            self._record(POOL, user_id, entry.id, now, owner_id)
+            self._add_pooled(entry)
+            return entry
+
+    def remove_from_pool(self, user_id, end_time=None):
+        end_time = end_time or datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            entry = self._pooled.get(user_id)
+            if entry is None:
+                return None
+            self.store.end_pooled(entry, end_time)
+            self._record(UNPOOL, user_id, entry.id, end_time, entry.owner_user_id)
+            self._remove_pooled(user_id)
+            return entry
+
+    def clear_pool(self, owner_id, end_time=None):
+        end_time = end_time or datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            self.store.end_pool(self.hat, owner_id, end_time)
+            self._record(POOL_CLEAR, owner_id, None, end_time)
+            self._clear_pooled(owner_id)
+
+    def change_pool_owner(self, current_owner_id, new_owner_id):
+        now = datetime.now(tz=pytz.utc)
+        with self._lock, self.store.transaction():
+            self.store.move_pool(self.hat, current_owner_id, new_owner_id)
+            self._record(POOL_MOVE, new_owner_id, None, now, current_owner_id)
+            self._move_pool(current_owner_id, new_owner_id)
+
+    def _add_pooled(self, entry):
+        self._pools.setdefault(entry.owner_user_id, OrderedDict())[entry.user_id] = entry
+        self._pooled[entry.user_id] = entry
+
+    def _remove_pooled(self, user_id):
+        entry = self._pooled.pop(user_id)
+        pool = self._pools[entry.owner_user_id]
+        del pool[user_id]
+        if not pool:
+            del self._pools[entry.owner_user_id]
+
+    def _clear_pooled(self, owner_id):
+        for user_id in self._pools.pop(owner_id, {}):
+            del self._pooled[user_id]
+
+    def _move_pool(self, current_owner_id, new_owner_id):
+        moved = self._pools.pop(current_owner_id, {})
+        for entry in moved.values():
+            entry.owner_user_id = new_owner_id
+        self._pools.setdefault(new_owner_id, OrderedDict()).update(moved)
+
+    #
+    # Journal
+    #
+
+    def _record(self, kind, user_id, entry_id, time, other_user_id=None):
+        """
+            Appends the change to the journal, in the transaction making it
+        """
+        self.store.record_event(self.hat, kind, user_id, other_user_id, entry_id, time,
+                                metrics.current_command(), receipts.current_key())
+
+    def replay(self, event):
+        """
+            Applies a journal event to the in-memory state only
+        """
+        with self._lock:
+            kind = event.kind
+            if kind == ON:
+                self.owner = HatLog(id=event.entry_id, hat=self.hat, user_id=event.user_id,
+                                    start_time=from_epoch_us(event.time))
+            elif kind == OFF:
+                self.owner = None
+            elif kind == QUEUE:
+                self._append_to_queue(HatQueue(id=event.entry_id, hat=self.hat,
+                                               user_id=event.user_id,
+                                               start_time=from_epoch_us(event.time)))
+            elif kind == DEQUEUE:
+                self._remove_queued(event.user_id)
+            elif kind == POOL:
+                self._add_pooled(HatPool(id=event.entry_id, hat=self.hat,
+                                         owner_user_id=event.other_user_id,
+                                         user_id=event.user_id))
+            elif kind == UNPOOL:
+                self._remove_pooled(event.user_id)
+            elif kind == POOL_CLEAR:
+                self._clear_pooled(event.user_id)
+            elif kind == POOL_MOVE:
+                self._move_pool(event.other_user_id, event.user_id)
+            else:
+                raise ValueError('Unknown hat event {}'.format(kind))
+
+    #
+    # Consistency
+    #
+
+    def check(self):
+        """
+            Compares the in-memory state against a fresh load from the store and
+            returns a list of the differences (empty if they match).
+        """
+        stored = HatState.load(self.hat, self.store)
+        problems = []
+        with self._lock:
+            owner = self.owner.user_id if self.owner else None
+            stored_owner = stored.owner.user_id if stored.owner else None
+            if owner != stored_owner:
+                problems.append('owner is {} in memory but {} in the database'.format(
+                    owner, stored_owner))
+
+            queue = [entry.user_id for entry in self._queue]
+            stored_queue = [entry.user_id for entry in stored._queue]
+            if queue != stored_queue:
+                problems.append('queue is {} in memory but {} in the database'.format(
+                    queue, stored_queue))
+
+            pooled = dict((user_id, entry.owner_user_id)
+                          for user_id, entry in self._pooled.items())
+            stored_pooled = dict((user_id, entry.owner_user_id)
+                                 for user_id, entry in stored._pooled.items())
+            if pooled != stored_pooled:
+                problems.append('pool is {} in memory but {} in the database'.format(
+                    pooled, stored_pooled))
+        return problems
+
+
+class HatStates(object):
+    """
+        Every hat's HatState by hat name. Looking up a hat is a dict lookup, so the cost
+        of a command doesn't depend on how many hats there are.
+    """
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else storage.default_store()
+        self._lock = threading.Lock()
+        self._states = {}
+        # Passed on to every HatState; see HatState
+        self.listener = None
+        # The last journal event applied, for states rebuilt from the journal
+        self.event_id = None
+
+    @classmethod
+    def load(cls, hat=None, store=None):
+        """
+            Loads the state of every hat with open entries in the store (or just the
+            given hat)
+        """
+        store = store if store is not None else storage.default_store()
+        owners, queued, pooled = store.open_entries(hat)
+        return cls.from_entries(owners, queued, pooled, store)
+
+    @classmethod
+    def from_entries(cls, owners, queued, pooled, store=None):
+        """
+            Builds the states from open HatLog entries (newest first), HatQueue entries
+            (in queue order) and HatPool entries (in the order they joined)
+        """
+        states = cls(store)
+        for entry in owners:
+            # Oldest wins if a hat somehow has more than one owner
+            states.get(entry.hat).owner = entry
+        for entry in queued:
+            states.get(entry.hat)._append_to_queue(entry)
+        for entry in pooled:
+            states.get(entry.hat)._add_pooled(entry)
+        return states
+
+    def entries(self):
+        """
+            Returns (owners, queued, pooled): every hat's open entries, in the orders
+            from_entries() takes them
+        """
+        owners, queued, pooled = [], [], []
+        for hat in self.hats():
+            state = self.get(hat)
+            with state._lock:
+                if state.owner is not None:
+                    owners.append(state.owner)
+                queued.extend(state._queue)
+                pooled.extend(state._pooled.values())
+        pooled.sort(key=lambda entry: entry.id)
+        return owners, queued, pooled
+
+    def to_rows(self):
+        """
+            The open entries as plain lists, for saving as JSON; from_rows() reverses it
+        """
+        owners, queued, pooled = self.entries()
+        return {
+            'owners': [[entry.id, entry.hat, entry.user_id, to_epoch_us(entry.start_time)]
+                       for entry in owners],
+            'queued': [[entry.id, entry.hat, entry.user_id, to_epoch_us(entry.start_time)]
+                       for entry in queued],
+            'pooled': [[entry.id, entry.hat, entry.owner_user_id, entry.user_id]
+                       for entry in pooled],
+        }
+
+    @classmethod
+    def from_rows(cls, rows, store=None):
+        return cls.from_entries(
+            [HatLog(id=row_id, hat=hat, user_id=user_id, start_time=from_epoch_us(start_time))
+             for row_id, hat, user_id, start_time in rows['owners']],
+            [HatQueue(id=row_id, hat=hat, user_id=user_id, start_time=from_epoch_us(start_time))
+             for row_id, hat, user_id, start_time in rows['queued']],
+            [HatPool(id=row_id, hat=hat, owner_user_id=owner_user_id, user_id=user_id)
+             for row_id, hat, owner_user_id, user_id in rows['pooled']], store)
+
+    def replay(self, events):
+        """
+            Applies journal events, in order, to the in-memory states
+        """
+        for event in events:
+            self.get(event.hat).replay(event)
+        return self
+
+    def get(self, hat):
+        state = self._states.get(hat)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(hat, HatState(hat, self._notify, self.store))
+        return state
+
+    def hats(self):
+        return list(self._states)
+
+    def _notify(self, state, event, entry):
+        if self.listener is not None:
+            self.listener(state, event, entry)
@@ -0,0 +1,60 @@
+"""
+    Where the hats, their history and the users are kept. HatState, HatCommand, the
+    user directory and the reminders go through a store rather than the peewee models,
+    so the same bot runs on SQLite ('sqlite', bot.storage.sql) or entirely in memory
+    ('memory', bot.storage.memory), as picked by the STORAGE setting.
+
+    A store has:
+
+    - atomic(): a transaction, as a context manager. They nest, and an inner one that
+      fails is undone without undoing the outer one.
+    - transaction(): joins the transaction open on this thread, or opens one
+    - start_hold(hat, user_id, start_time), start_queued(hat, user_id, start_time) and
+      start_pooled(hat, owner_user_id, user_id), which return the new HatLog, HatQueue
+      or HatPool entry; end_hold(entry, end_time), end_queued(entry, end_time) and
+      end_pooled(entry, end_time), which also set the entry's end_time
+    - end_pool(hat, owner_user_id, end_time) and move_pool(hat, current_owner_id,
+      new_owner_id), for a whole pool at once
+    - open_entries(hat=None): (owners, queued, pooled), the entries not yet ended, for
+      one hat or all of them. Owners come newest first, the queue in queue order and
+      the pool in the order they joined.
+    - record_event(hat, kind, user_id, other_user_id, entry_id, time, cause,
+      command_key) appends to the journal, and events(after_id=0) reads it back as
+      bot.journal.Event tuples
+    - take_snapshot(states) saves the states as of the latest event, returning its id
+      (or None if there's been no event since the last one), and latest_snapshot()
+      gives (event_id, rows) or (None, None). The memory store keeps only the latest
+      snapshot and drops the events it covers, so it doesn't grow without bound.
+    - increment(metric, bucket, amount=1) and count(metric, bucket), for the counters
+      in bot.rollups
+    - user_info(user_id) returns the SlackUserInfo or None; save_user(user_id, name),
+      save_users(names), users_after(after_id) giving (id, user_id, name) in id order,
+      and tip(user_id)
+    - run_once(key, function, *args) and prune_receipts(older_than), for the command
+      receipts in bot.receipts
+    - db: the peewee database, or None. Reports, exports, archiving and replication
+      work on the database directly, so they need one.
+
+    tests/test_storage.py checks that the stores behave the same.
+"""
+from functools import lru_cache
+
+
+def make_store(name):
+    if name == 'sqlite':
+        from bot.storage.sql import SqlStore
+        return SqlStore()
+    if name == 'memory':
+        from bot.storage.memory import MemoryStore
+        return MemoryStore()
+    raise ValueError('Unknown STORAGE {}'.format(name))
+
+
+@lru_cache(maxsize=None)
+def default_store():
+    """
+        The store named by the STORAGE setting: 'sqlite' (the default) or 'memory'
+    """
+    # Not imported up top, so the bench and tests can set up settings first
+    from bot import settings
+    return make_store(getattr(settings, 'STORAGE', 'sqlite'))
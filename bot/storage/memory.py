@@ -0,0 +1,338 @@
+"""
+    A store that keeps everything in this process, in dicts and sorted lists. Nothing
+    touches the disk, so it is as fast as the bot can go, and everything is gone when
+    the bot stops: it suits the bench, trying the bot out and deployments that can live
+    with the hats being reset on a restart.
+
+    Only open entries are kept; the history that outlives them is the counters and the
+    journal since its latest snapshot, which is all the bot reads back of it.
+    Transactions behave like the database's: each thread keeps a log of how to undo
+    what it changed, and a transaction that fails is undone from it. Changes are seen
+    by other threads before they commit, which is no worse than HatState, whose
+    changes are seen as soon as they are made.
+"""
+import bisect
+import itertools
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytz
+
+from bot import receipts
+from bot.journal import Event
+from bot.models import HatLog, HatQueue, HatPool, SlackUserInfo, from_epoch_us, to_epoch_us
+
+
+class MemoryStore(object):
+    """
+        Keeps everything in memory. See bot.storage for what a store does.
+    """
+
+    db = None
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Per thread, a list of undo actions for each transaction open on it
+        self._local = threading.local()
+        self._ids = dict((table, itertools.count(1))
+                         for table in ('hold', 'queued', 'pooled', 'event', 'user'))
+        # id -> (hat, user_id, start_time) of each open HatLog and HatQueue entry
+        self._holds = {}
+        self._queued = {}
+        # (start_time, id) of the open HatQueue entries, in queue order
+        self._queue_order = []
+        # id -> (hat, owner_user_id, user_id) of each open HatPool entry
+        self._pooled = {}
+        # the open HatPool ids in the order they joined, and by (hat, owner_user_id)
+        self._pool_order = []
+        self._pools = {}
+        # The journal since the latest snapshot, and the event ids, to bisect on
+        self._events = []
+        self._event_ids = []
+        # (event_id, rows) of the latest snapshot, or (None, None)
+        self._snapshot = (None, None)
+        # (metric, bucket) -> value
+        self._counts = {}
+        # user_id -> [id, name, tip], in id order
+        self._users = OrderedDict()
+        # key -> (time, JSON reply), oldest first
+        self._receipts = OrderedDict()
+
+    def _undo_log(self):
+        if not hasattr(self._local, 'undo'):
+            self._local.undo = []
+        return self._local.undo
+
+    def _changed(self, undo):
+        """
+            Remembers how to undo a change, if it was made in a transaction
+        """
+        log = self._undo_log()
+        if log:
+            log[-1].append(undo)
+
+    @contextmanager
+    def atomic(self):
+        log = self._undo_log()
+        log.append([])
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                for undo in reversed(log.pop()):
+                    undo()
+            raise
+        done = log.pop()
+        if log:
+            # Undone along with the outer transaction, if that fails
+            log[-1].extend(done)
+
+    @contextmanager
+    def transaction(self):
+        if self._undo_log():
+            yield
+        else:
+            with self.atomic():
+                yield
+
+    #
+    # Hats
+    #
+
+    def start_hold(self, hat, user_id, start_time):
+        start_time = to_epoch_us(start_time)
+        with self._lock:
+            entry_id = next(self._ids['hold'])
+            self._holds[entry_id] = (hat, user_id, start_time)
+        self._changed(lambda: self._holds.pop(entry_id))
+        return self._hold(entry_id, (hat, user_id, start_time))
+
+    def end_hold(self, entry, end_time):
+        entry.end_time = end_time
+        with self._lock:
+            row = self._holds.pop(entry.id, None)
+        if row is not None:
+            self._changed(lambda: self._holds.__setitem__(entry.id, row))
+
+    def start_queued(self, hat, user_id, start_time):
+        start_time = to_epoch_us(start_time)
+        with self._lock:
+            entry_id = next(self._ids['queued'])
+            self._add_queued(entry_id, (hat, user_id, start_time))
+        self._changed(lambda: self._remove_queued(entry_id))
+        return self._queue_entry(entry_id, (hat, user_id, start_time))
+
+    def end_queued(self, entry, end_time):
+        entry.end_time = end_time
+        with self._lock:
+            row = self._remove_queued(entry.id)
+        if row is not None:
+            self._changed(lambda: self._add_queued(entry.id, row))
+
+    def start_pooled(self, hat, owner_user_id, user_id):
+        with self._lock:
+            entry_id = next(self._ids['pooled'])
+            self._add_pooled(entry_id, (hat, owner_user_id, user_id))
+        self._changed(lambda: self._remove_pooled(entry_id))
+        return self._pool_entry(entry_id, (hat, owner_user_id, user_id))
+
+    def end_pooled(self, entry, end_time):
+        entry.end_time = end_time
+        with self._lock:
+            row = self._remove_pooled(entry.id)
+        if row is not None:
+            self._changed(lambda: self._add_pooled(entry.id, row))
+
+    def end_pool(self, hat, owner_user_id, end_time):
+        with self._lock:
+            ended = [(entry_id, self._remove_pooled(entry_id))
+                     for entry_id in list(self._pools.get((hat, owner_user_id), ()))]
+
+        def undo():
+            for entry_id, row in ended:
+                self._add_pooled(entry_id, row)
+        self._changed(undo)
+
+    def move_pool(self, hat, current_owner_id, new_owner_id):
+        with self._lock:
+            moved = list(self._pools.get((hat, current_owner_id), ()))
+            self._set_pool_owner(moved, new_owner_id)
+        self._changed(lambda: self._set_pool_owner(moved, current_owner_id))
+
+    def open_entries(self, hat=None):
+        with self._lock:
+            owners = [self._hold(entry_id, row) for entry_id, row in self._holds.items()
+                      if hat is None or row[0] == hat]
+            queued = [self._queue_entry(entry_id, self._queued[entry_id])
+                      for _, entry_id in self._queue_order
+                      if hat is None or self._queued[entry_id][0] == hat]
+            pooled = [self._pool_entry(entry_id, self._pooled[entry_id])
+                      for entry_id in self._pool_order
+                      if hat is None or self._pooled[entry_id][0] == hat]
+        owners.sort(key=lambda entry: (entry.start_time, entry.id), reverse=True)
+        return owners, queued, pooled
+
+    def _hold(self, entry_id, row):
+        hat, user_id, start_time = row
+        return HatLog(id=entry_id, hat=hat, user_id=user_id,
+                      start_time=from_epoch_us(start_time))
+
+    def _queue_entry(self, entry_id, row):
+        hat, user_id, start_time = row
+        return HatQueue(id=entry_id, hat=hat, user_id=user_id,
+                        start_time=from_epoch_us(start_time))
+
+    def _pool_entry(self, entry_id, row):
+        hat, owner_user_id, user_id = row
+        return HatPool(id=entry_id, hat=hat, owner_user_id=owner_user_id, user_id=user_id)
+
+    def _add_queued(self, entry_id, row):
+        self._queued[entry_id] = row
+        bisect.insort(self._queue_order, (row[2], entry_id))
+
+    def _remove_queued(self, entry_id):
+        row = self._queued.pop(entry_id, None)
+        if row is not None:
+            del self._queue_order[bisect.bisect_left(self._queue_order, (row[2], entry_id))]
+        return row
+
+    def _add_pooled(self, entry_id, row):
+        hat, owner_user_id, _ = row
+        self._pooled[entry_id] = row
+        bisect.insort(self._pool_order, entry_id)
+        self._pools.setdefault((hat, owner_user_id), set()).add(entry_id)
+
+    def _remove_pooled(self, entry_id):
+        row = self._pooled.pop(entry_id, None)
+        if row is not None:
+            hat, owner_user_id, _ = row
+            del self._pool_order[bisect.bisect_left(self._pool_order, entry_id)]
+            pool = self._pools[hat, owner_user_id]
+            pool.discard(entry_id)
+            if not pool:
+                del self._pools[hat, owner_user_id]
+        return row
+
+    def _set_pool_owner(self, entry_ids, owner_user_id):
+        for entry_id in entry_ids:
+            hat, _, user_id = self._remove_pooled(entry_id)
+            self._add_pooled(entry_id, (hat, owner_user_id, user_id))
+
+    #
+    # History
+    #
+
+    def record_event(self, hat, kind, user_id, other_user_id, entry_id, time, cause,
+                     command_key):
+        with self._lock:
+            event = Event(next(self._ids['event']), hat, kind, user_id, other_user_id,
+                          entry_id, to_epoch_us(time), cause, command_key)
+            self._events.append(event)
+            self._event_ids.append(event.id)
+        self._changed(lambda: self._remove_event(event.id))
+
+    def events(self, after_id=0):
+        with self._lock:
+            return self._events[bisect.bisect_right(self._event_ids, after_id):]
+
+    def take_snapshot(self, states):
+        with self._lock:
+            event_id = self._event_ids[-1] if self._event_ids else self._snapshot[0] or 0
+            if self._snapshot[0] is not None and self._snapshot[0] >= event_id:
+                return None
+            self._snapshot = (event_id, states.to_rows())
+            # The snapshot stands in for the events up to it
+            del self._events[:]
+            del self._event_ids[:]
+        return event_id
+
+    def latest_snapshot(self):
+        with self._lock:
+            return self._snapshot
+
+    def _remove_event(self, event_id):
+        index = bisect.bisect_left(self._event_ids, event_id)
+        if index < len(self._event_ids) and self._event_ids[index] == event_id:
+            del self._events[index]
+            del self._event_ids[index]
+
+    def increment(self, metric, bucket, amount=1):
+        with self._lock:
+            self._add_count((metric, bucket), amount)
+        self._changed(lambda: self._add_count((metric, bucket), -amount))
+
+    def count(self, metric, bucket):
+        with self._lock:
+            return self._counts.get((metric, bucket), 0)
+
+    def _add_count(self, key, amount):
+        self._counts[key] = self._counts.get(key, 0) + amount
+
+    #
+    # Users
+    #
+
+    def user_info(self, user_id):
+        with self._lock:
+            row = self._users.get(user_id)
+            if row is None:
+                return None
+            user_info_id, name, tip = row
+        return SlackUserInfo(id=user_info_id, user_id=user_id, name=name, tip=tip)
+
+    def save_user(self, user_id, name):
+        with self._lock:
+            row = self._users.get(user_id)
+            if row is None:
+                self._users[user_id] = [next(self._ids['user']), name, 0]
+                self._changed(lambda: self._users.pop(user_id))
+            else:
+                old_name, row[1] = row[1], name
+                self._changed(lambda: row.__setitem__(1, old_name))
+
+    def save_users(self, names):
+        with self.atomic(), self._lock:
+            for user_id, name in names.items():
+                self.save_user(user_id, name)
+
+    def users_after(self, after_id):
+        with self._lock:
+            return [(user_info_id, user_id, name)
+                    for user_id, (user_info_id, name, _) in self._users.items()
+                    if user_info_id > after_id]
+
+    def tip(self, user_id):
+        with self._lock:
+            row = self._users.get(user_id)
+            if row is None:
+                return
+            row[2] += 1
+        self._changed(lambda: row.__setitem__(2, row[2] - 1))
+
+    #
+    # Receipts
+    #
+
+    def run_once(self, key, function, *args):
+        with self._lock:
+            receipt = self._receipts.get(key)
+        if receipt is not None:
+            return json.loads(receipt[1])
+        with receipts.carrying_out(key):
+            response = function(*args)
+        with self._lock:
+            self._receipts[key] = (to_epoch_us(datetime.now(tz=pytz.utc)), json.dumps(response))
+        self._changed(lambda: self._receipts.pop(key, None))
+        return response
+
+    def prune_receipts(self, older_than, batch_size=1000):
+        cutoff = to_epoch_us(older_than)
+        deleted = 0
+        with self._lock:
+            while self._receipts and next(iter(self._receipts.values()))[0] < cutoff:
+                self._receipts.popitem(last=False)
+                deleted += 1
+        return deleted
@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+
+from bot import receipts
+from bot.models import db, HatLog, HatQueue, HatPool, SlackUserInfo, StatRollup, to_epoch_us
+
+RECORD_EVENT = ('INSERT INTO "hat_event" ("hat", "kind", "user_id", "other_user_id", '
+                '"entry_id", "time", "cause", "command_key") VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+class SqlStore(object):
+    """
+        Keeps everything in the bot's SQLite database, through the peewee models. See
+        bot.storage for what a store does.
+    """
+
+    def __init__(self):
+        self.db = db
+
+    def atomic(self):
+        return self.db.atomic()
+
+    @contextmanager
+    def transaction(self):
+        """
+            A transaction for a change made outside of one. Commands already run in a
+            transaction, and a savepoint around each change would only add statements.
+        """
+        if self.db.transaction_depth():
+            yield
+        else:
+            with self.db.atomic():
+                yield
+
+    #
+    # Hats
+    #
+
+    def start_hold(self, hat, user_id, start_time):
+        return HatLog.create(hat=hat, user_id=user_id, start_time=start_time)
+
+    def end_hold(self, entry, end_time):
+        entry.end_time = end_time
+        entry.save()
+
+    def start_queued(self, hat, user_id, start_time):
+        return HatQueue.create(hat=hat, user_id=user_id, start_time=start_time)
+
+    def end_queued(self, entry, end_time):
+        entry.end_time = end_time
+        entry.save()
+
+    def start_pooled(self, hat, owner_user_id, user_id):
+        return HatPool.create(hat=hat, owner_user_id=owner_user_id, user_id=user_id)
+
+    def end_pooled(self, entry, end_time):
+        entry.end_time = end_time
+        entry.save()
+
+    def end_pool(self, hat, owner_user_id, end_time):
+        HatPool.update(end_time=end_time).where(HatPool.hat == hat,
+                                                HatPool.owner_user_id == owner_user_id,
+                                                HatPool.end_time.is_null(True)).execute()
+
+    def move_pool(self, hat, current_owner_id, new_owner_id):
+        HatPool.update(owner_user_id=new_owner_id).where(
+            HatPool.hat == hat, HatPool.owner_user_id == current_owner_id,
+            HatPool.end_time.is_null(True)).execute()
+
+    def open_entries(self, hat=None):
+        """
+            Loads the open entries of every hat (or just the given hat) using one query
+            per table
+        """
+        def scoped(model, query):
+            return query.where(model.hat == hat) if hat is not None else query
+
+        owners = scoped(HatLog, HatLog.select().where(HatLog.end_time.is_null(True))
+                        ).order_by(HatLog.start_time.desc())
+        queued = scoped(HatQueue, HatQueue.select().where(HatQueue.end_time.is_null(True))
+                        ).order_by(HatQueue.start_time)
+        pooled = scoped(HatPool, HatPool.select().where(HatPool.end_time.is_null(True))
+                        ).order_by(HatPool.id)
+        return list(owners), list(queued), list(pooled)
+
+    #
+    # History
+    #
+
+    def record_event(self, hat, kind, user_id, other_user_id, entry_id, time, cause,
+                     command_key):
+        self.db.execute_sql(RECORD_EVENT, (hat, kind, user_id, other_user_id, entry_id,
+                                           to_epoch_us(time), cause, command_key))
+
+    def events(self, after_id=0):
+        from bot.journal import events_after
+        return events_after(self.db, after_id)
+
+    def take_snapshot(self, states):
+        from bot.journal import take_snapshot
+        return take_snapshot(self.db, states)
+
+    def latest_snapshot(self):
+        from bot.journal import latest_snapshot
+        return latest_snapshot(self.db)
+
+    def increment(self, metric, bucket, amount=1):
+        StatRollup.insert(metric=metric, bucket=bucket, value=0).on_conflict('IGNORE').execute()
+        StatRollup.update(value=StatRollup.value + amount).where(
+            StatRollup.metric == metric, StatRollup.bucket == bucket).execute()
+
+    def count(self, metric, bucket):
+        row = StatRollup.select(StatRollup.value).where(
+            StatRollup.metric == metric, StatRollup.bucket == bucket).tuples().first()
+        return row[0] if row else 0
+
+    #
+    # Users
+    #
+
+    def user_info(self, user_id):
+        return SlackUserInfo.select().where(SlackUserInfo.user_id == user_id).first()
+
+    def save_user(self, user_id, name):
+        updated = SlackUserInfo.update(name=name).where(SlackUserInfo.user_id == user_id).execute()
+        if not updated:
+            SlackUserInfo.create(user_id=user_id, name=name)
+
+    def save_users(self, names):
+        with self.db.atomic():
+            stored = dict(SlackUserInfo.select(SlackUserInfo.user_id, SlackUserInfo.name).tuples())
+            for user_id, name in names.items():
+                if user_id in stored and stored[user_id] != name:
+                    SlackUserInfo.update(name=name).where(
+                        SlackUserInfo.user_id == user_id).execute()
+            new_users = [{'user_id': user_id, 'name': name}
+                         for user_id, name in names.items() if user_id not in stored]
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(new_users), 100):
+                SlackUserInfo.insert_many(new_users[start:start + 100]).execute()
+
+    def users_after(self, after_id):
+        return list(SlackUserInfo.select(SlackUserInfo.id, SlackUserInfo.user_id,
+                                         SlackUserInfo.name).where(
+            SlackUserInfo.id > after_id).order_by(SlackUserInfo.id).tuples())
+
+    def tip(self, user_id):
+        # Incremented in SQL, so no tip is lost to a concurrent read-modify-write
+        SlackUserInfo.update(tip=SlackUserInfo.tip + 1).where(
+            SlackUserInfo.user_id == user_id).execute()
+
+    #
+    # Receipts
+    #
+
+    def run_once(self, key, function, *args):
+        return receipts.run_once(self.db, key, function, *args)
+
+    def prune_receipts(self, older_than, batch_size=1000):
+        return receipts.prune(self.db, older_than, batch_size)
@@ -0,0 +1,5 @@
+"""
+    Where Slack events come from. A transport's connect() returns whether it is ready,
+    and read(timeout) blocks until events arrive (or the timeout passes) and returns
+    them as a list of Slack event dicts.
+"""
@@ -0,0 +1,175 @@
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue, Empty, Full
+
+logger = logging.getLogger(__name__)
+
+# Slack rejects a request whose timestamp is further than this from now, and so do we
+MAX_REQUEST_AGE = 300
+
+
+def sign(signing_secret, timestamp, body):
+    """
+        The X-Slack-Signature Slack sends with a request body
+    """
+    base = b'v0:' + str(timestamp).encode('utf-8') + b':' + body
+    return 'v0=' + hmac.new(signing_secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+
+
+def verify(signing_secret, timestamp, body, signature, now=None):
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except (TypeError, ValueError):
+        return False
+    if age > MAX_REQUEST_AGE or not signature:
+        return False
+    return hmac.compare_digest(sign(signing_secret, timestamp, body), signature)
+
+
+class EventsApiTransport(object):
+    """
+        Receives Events API requests over HTTP. Each request is verified and queued,
+        and acknowledged straight away; read() hands the queued events to the bot.
+        The queue is bounded: when it stays full for enqueue_timeout seconds the
+        request gets a 503 with Retry-After, so Slack redelivers it later instead of
+        us dropping it or acking late. Requests are handled by a fixed pool of
+        `workers` threads.
+    """
+
+    def __init__(self, signing_secret, port, host='0.0.0.0', path='/slack/events',
+                 max_queue=1000, enqueue_timeout=1.0, workers=8, retry_after=1):
+        self.signing_secret = signing_secret
+        self.port = port
+        self.host = host
+        self.path = path
+        self.enqueue_timeout = enqueue_timeout
+        self.workers = workers
+        self.retry_after = retry_after
+        self._queue = Queue(maxsize=max_queue)
+        self._server = None
+        self.accepted = 0
+        self.rejected = 0
+        self.invalid = 0
+
+    def connect(self):
+        self._server = _PooledHTTPServer((self.host, self.port), _EventsHandler, self.workers)
+        self._server.transport = self
+        # Port 0 picks a free port; report the real one
+        self.port = self._server.server_port
+        thread = threading.Thread(target=self._server.serve_forever, name='events-api')
+        thread.daemon = True
+        thread.start()
+        logger.info('Receiving Slack events on http://%s:%d%s', self.host, self.port, self.path)
+        return True
+
+    def read(self, timeout=5, max_batch=100):
+        try:
+            events = [self._queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(events) < max_batch:
+            try:
+                events.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return events
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def register_metrics(self, registry):
+        registry.callback('hatman_events_queue_depth', 'Received events waiting to be handled',
+                          'gauge', self.queue_depth)
+        for name in ('accepted', 'rejected', 'invalid'):
+            registry.callback('hatman_events_{}'.format(name), 'Events API requests {}'.format(name),
+                              'counter', lambda name=name: getattr(self, name))
+
+    def receive(self, headers, body):
+        """
+            Handles one request. Returns (status, headers, body).
+        """
+        if not verify(self.signing_secret, headers.get('X-Slack-Request-Timestamp'), body,
+                      headers.get('X-Slack-Signature')):
+            self.invalid += 1
+            return 401, {}, b''
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.invalid += 1
+            return 400, {}, b''
+
+        if payload.get('type') == 'url_verification':
+            return 200, {'Content-Type': 'text/plain'}, payload.get('challenge', '').encode('utf-8')
+        if payload.get('type') != 'event_callback' or 'event' not in payload:
+            return 200, {}, b''
+
+        try:
+            self._queue.put(payload['event'], timeout=self.enqueue_timeout)
+        except Full:
+            self.rejected += 1
+            logger.warning('Event queue is full, asking Slack to retry %s',
+                           payload.get('event_id'))
+            return 503, {'Retry-After': str(self.retry_after)}, b''
+        self.accepted += 1
+        return 200, {}, b''
+
+
+class _PooledHTTPServer(HTTPServer):
+    """
+        Handles requests on a fixed pool of threads rather than a thread per request
+    """
+    # Room for a burst of connections to wait for a thread instead of being refused
+    request_queue_size = 128
+
+    def __init__(self, address, handler, workers):
+        HTTPServer.__init__(self, address, handler)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self._pool.shutdown(wait=False)
+
+
+class _EventsHandler(BaseHTTPRequestHandler):
+    # Don't let a slow client hold one of the pool's threads
+    timeout = 10
+
+    def do_POST(self):
+        if self.path.split('?')[0] != self.server.transport.path:
+            self._respond(404, {}, b'')
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._respond(*self.server.transport.receive(self.headers, body))
+
+    def _respond(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
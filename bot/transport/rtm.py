@@ -0,0 +1,68 @@
+import logging
+import select
+import time
+
+READ_WEBSOCKET_TIMEOUT = 5  # max seconds to block waiting for a frame
+MAX_RECONNECT_DELAY = 60  # seconds between reconnection attempts, at most
+
+logger = logging.getLogger(__name__)
+
+
+class RtmTransport(object):
+    """
+        The legacy RTM websocket, through slackclient's rtm_connect/rtm_read. When the
+        connection drops, or Slack says goodbye, it reconnects with backoff. Messages
+        sent around a reconnect can arrive twice; the read loop drops the repeats.
+    """
+
+    def __init__(self, slack_client, sleep=time.sleep):
+        self.slack_client = slack_client
+        self.sleep = sleep
+        self.reconnects = 0
+
+    def connect(self):
+        return self.slack_client.rtm_connect()
+
+    def reconnect(self):
+        """
+            Connects again, waiting longer after each failed attempt, until it works
+        """
+        delay = 1
+        while not self.slack_client.rtm_connect():
+            logger.warning('Reconnecting to the RTM failed; trying again in %ds', delay)
+            self.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        self.reconnects += 1
+        logger.info('Reconnected to the RTM')
+
+    def read(self, timeout=READ_WEBSOCKET_TIMEOUT):
+        """
+            Blocks until the RTM websocket has a frame ready (or the timeout passes)
+            and returns every event that can be read without blocking again.
+        """
+        events = []
+        try:
+            sock = self.slack_client.server.websocket.sock
+            # SSL sockets may already hold decrypted frames that select can't see
+            pending = getattr(sock, 'pending', None)
+            if not (pending and pending()):
+                select.select([sock], [], [], timeout)
+
+            batch = self.slack_client.rtm_read()
+            while batch:
+                events.extend(batch)
+                batch = self.slack_client.rtm_read()
+        except Exception:
+            # The websocket library raises its own errors, OSError or ValueError for a
+            # closed socket, depending on where it notices
+            logger.warning('Lost the RTM connection', exc_info=True)
+            self.reconnect()
+            return events
+
+        if any(event.get('type') == 'goodbye' for event in events):
+            logger.info('Slack is closing the RTM connection')
+            self.reconnect()
+        return events
+
+    def close(self):
+        pass
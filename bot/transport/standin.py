@@ -0,0 +1,136 @@
+"""
+    A local stand-in for Slack's side of the Events API, for exercising the 'events'
+    transport without Slack.
+
+    python -m bot.transport.standin URL SIGNING_SECRET [--events N] [--concurrency N]
+
+    posts N signed app_mention events from the bench's mixed workload to URL, the way
+    Slack delivers them, and reports how quickly they were acknowledged.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bot.transport.events_api import sign
+
+# Slack gives up on a delivery that isn't acknowledged within this many seconds...
+ACK_DEADLINE = 3
+# ...and retries it this many times
+MAX_RETRIES = 3
+
+
+class StandInSlack(object):
+    """
+        Delivers events like Slack does: signed POSTs with a 3 second deadline, retried
+        up to three times (honouring Retry-After) when the ack is late or isn't a 200.
+    """
+
+    def __init__(self, url, signing_secret, team_id='TSTANDIN', backoff=1.0, pool_size=10):
+        self.url = url
+        self.signing_secret = signing_secret
+        self.team_id = team_id
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+        self._lock = threading.Lock()
+        self.ack_times = []
+        self.retries = 0
+        self.failures = 0
+
+    def post(self, payload, retry_num=None):
+        body = json.dumps(payload).encode('utf-8')
+        timestamp = str(int(time.time()))
+        headers = {'Content-Type': 'application/json',
+                   'X-Slack-Request-Timestamp': timestamp,
+                   'X-Slack-Signature': sign(self.signing_secret, timestamp, body)}
+        if retry_num is not None:
+            headers['X-Slack-Retry-Num'] = str(retry_num)
+            headers['X-Slack-Retry-Reason'] = 'http_error'
+        return self.session.post(self.url, data=body, headers=headers, timeout=ACK_DEADLINE)
+
+    def verify_url(self):
+        """
+            Sends the url_verification challenge Slack sends when the Request URL is set
+        """
+        challenge = uuid.uuid4().hex
+        response = self.post({'type': 'url_verification', 'challenge': challenge})
+        return response.status_code == 200 and response.text == challenge
+
+    def deliver(self, event):
+        """
+            Delivers one event, retrying like Slack. Returns whether it was acknowledged.
+        """
+        payload = {'type': 'event_callback', 'team_id': self.team_id, 'event': event,
+                   'event_id': 'Ev' + uuid.uuid4().hex[:10].upper(),
+                   'event_time': int(time.time())}
+        for attempt in range(MAX_RETRIES + 1):
+            started = time.time()
+            retry_after = self.backoff * 2 ** attempt
+            try:
+                response = self.post(payload, attempt or None)
+                if response.status_code == 200:
+                    with self._lock:
+                        self.ack_times.append(time.time() - started)
+                    return True
+                retry_after = float(response.headers.get('Retry-After', retry_after))
+            except requests.RequestException:
+                pass
+            if attempt < MAX_RETRIES:
+                with self._lock:
+                    self.retries += 1
+                time.sleep(retry_after)
+        with self._lock:
+            self.failures += 1
+        return False
+
+    def stats(self):
+        with self._lock:
+            ack_times = sorted(self.ack_times)
+
+        def percentile(fraction):
+            if not ack_times:
+                return None
+            return ack_times[min(len(ack_times) - 1, int(fraction * len(ack_times)))]
+
+        return {'acked': len(ack_times), 'retries': self.retries, 'failures': self.failures,
+                'ack_p50': percentile(0.5), 'ack_p99': percentile(0.99),
+                'ack_max': ack_times[-1] if ack_times else None}
+
+
+def as_app_mention(event):
+    event = dict(event)
+    event['type'] = 'app_mention'
+    return event
+
+
+if __name__ == "__main__":
+    from bot.bench import workloads
+
+    parser = argparse.ArgumentParser(prog='python -m bot.transport.standin')
+    parser.add_argument('url', help='e.g. http://localhost:3000/slack/events')
+    parser.add_argument('signing_secret')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--bot-id', default=workloads.BENCH_BOT_ID)
+    parser.add_argument('--channel', default=workloads.BENCH_CHANNEL_ID)
+    args = parser.parse_args()
+
+    slack = StandInSlack(args.url, args.signing_secret, pool_size=args.concurrency)
+    if not slack.verify_url():
+        raise SystemExit('{} failed the url_verification challenge'.format(args.url))
+    commands = workloads.generate('mixed', workloads.bench_users(args.users), args.events)
+    events = [as_app_mention(event) for event in
+              workloads.to_events(commands, args.channel, args.bot_id, start_ts=time.time())]
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(slack.deliver, events))
+    print('Delivered {} events in {:.3f}s: {}'.format(len(events), time.time() - started,
+                                                      slack.stats()))
@@ -0,0 +1,49 @@
+import re
+
+_TOKEN = re.compile(r'\S+')
+
+
+def tokenize(text):
+    """
+        Splits text on whitespace, returning (token, end offset) pairs so callers can
+        recover the untouched text that follows any token.
+    """
+    return [(match.group(), match.end()) for match in _TOKEN.finditer(text)]
+
+
+class TokenTrie(object):
+    """
+        Maps sequences of tokens to values. A lookup walks one token at a time, so it
+        costs O(tokens) no matter how many sequences are stored.
+    """
+
+    def __init__(self):
+        # Each node is a dict of token -> child node; the None key holds a node's value
+        self._root = {}
+
+    def insert(self, tokens, value):
+        """
+            Stores value under tokens and returns the value it replaced, if any
+        """
+        node = self._root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        previous = node.get(None)
+        node[None] = value
+        return previous
+
+    def longest_match(self, tokens, start=0):
+        """
+            Finds the longest stored sequence at the front of tokens[start:], where
+            tokens are (token, end offset) pairs from tokenize(). Returns (value, index
+            of the first unmatched token), or (None, start) if nothing matches.
+        """
+        node = self._root
+        value, end = node.get(None), start
+        for index in range(start, len(tokens)):
+            node = node.get(tokens[index][0])
+            if node is None:
+                break
+            if None in node:
+                value, end = node[None], index + 1
+        return value, end
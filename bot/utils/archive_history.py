@@ -0,0 +1,16 @@
+import sys
+from datetime import timedelta
+
+from bot import settings
+from bot.settings import database
+from bot.migrations import migrate
+from bot.archive import archive
+
+# Usage: python -m bot.utils.archive_history [days]
+# Archives closed history older than days (default ARCHIVE_AFTER_DAYS) in one go
+if __name__ == "__main__":
+    migrate(database)
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else getattr(settings, 'ARCHIVE_AFTER_DAYS', 30)
+    moved = archive(database, timedelta(days=days), getattr(settings, 'ARCHIVE_BATCH_SIZE', 500))
+    for table, count in moved.items():
+        print("Archived {} {} rows".format(count, table))
@@ -0,0 +1,13 @@
+from bot.settings import database
+from bot.migrations import migrate, check_query_plans
+
+if __name__ == "__main__":
+    migrate(database)
+    missing = 0
+    for name, plan, uses_index in check_query_plans(database):
+        if not uses_index:
+            missing += 1
+        print("{} {}: {}".format('ok  ' if uses_index else 'SCAN', name, '; '.join(plan)))
+    if missing:
+        print("{} hot queries do not use an index".format(missing))
+        raise SystemExit(1)
@@ -0,0 +1,37 @@
+import argparse
+import os
+import sys
+
+from bot.export import EXPORTS, FORMATS, export
+from bot.settings import database
+from bot.migrations import migrate
+
+# Usage: python -m bot.utils.export_history {hatlog,hatqueue,hatpool,users,events}
+#            [--format csv|jsonl] [--after ID] [--limit N] [--output FILE]
+#
+# Prints the id of the last row written; pass it back as --after to resume. With
+# --output, a resumed export is appended to the file.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m bot.utils.export_history')
+    parser.add_argument('name', choices=sorted(EXPORTS))
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--after', type=int, default=0, help='only rows with ids above this')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--output', help='file to write to, rather than stdout')
+    args = parser.parse_args()
+
+    migrate(database)
+    if args.output:
+        resuming = args.after > 0 and os.path.exists(args.output)
+        out = open(args.output, 'a' if resuming else 'w', newline='')
+    else:
+        resuming = False
+        out = sys.stdout
+    try:
+        count, last = export(database, args.name, out, args.format, args.after, args.limit,
+                             header=not resuming)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print('Exported {} {} rows; resume with --after {}'.format(count, args.name, last),
+          file=sys.stderr)
@@ -0,0 +1,79 @@
+import argparse
+import sys
+
+from bot import journal
+from bot.settings import database
+from bot.migrations import migrate
+from bot.state import HatStates
+
+# Usage:
+#   python -m bot.utils.hat_journal dump [--since ID] [--until ID] [--hat HAT] > hat.jsonl
+#   python -m bot.utils.hat_journal replay hat.jsonl [--until ID] [--verbose]
+#   python -m bot.utils.hat_journal verify
+
+
+def describe(states, hat):
+    state = states.get(hat)
+    owner = state.owner.user_id if state.owner else 'no one'
+    queue = ' '.join(entry.user_id for entry in state.queue_entries()) or '-'
+    pooled = state.pooled_users(state.owner.user_id) if state.owner else []
+    pool = ' '.join(entry.user_id for entry in pooled) or '-'
+    return '{}: owner {}, queue {}, pool {}'.format(hat, owner, queue, pool)
+
+
+def replay(path, until=None, verbose=False):
+    with open(path) as dump:
+        event_id, rows, events = journal.read_dump(dump)
+        states = HatStates.from_rows(rows)
+        if verbose:
+            print('snapshot at event {}'.format(event_id))
+            for hat in sorted(states.hats()):
+                print('  ' + describe(states, hat))
+        for event in events:
+            if until is not None and event.id > until:
+                break
+            states.get(event.hat).replay(event)
+            if verbose:
+                print('{} {} {} {}{} ({})'.format(
+                    event.id, event.hat, event.kind, event.user_id,
+                    ' ' + event.other_user_id if event.other_user_id else '', event.cause))
+                print('  ' + describe(states, event.hat))
+    return states
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m bot.utils.hat_journal')
+    commands = parser.add_subparsers(dest='command')
+    dump = commands.add_parser('dump', help='write the journal as JSON lines')
+    dump.add_argument('--since', type=int, help='start from the snapshot at or before this event')
+    dump.add_argument('--until', type=int)
+    dump.add_argument('--hat')
+    replay_parser = commands.add_parser('replay', help='replay a dump and print the state')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--until', type=int)
+    replay_parser.add_argument('--verbose', action='store_true',
+                               help='print each event and the state after it')
+    commands.add_parser('verify', help='check that the journal agrees with the tables')
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        migrate(database)
+        count = journal.dump(database, sys.stdout, args.since, args.until, args.hat)
+        print('Wrote {} events'.format(count), file=sys.stderr)
+    elif args.command == 'replay':
+        states = replay(args.path, args.until, args.verbose)
+        for hat in sorted(states.hats()):
+            print(describe(states, hat))
+    elif args.command == 'verify':
+        migrate(database)
+        restored = journal.restore(database)
+        stored = HatStates.load()
+        differences = [(hat, describe(restored, hat), describe(stored, hat))
+                       for hat in sorted(set(restored.hats()) | set(stored.hats()))
+                       if describe(restored, hat) != describe(stored, hat)]
+        for hat, from_journal, from_tables in differences:
+            print('journal {}\n tables {}'.format(from_journal, from_tables))
+        print('The journal {} the tables'.format('disagrees with' if differences else 'matches'))
+        sys.exit(1 if differences else 0)
+    else:
+        parser.print_help()
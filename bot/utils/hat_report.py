@@ -0,0 +1,24 @@
+import sys
+
+from bot.settings import database
+from bot.migrations import migrate
+from bot.report import DEFAULT_WINDOW, build_report, format_report, parse_window
+from bot.state import configured_hats
+
+# Usage: python -m bot.utils.hat_report [hat ...] [window, e.g. 30d, 12h, 8w]
+if __name__ == "__main__":
+    migrate(database)
+    window = DEFAULT_WINDOW
+    hats = []
+    for arg in sys.argv[1:]:
+        try:
+            parsed = parse_window(arg)
+        except ValueError as error:
+            sys.exit(error)
+        if parsed is not None:
+            window = parsed
+        else:
+            hats.append(arg)
+    for hat in hats or sorted(configured_hats()):
+        print(format_report(build_report(database, hat, window)))
+        print()
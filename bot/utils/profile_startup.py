@@ -0,0 +1,58 @@
+import subprocess
+import sys
+import time
+
+# Usage: python -m bot.utils.profile_startup [number of modules to list, default 15]
+#
+# Shows where starting the bot goes, short of talking to Slack: the slowest modules
+# to import (from python -X importtime) and how long the database and state take.
+
+
+def import_times():
+    """
+        Imports run_bot in a fresh interpreter. Returns [(module, self us, cumulative us)].
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import run_bot'],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(own), int(cumulative)))
+    return modules
+
+
+if __name__ == "__main__":
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    modules = import_times()
+    total = next(cumulative for name, own, cumulative in modules if name == 'run_bot')
+    print('import run_bot: {:.1f}ms'.format(total / 1000.0))
+    for name, own, cumulative in sorted(modules, key=lambda module: -module[1])[:top]:
+        print('  {:<40} {:7.1f}ms self {:7.1f}ms total'.format(name, own / 1000.0,
+                                                              cumulative / 1000.0))
+
+    from bot import settings, snapshot
+    from bot.migrations import current_version, latest_version
+    from bot.state import HatStates
+
+    started = time.perf_counter()
+    snapshot_file = getattr(settings, 'STATE_SNAPSHOT_FILE', None)
+    restored = snapshot.load(snapshot_file, settings.DB_FILE) if snapshot_file else None
+    if snapshot_file:
+        print('snapshot: {:.1f}ms ({})'.format(
+            (time.perf_counter() - started) * 1000,
+            'missing' if restored is None else
+            'users only' if restored.states is None else 'usable'))
+
+    started = time.perf_counter()
+    settings.database.connect()
+    if current_version(settings.database) != latest_version():
+        print('The database needs migrating; run the bot once first')
+        sys.exit(1)
+    print('schema check: {:.1f}ms'.format((time.perf_counter() - started) * 1000))
+
+    started = time.perf_counter()
+    states = HatStates.load()
+    print('hat state from the tables: {:.1f}ms ({} hats)'.format(
+        (time.perf_counter() - started) * 1000, len(states.hats())))
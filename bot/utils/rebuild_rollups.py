@@ -0,0 +1,7 @@
+from bot.settings import database
+from bot.migrations import migrate
+from bot.rollups import rebuild
+
+if __name__ == "__main__":
+    migrate(database)
+    print("Rebuilt {} stats rollups".format(rebuild(database)))
@@ -1,13 +1,26 @@
+import json
+import logging
+import signal
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-from collections import OrderedDict
+import pytz
 from slackclient import SlackClient
 
-from bot import settings
-from bot.models import HatLog, HatQueue, HatPool, SlackUserInfo
-from bot.commands.hat import HatCommand
-from bot.commands.example import ExampleCommand
+import bot.commands
+from bot import journal, metrics, receipts, render, replica, settings, snapshot, storage
+from bot.archive import Archiver
+from bot.dedup import RecentEvents, event_key
+from bot.directory import UserDirectory
+from bot.engine import FUN, QUERY, STATE, CommandEngine, Overloaded
+from bot.migrations import latest_version, migrate
+from bot.outbound import OutboundDispatcher, SlackWebSender
+from bot.reminders import HatReminders
+from bot.router import CommandRouter
+from bot.scheduler import Scheduler
+from bot.transport.rtm import RtmTransport
 
 
 this = sys.modules[__name__]
@@ -18,81 +31,445 @@ db = settings.database
 # constants
 AT_BOT = "<@" + BOT_ID + ">"
 HELP_COMMAND = "help"
+READ_EVENTS_TIMEOUT = 5  # max seconds to block waiting for events
+UNROUTED = 'unrouted'  # metrics name for messages no command handles
+BUSY_REPLY = "I'm busy with the hats right now. Try that again in a minute."
+BUSY_NOTICE_INTERVAL = 60  # seconds between busy notices in a channel
+
+logger = logging.getLogger(__name__)
 
 # instantiate Slack & clients
 slack_client = SlackClient(settings.SLACK_BOT_TOKEN)
 
-# Dictionaries for command lookups
-this.prefix_dict = None
+this.router = None
+# Where the hats are kept; see bot.storage
+this.store = None
+this.directory = None
+this.engine = None
+this.outbound = None
+this.archiver = None
+this.scheduler = None
+# Keys of recently dispatched messages, so a repeated delivery is dropped
+this.recent_events = None
+# channel -> when it was last told the bot is too busy for fun commands
+this.busy_notices = {}
+# With REPLICATION, the LeaderElector deciding whether this replica is the active one
+this.elector = None
+# Whether the background work only the active replica does is running
+this.leading = False
+# The highest SlackUserInfo id a standby has cached
+this.users_position = 0
+this.schema_version = None
+# (phase, seconds) for the last initialize()
+this.startup_timings = []
+
+def load_commands(restored=None):
+    """
+        Builds the router. Given a restored snapshot, its user names (and hat state, if
+        still valid) are used as they are and the user list is reloaded in the background.
+        Otherwise the hat state is rebuilt from the journal.
+    """
+    this.directory = UserDirectory(slack_client,
+                                   ttl=getattr(settings, 'USER_CACHE_TTL', 3600),
+                                   max_size=getattr(settings, 'USER_CACHE_SIZE', 5000),
+                                   store=this.store)
+    states = None
+    if restored is not None:
+        this.directory.restore(restored.users)
+        this.directory.load_in_background()
+        states = restored.states
+    else:
+        this.directory.load()
+    if states is None and this.store.db is not None:
+        states = journal.restore(db)
+    elif states is not None and states.event_id is None:
+        # Restored from a snapshot of this very database
+        states.event_id = journal.last_event_id(db)
+    # Every BotCommand subclass in bot.commands is picked up automatically
+    this.router = CommandRouter.load(bot.commands, slack_client=slack_client,
+                                     directory=this.directory, states=states,
+                                     elector=this.elector, store=this.store)
+
+def hat_command():
+    from bot.commands.hat import HatCommand
+    for command in this.router.commands:
+        if isinstance(command, HatCommand):
+            return command
+    return None
+
+def minutes_setting(name, default=None):
+    minutes = getattr(settings, name, default)
+    return timedelta(minutes=minutes) if minutes is not None else None
+
+def start_reminders():
+    """
+        Starts the scheduler behind hat expiry, queue nudges and the like. Timers
+        that fire are run on the engine's ordered lane.
+    """
+    this.scheduler = Scheduler(
+        submit=lambda function, *args: this.engine.submit(STATE, function, *args)).start()
+    command = hat_command()
+    if command is not None:
+        command.reminders = HatReminders(
+            command, this.scheduler, this.outbound.send,
+            warn_after=minutes_setting('HAT_WARN_AFTER'),
+            expire_after=minutes_setting('HAT_EXPIRE_AFTER'),
+            nudge_after=minutes_setting('QUEUE_NUDGE_AFTER', 5),
+            claim_timeout=minutes_setting('QUEUE_CLAIM_TIMEOUT'),
+            max_wait=minutes_setting('QUEUE_MAX_WAIT'))
+        command.reminders.watch(command.states)
+        snapshot_journal_later()
+    prune_receipts_later()
+
+def snapshot_journal_later():
+    """
+        Snapshots the hat state into the journal every JOURNAL_SNAPSHOT_INTERVAL
+        seconds, on the ordered lane, so a rebuild only has to replay recent events
+        (and, in memory, so the journal doesn't keep every event)
+    """
+    interval = getattr(settings, 'JOURNAL_SNAPSHOT_INTERVAL', 600)
+
+    def snapshot_journal():
+        try:
+            this.store.take_snapshot(hat_command().states)
+        finally:
+            snapshot_journal_later()
+
+    this.scheduler.schedule('journal snapshot', time.time() + interval, snapshot_journal)
+
+def prune_receipts_later():
+    """
+        Every hour, deletes command receipts older than RECEIPT_RETENTION hours. A
+        message is only ever redelivered within minutes, so a day is plenty.
+    """
+    def prune_receipts():
+        try:
+            hours = getattr(settings, 'RECEIPT_RETENTION', 24)
+            this.store.prune_receipts(datetime.now(tz=pytz.utc) - timedelta(hours=hours))
+        finally:
+            prune_receipts_later()
+
+    this.scheduler.schedule('prune receipts', time.time() + 3600, prune_receipts)
+
+def start_leading():
+    """
+        Starts the background work only the active replica does: the reminders and
+        other timers, and archiving
+    """
+    start_reminders()
+    archive_after_days = getattr(settings, 'ARCHIVE_AFTER_DAYS', 30)
+    if archive_after_days is not None and this.store.db is not None:
+        this.archiver = Archiver(db, max_age=timedelta(days=archive_after_days),
+                                 batch_size=getattr(settings, 'ARCHIVE_BATCH_SIZE', 500),
+                                 interval=getattr(settings, 'ARCHIVE_INTERVAL', 300)).start()
+    this.leading = True
+
+def stop_leading():
+    this.leading = False
+    if this.scheduler is not None:
+        this.scheduler.stop()
+        this.scheduler = None
+    if this.archiver is not None:
+        this.archiver.stop()
+        this.archiver = None
+    command = hat_command()
+    if command is not None:
+        command.reminders = None
+
+def is_active():
+    """
+        Whether this replica should answer commands: always, unless there are standbys
+    """
+    return this.elector is None or (this.leading and this.elector.is_leader)
+
+def journal_position():
+    command = hat_command()
+    return command.states.event_id if command is not None else None
+
+def follow_database():
+    """
+        Brings a standby's hat state and user cache up to date with what the active
+        replica has written
+    """
+    command = hat_command()
+    if command is not None and command.states.event_id is not None:
+        journal.follow(db, command.states)
+    this.users_position = this.directory.follow(this.users_position)
+
+def take_over(term):
+    """
+        Called when this replica becomes the active one. Commands are answered once it
+        has caught up with the journal and started the background work.
+    """
+    follow_database()
+    start_leading()
+    logger.info('Took over as the active replica at journal event %s', journal_position())
+
+def step_down():
+    """
+        Called when this replica loses the lease. Whatever it had in memory may have
+        been overtaken by the new active replica, so the hat state is rebuilt.
+    """
+    stop_leading()
+    command = hat_command()
+    if command is not None:
+        command.states = journal.restore(db)
 
-def load_commands():
-    # Eventually this could potentially use metaprogramming magic to do this for all of the
-    # classes in bot.commands, but for now, we'll do it this way
-    hat_command = HatCommand(slack_client)
-    example_command = ExampleCommand()
-    this.prefix_dict = {
-        'hat': hat_command,
-        'example' : example_command,
-        '': hat_command
-    }
-    this.prefixes = ['hat', 'example', '']
+def dispatch_command(command, channel, user, ts=None):
+    """
+        Hands the command to the engine without waiting for it. Commands that change
+        hat state are queued on the ordered lane, everything else runs concurrently.
+        Returns the command's future, or None if it was a fun command turned away
+        because the bot is busy.
+    """
+    route = this.router.route(command)
+    priority = route.priority if route is not None else QUERY
+    # Identical fun commands in a channel are answered once
+    coalesce = (channel, command) if priority == FUN else None
+    if priority == FUN and this.outbound.waiting(channel) >= this.engine.shed_depth:
+        # Its reply would only hold up the channel's other replies
+        return turn_away(channel, 'replies')
+    try:
+        return this.engine.submit(priority, handle_command, command, channel, user, ts, route,
+                                  coalesce=coalesce)
+    except Overloaded:
+        return turn_away(channel, 'commands')
 
-def handle_command(command, channel, user):
+def turn_away(channel, backlog):
+    """
+        Tells the channel a fun command was dropped because of the backlog of commands
+        or replies. One notice per channel while we're busy, rather than one per command.
+    """
+    metrics.COMMANDS_SHED.labels(backlog).inc()
+    now = time.time()
+    if now - this.busy_notices.get(channel, 0) > BUSY_NOTICE_INTERVAL:
+        this.busy_notices[channel] = now
+        this.outbound.send(channel, BUSY_REPLY, as_user=True)
+    return None
+
+def handle_command(command, channel, user, ts=None, route=None):
     """
         Receives commands directed at the bot and determines if they
         are valid commands. If so, then calls the correct thing for the command. If not,
         returns back what it needs for clarification.
+        If the Slack event timestamp is given, the end-to-end latency is logged.
     """
+    if not is_active():
+        # Queued while this replica was active; the one that is now will answer it
+        logger.warning("Dropped '%s' in %s: this replica is no longer active", command, channel)
+        return
+
+    started = time.perf_counter()
     response = None
-    found_prefix = False
-    for prefix in this.prefixes:
-        if command.startswith(prefix):
-            command_instance = this.prefix_dict[prefix]
-            response = command_instance.handle(command, channel, user)
-            break
+    if route is None:
+        route = this.router.route(command)
+    name = route.metric_name if route is not None else UNROUTED
+    metrics.set_command(name)
+    try:
+        if route is not None:
+            response = route.run(channel, user, receipts.message_key(channel, ts))
+    except replica.LeaseLost as error:
+        # Lost while the command waited for the database; the new active replica
+        # answers it, so nothing it did was committed
+        logger.warning("Dropped '%s' in %s: %s", command, channel, error)
+        return
+    except Exception:
+        metrics.COMMAND_ERRORS.labels(name).inc()
+        raise
+    finally:
+        metrics.clear_command()
+        metrics.COMMAND_SECONDS.labels(name).observe(time.perf_counter() - started)
 
     if response is None:
         response = "Not sure what you mean. Use the *{}* command".format(HELP_COMMAND)
 
-    slack_client.api_call("chat.postMessage", channel=channel,
-                          text=response, as_user=True)
+    params = {}
+    if isinstance(response, dict):
+        # A Block Kit reply; its text is what notifications show
+        params['blocks'] = json.dumps(response['blocks'])
+        response = response['text']
+    this.outbound.send(channel, render.truncate(response), as_user=True,
+                       event_time=float(ts) if ts is not None else None,
+                       priority=route.priority if route is not None else QUERY, **params)
+
+    if ts is not None:
+        logger.info("Queued reply to '%s' in %s after %.3fs", command, channel,
+                    time.time() - float(ts))
 
 
 def parse_slack_output(slack_rtm_output):
     """
         The Slack Real Time Messaging API is an events firehose.
-        this parsing function returns None unless a message is
-        directed at the Bot, based on its ID.
-    """
-    output_list = slack_rtm_output
-    if output_list and len(output_list) > 0:
-        for output in output_list:
-            if output and 'text' in output and AT_BOT in output['text']:
-                # return text after the @ mention, whitespace removed
-                return output['text'].split(AT_BOT)[1].strip().lower(), \
-                    output['channel'], output['user']
-    return None, None, None
-
-def initialize():
-    models = [HatLog, HatQueue, HatPool, SlackUserInfo]
-    db.connect()
-    for model in models:
-        if not model.table_exists():
-            model.create_table(True)
-    db.close()
-    load_commands()
+        this parsing function returns every message in the batch that is
+        directed at the Bot, based on its ID, as (command, channel, user, ts)
+        tuples in the order they arrived. Messages seen before are left out.
+    """
+    commands = []
+    for output in slack_rtm_output or []:
+        if output and 'text' in output and AT_BOT in output['text'] \
+                and 'channel' in output and 'user' in output:
+            if this.recent_events is not None and this.recent_events.seen(event_key(output)):
+                logger.info('Dropped a repeat of message %s in %s', output.get('ts'),
+                            output['channel'])
+                continue
+            # text after the @ mention, whitespace removed
+            commands.append((output['text'].split(AT_BOT)[1].strip().lower(),
+                             output['channel'], output['user'], output.get('ts')))
+    return commands
 
-if __name__ == "__main__":
-    initialize()
 
-    READ_WEBSOCKET_DELAY = 1  # 1 second delay between reading from firehose
-    if slack_client.rtm_connect():
-        print("{} connected and running!".format(settings.BOT_NAME))
-        while True:
-            command, channel, user = parse_slack_output(
-                slack_client.rtm_read())
-            if all([command, channel, user]):
-                handle_command(command, channel, user)
-            time.sleep(READ_WEBSOCKET_DELAY)
+def make_transport():
+    """
+        The transport named by the TRANSPORT setting: 'rtm' (the default) or 'events'
+        for the Events API over HTTP
+    """
+    name = getattr(settings, 'TRANSPORT', 'rtm')
+    if name == 'events':
+        from bot.transport.events_api import EventsApiTransport
+        transport = EventsApiTransport(
+            settings.SLACK_SIGNING_SECRET,
+            port=getattr(settings, 'EVENTS_PORT', 3000),
+            max_queue=getattr(settings, 'EVENT_QUEUE_SIZE', 1000))
+        transport.register_metrics(metrics.REGISTRY)
+        return transport
+    if name == 'rtm':
+        return RtmTransport(slack_client)
+    raise ValueError('Unknown TRANSPORT {}'.format(name))
+
+def initialize(sender=None):
+    """
+        Prepares the database, commands, engine and outbound dispatcher. Replies are
+        posted with `sender`, or over the Slack Web API if none is given. With a
+        STATE_SNAPSHOT_FILE, the state saved by the last shutdown() is restored.
+    """
+    this.startup_timings = []
+    started = last = time.perf_counter()
+
+    def finished(phase):
+        nonlocal last
+        now = time.perf_counter()
+        this.startup_timings.append((phase, now - last))
+        last = now
+
+    this.store = storage.default_store()
+    in_memory = this.store.db is None
+    snapshot_file = getattr(settings, 'STATE_SNAPSHOT_FILE', None)
+    # Read before connecting: the snapshot is checked against the untouched database
+    restored = None
+    if snapshot_file and not in_memory:
+        restored = snapshot.load(snapshot_file, settings.DB_FILE)
+    finished('snapshot')
+
+    metrics.instrument_slack_client(slack_client)
+    if not in_memory:
+        metrics.instrument_database(db)
+        db.connect()
+        # WAL mode is stored in the database file, so this also covers settings files
+        # from before DB_PRAGMAS. Connections stay open for the life of their thread.
+        db.execute_sql('PRAGMA journal_mode=wal')
+        if restored is not None and restored.schema_version == latest_version():
+            # Nothing has touched the database since it was last migrated
+            this.schema_version = restored.schema_version
+        else:
+            this.schema_version = migrate(db)
+    finished('schema')
+
+    if getattr(settings, 'REPLICATION', False) and in_memory:
+        raise ValueError('REPLICATION needs the sqlite STORAGE: standbys follow the database')
+    if getattr(settings, 'REPLICATION', False):
+        this.elector = replica.LeaderElector(
+            db, getattr(settings, 'REPLICA_NAME', None) or replica.default_name(),
+            ttl=getattr(settings, 'LEADER_LEASE_TTL', 0.8),
+            stall_timeout=getattr(settings, 'LEADER_STALL_TIMEOUT', 30),
+            on_elected=take_over, on_deposed=step_down, on_standby=follow_database,
+            position=journal_position)
+        this.users_position = db.execute_sql(
+            'SELECT MAX("id") FROM "slackuserinfo"').fetchone()[0] or 0
+    else:
+        this.elector = None
+    load_commands(restored)
+    finished('commands')
+
+    this.recent_events = RecentEvents(window=getattr(settings, 'DEDUP_WINDOW', 600),
+                                      max_size=getattr(settings, 'DEDUP_SIZE', 10000))
+    this.recent_events.register_metrics(metrics.REGISTRY)
+
+    this.engine = CommandEngine(
+        concurrency=getattr(settings, 'COMMAND_CONCURRENCY', 4),
+        max_pending=getattr(settings, 'COMMAND_QUEUE_SIZE', 1000),
+        shed_depth=getattr(settings, 'FUN_SHED_DEPTH', 50))
+    this.engine.register_metrics(metrics.REGISTRY)
+    this.outbound = OutboundDispatcher(
+        sender or SlackWebSender(settings.SLACK_BOT_TOKEN),
+        max_queue=getattr(settings, 'SEND_QUEUE_SIZE', 1000),
+        rate=getattr(settings, 'CHANNEL_MESSAGE_RATE', 1.0),
+        burst=getattr(settings, 'CHANNEL_MESSAGE_BURST', 4)).start()
+    this.outbound.register_metrics(metrics.REGISTRY)
+    if this.elector is not None:
+        # Standing by until elected; take_over() starts the background work
+        this.elector.start()
     else:
-        print("Connection failed. Invalid Slack token or bot ID?")
+        start_leading()
+    metrics_port = getattr(settings, 'METRICS_PORT', None)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    finished('workers')
+
+    logger.info('Started in %.3fs (%s)', time.perf_counter() - started, ', '.join(
+        '{} {:.3f}s'.format(phase, seconds) for phase, seconds in this.startup_timings))
+
+def shutdown():
+    """
+        Lets queued commands and replies finish, stops the background work and, with a
+        STATE_SNAPSHOT_FILE, saves the state for the next start
+    """
+    # A standby's state may be behind the database, so only the active replica saves it
+    active = is_active()
+    stop_leading()
+    this.engine.shutdown()
+    this.outbound.stop()
+    this.directory.close()
+    snapshot_file = getattr(settings, 'STATE_SNAPSHOT_FILE', None)
+    command = hat_command()
+    if this.store.db is None:
+        # Nothing to save it to
+        active = False
+    if active and command is not None:
+        this.store.take_snapshot(command.states)
+    if this.elector is not None:
+        # Hands over to a standby straight away, rather than once the lease expires. Done
+        # before saving the snapshot, whose fingerprint of the database would otherwise
+        # not cover the lease release.
+        this.elector.stop()
+    if active and snapshot_file and command is not None:
+        snapshot.save(snapshot_file, db, command.states, this.directory, this.schema_version)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Stop cleanly, saving the snapshot, when asked to by a process manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    transport = make_transport()
+    # Connecting needs nothing initialize() sets up, so do both at once
+    connecting = ThreadPoolExecutor(max_workers=1).submit(transport.connect)
+    initialize()
+    try:
+        if connecting.result():
+            print("{} connected and running!".format(settings.BOT_NAME))
+            while True:
+                events = transport.read(READ_EVENTS_TIMEOUT)
+                if this.elector is not None:
+                    this.elector.heartbeat()
+                if not is_active():
+                    # A standby reads events only to stay connected
+                    continue
+                for command, channel, user, ts in parse_slack_output(events):
+                    dispatch_command(command, channel, user, ts)
+        else:
+            print("Connection failed. Invalid Slack token or bot ID?")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+        shutdown()
@@ -0,0 +1,28 @@
+import pytest
+
+from bot.bench.environment import use_bench_settings
+
+# The modules under test read bot.settings when they are imported, so point it at a
+# throwaway database before any of them are
+use_bench_settings()
+
+
+@pytest.fixture(scope='session')
+def database():
+    from bot.migrations import migrate
+    from bot.models import db
+
+    db.connect()
+    migrate(db)
+    yield db
+    db.close()
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(request, database):
+    """
+        Each store in turn. The sqlite ones share a database, so tests use hats and
+        users of their own.
+    """
+    from bot.storage import make_store
+    return make_store(request.param)
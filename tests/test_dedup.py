@@ -0,0 +1,97 @@
+"""
+    Repeated deliveries: the recent events LRU, and command receipts replaying the
+    first reply through handle_command
+"""
+import pytest
+
+import run_bot
+from bot.commands.base import BotCommand
+from bot.dedup import RecentEvents, event_key
+from bot.router import CommandRouter
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Counter(BotCommand):
+    DEFAULT_COMMAND_PREFIX = 'count'
+    MUTATING_COMMANDS = frozenset(['up'])
+
+    def up(self, command, channel, user):
+        self.store.increment('dedup', channel)
+        return 'Counted {}'.format(self.store.count('dedup', channel))
+
+
+class Outbound(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, channel, text, **params):
+        self.sent.append((channel, text))
+
+
+def test_event_key():
+    assert event_key({'client_msg_id': 'abc', 'channel': 'C1', 'ts': '1.0'}) == 'abc'
+    assert event_key({'channel': 'C1', 'ts': '1.0'}) == 'C1:1.0'
+
+
+def test_repeats_within_the_window():
+    clock = Clock()
+    recent = RecentEvents(window=10, clock=clock)
+    assert not recent.seen('a')
+    clock.now = 9
+    assert recent.seen('a')
+    assert recent.duplicates == 1
+    # Seen again, but the window runs from when it was first seen
+    clock.now = 11
+    assert not recent.seen('a')
+    assert len(recent) == 1
+
+
+def test_oldest_evicted_past_max_size():
+    recent = RecentEvents(max_size=2, clock=Clock())
+    for key in ('a', 'b', 'c'):
+        assert not recent.seen(key)
+    assert len(recent) == 2
+    assert recent.seen('c') and recent.seen('b')
+    assert not recent.seen('a')
+
+
+def test_parse_drops_repeated_messages(monkeypatch):
+    monkeypatch.setattr(run_bot.this, 'recent_events', RecentEvents(clock=Clock()))
+    message = {'text': '{} hat on'.format(run_bot.AT_BOT), 'channel': 'C1', 'user': 'U1',
+               'ts': '1.0'}
+    assert run_bot.parse_slack_output([message]) == [('hat on', 'C1', 'U1', '1.0')]
+    assert run_bot.parse_slack_output([dict(message)]) == []
+
+
+@pytest.fixture
+def bot(store, monkeypatch):
+    router = CommandRouter()
+    router.register(Counter(store=store))
+    monkeypatch.setattr(run_bot.this, 'router', router)
+    monkeypatch.setattr(run_bot.this, 'outbound', Outbound())
+    monkeypatch.setattr(run_bot.this, 'elector', None)
+    return run_bot.this
+
+
+def test_receipt_replays_the_first_reply(bot, store):
+    run_bot.handle_command('count up', 'CD1', 'U1', '100.000001')
+    run_bot.handle_command('count up', 'CD1', 'U1', '100.000001')
+    assert store.count('dedup', 'CD1') == 1
+    assert [text for _, text in bot.outbound.sent] == ['Counted 1', 'Counted 1']
+
+    run_bot.handle_command('count up', 'CD1', 'U1', '100.000002')
+    assert store.count('dedup', 'CD1') == 2
+    assert bot.outbound.sent[-1] == ('CD1', 'Counted 2')
+
+
+def test_no_receipt_without_a_timestamp(bot, store):
+    run_bot.handle_command('count up', 'CD2', 'U1')
+    run_bot.handle_command('count up', 'CD2', 'U1')
+    assert store.count('dedup', 'CD2') == 2
@@ -0,0 +1,88 @@
+"""
+    Replies cut short to fit Slack's limits on text and Block Kit messages
+"""
+from bot import render, settings
+from bot.commands.hat import HatCommand
+from bot.state import HatStates
+
+
+class Directory(object):
+    def get_name(self, user_id):
+        return user_id
+
+
+def sections(message):
+    return [block['text']['text'] for block in message['blocks'][1:]
+            if block['type'] == 'section']
+
+
+def test_truncate_short_text():
+    assert render.truncate('one\ntwo', 7) == 'one\ntwo'
+
+
+def test_truncate_at_a_line_break():
+    text = '\n'.join('line {}'.format(number) for number in range(10))
+    cut = render.truncate(text, 35)
+    assert len(cut) <= 35
+    assert cut.split('\n') == ['line 0', 'line 1', '…and 8 more lines']
+
+
+def test_truncate_one_huge_line():
+    cut = render.truncate('x' * 100, 40)
+    assert len(cut) <= 40
+    assert cut.startswith('x') and cut.split('\n')[0].endswith('…')
+
+
+def test_listing_text():
+    assert render.listing('Title:', ['a', 'b'], 'Footer') == 'Title:\na\nb\nFooter'
+    text = render.listing('Title:', ['y' * 100] * 100)
+    assert len(text) <= render.MAX_TEXT
+    assert text.endswith('more lines')
+
+
+def test_listing_blocks():
+    message = render.listing('Title:', ['a', 'b'], 'Footer', blocks=True)
+    assert message['text'] == 'Title:\na\nb\nFooter'
+    assert message['blocks'][0]['text']['text'] == 'Title:'
+    assert sections(message) == ['a\nb']
+    assert message['blocks'][-1] == {'type': 'context', 'elements': [
+        {'type': 'mrkdwn', 'text': 'Footer'}]}
+
+
+def test_listing_blocks_within_limits():
+    lines = ['z' * 1000] * 200
+    message = render.listing('Title:', lines, 'Footer', blocks=True)
+    assert len(message['blocks']) == render.MAX_BLOCKS
+    assert len(message['text']) <= render.MAX_TEXT
+    texts = sections(message)
+    assert all(len(text) <= render.MAX_SECTION_TEXT for text in texts)
+    # Two lines fit in a section, so 47 sections hold 94 lines before the last says so
+    assert texts[-1] == '…and 106 more'
+    assert sum(len(text.split('\n')) for text in texts[:-1]) == 94
+
+    # A line too long for any section is cut in its own
+    message = render.listing('Title:', ['w' * 5000], blocks=True)
+    assert len(sections(message)[0]) <= render.MAX_SECTION_TEXT
+
+
+def test_queued_pages(store, monkeypatch):
+    monkeypatch.setattr(settings, 'QUEUE_PAGE_SIZE', 2, raising=False)
+    states = HatStates.load(store=store)
+    state = states.get('render')
+    for number in range(5):
+        state.enqueue('UV{}'.format(number))
+    command = HatCommand(None, states=states, directory=Directory(), hats={'render': 'CV'},
+                         store=store)
+
+    monkeypatch.setattr(settings, 'REPLY_BLOCKS', False, raising=False)
+    assert command.queued('', 'CV', 'UV0') == (
+        '5 people are in the queue:\n*1*. UV0\n*2*. UV1\n'
+        'Page 1 of 3. Use *hat queued 2* for more.')
+    assert command.queued('3', 'CV', 'UV0') == (
+        '5 people are in the queue:\n*5*. UV4\nPage 3 of 3.')
+    assert command.queued('4', 'CV', 'UV0') == 'The queue only has 3 pages.'
+
+    monkeypatch.setattr(settings, 'REPLY_BLOCKS', True, raising=False)
+    message = command.queued('2', 'CV', 'UV0')
+    assert sections(message) == ['*3*. UV2\n*4*. UV3']
+    assert message['text'].endswith('Use *hat queued 3* for more.')
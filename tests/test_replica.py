@@ -0,0 +1,66 @@
+"""
+    Fencing: a replica that has lost the lease must not commit anything
+"""
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from bot.commands.hat import HatCommand
+from bot.replica import LeaderElector, LeaseLost
+from bot.state import HatStates
+from bot.storage import make_store
+
+
+@pytest.fixture
+def command(database):
+    store = make_store('sqlite')
+    # Whoever held the lease last is gone
+    database.execute_sql('UPDATE "leader_lease" SET "expires_time" = 0')
+    elector = LeaderElector(database, 'fenced', ttl=0.3)
+    assert elector.tick()
+    yield HatCommand(None, states=HatStates.load(store=store), hats={'fenced': 'CF'},
+                     elector=elector, store=store)
+    elector.stop()
+
+
+def take_over(database, name):
+    database.execute_sql('UPDATE "leader_lease" SET "holder" = ?, "term" = "term" + 1, '
+                         '"expires_time" = ?', (name, int((time.time() + 60) * 1000000)))
+
+
+def test_holder_commits(command):
+    assert command.run_atomic(HatCommand.on, 'fenced', 'CF', 'UF1') == 'You have the hat now!'
+    assert command.states.get('fenced').owner.user_id == 'UF1'
+
+
+def test_deposed_replica_commits_nothing(command, database):
+    take_over(database, 'other')
+    with pytest.raises(LeaseLost):
+        command.run_atomic(HatCommand.on, 'fenced', 'CF', 'UF2', 'CF:1.0')
+    owners, _, _ = command.store.open_entries('fenced')
+    assert [entry.user_id for entry in owners if entry.user_id == 'UF2'] == []
+    assert database.execute_sql('SELECT COUNT(*) FROM "command_receipt" '
+                                'WHERE "key" = \'CF:1.0\'').fetchone()[0] == 0
+
+
+def test_lease_lost_waiting_for_the_lock(command, database):
+    # Another writer holds the lock for longer than the lease lasts
+    other = sqlite3.connect(database.database, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(command.run_atomic(HatCommand.off, 'fenced', 'CF', 'UF1'))
+        except LeaseLost as error:
+            outcome.append(error)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(2 * command.elector.ttl)
+    other.execute('COMMIT')
+    thread.join()
+    other.close()
+    assert isinstance(outcome[0], LeaseLost)
@@ -0,0 +1,109 @@
+"""
+    Routing messages to commands through the token tries
+"""
+from bot.commands.base import BotCommand
+from bot.router import CommandRouter
+from bot.trie import TokenTrie, tokenize
+
+
+class Deploy(BotCommand):
+    DEFAULT_COMMAND_PREFIX = 'deploy'
+    FALLBACK = True
+
+    def status(self, command, channel, user):
+        return 'status ' + command
+
+    def status_all(self, command, channel, user):
+        return 'status all ' + command
+
+
+class DeployLogs(BotCommand):
+    DEFAULT_COMMAND_PREFIX = 'deploy logs'
+
+    def tail(self, command, channel, user):
+        return 'tail ' + command
+
+
+class Status(BotCommand):
+    DEFAULT_COMMAND_PREFIX = 'status'
+
+    def now(self, command, channel, user):
+        return 'now'
+
+
+def router(store, *classes):
+    router = CommandRouter()
+    for command_class in classes:
+        router.register(command_class(store=store))
+    router.check()
+    return router
+
+
+def test_trie_longest_match():
+    trie = TokenTrie()
+    trie.insert(['a'], 1)
+    trie.insert(['a', 'b', 'c'], 3)
+    assert trie.longest_match(tokenize('a b c d')) == (3, 3)
+    # 'a b' isn't stored, so a match stops at the longest stored prefix
+    assert trie.longest_match(tokenize('a b d')) == (1, 1)
+    assert trie.longest_match(tokenize('x a')) == (None, 0)
+    assert trie.longest_match(tokenize('x a b c'), start=1) == (3, 4)
+    assert trie.insert(['a'], 'one') == 1
+
+
+def test_longest_prefix_wins(store):
+    routes = router(store, Deploy, DeployLogs)
+    route = routes.route('deploy logs tail  web  ')
+    assert type(route.instance) is DeployLogs
+    assert (route.name, route.remainder) == ('tail', 'web')
+    route = routes.route('deploy status web')
+    assert type(route.instance) is Deploy
+    assert route.run('C1', 'U1') == 'status web'
+
+
+def test_longest_command_wins(store):
+    routes = router(store, Deploy)
+    assert routes.route('deploy status all of   them').run('C1', 'U1') == 'status all of   them'
+    assert routes.route('deploy status al').run('C1', 'U1') == 'status al'
+
+
+def test_fallback_without_prefix(store):
+    routes = router(store, Deploy, DeployLogs)
+    # Without a known prefix the fallback gets the message, and its prefix is optional
+    route = routes.route('status all web')
+    assert type(route.instance) is Deploy
+    assert route.run('C1', 'U1') == 'status all web'
+    assert routes.route('something else').run('C1', 'U1') == \
+        'You did not provide a valid *deploy* command'
+
+
+def test_unknown_command_under_prefix(store):
+    route = router(store, Deploy, DeployLogs).route('deploy logs rotate')
+    assert type(route.instance) is DeployLogs
+    assert route.name is None and route.function is None
+    assert route.metric_name == 'deploy logs (invalid)'
+
+
+def test_no_fallback(store):
+    assert router(store, DeployLogs).route('hello') is None
+
+
+def test_ambiguous_registrations(store):
+    class OtherDeploy(Deploy):
+        pass
+
+    routes = router(store, Deploy, OtherDeploy)
+    assert routes.problems == [
+        "prefix 'deploy' is registered by both Deploy and OtherDeploy",
+        'both Deploy and OtherDeploy want to be the fallback command']
+    # The later registration takes the prefix
+    assert type(routes.route('deploy status').instance) is OtherDeploy
+
+
+def test_shadowed_fallback_commands(store):
+    routes = router(store, Deploy, Status)
+    assert routes.problems == [
+        "'status' is shadowed by the 'status' prefix of Status; use 'deploy status'",
+        "'status all' is shadowed by the 'status' prefix of Status; use 'deploy status all'"]
+    assert type(routes.route('status now').instance) is Status
+    assert routes.route('deploy status all web').run('C1', 'U1') == 'status all web'
@@ -0,0 +1,250 @@
+"""
+    What bot.storage says a store does, checked against every store. Each test uses
+    hats and users of its own, since the sqlite stores share a database.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from bot import receipts, rollups
+from bot.models import to_epoch_us
+from bot.state import HatStates
+
+START = datetime(2020, 1, 1, tzinfo=pytz.utc)
+
+
+class Boom(Exception):
+    pass
+
+
+def moment(seconds):
+    return START + timedelta(seconds=seconds)
+
+
+def last_event_id(store):
+    events = list(store.events())
+    return events[-1].id if events else 0
+
+
+def last_user_id(store):
+    users = store.users_after(0)
+    return users[-1][0] if users else 0
+
+
+def test_holds(store):
+    first = store.start_hold('holds', 'UH1', moment(1))
+    second = store.start_hold('holds', 'UH2', moment(2))
+    store.start_hold('holds other', 'UH3', moment(3))
+    owners, _, _ = store.open_entries('holds')
+    # Newest first
+    assert [(entry.id, entry.hat, entry.user_id, entry.start_time) for entry in owners] == [
+        (second.id, 'holds', 'UH2', moment(2)), (first.id, 'holds', 'UH1', moment(1))]
+
+    store.end_hold(second, moment(4))
+    assert second.end_time == moment(4)
+    owners, _, _ = store.open_entries('holds')
+    assert [entry.id for entry in owners] == [first.id]
+    owners, _, _ = store.open_entries()
+    assert sorted(entry.user_id for entry in owners
+                  if entry.hat.startswith('holds')) == ['UH1', 'UH3']
+
+
+def test_queue(store):
+    first = store.start_queued('queue', 'UQ1', moment(1))
+    last = store.start_queued('queue', 'UQ2', moment(3))
+    middle = store.start_queued('queue', 'UQ3', moment(2))
+    store.start_queued('queue other', 'UQ4', moment(0))
+    _, queued, _ = store.open_entries('queue')
+    assert [entry.user_id for entry in queued] == ['UQ1', 'UQ3', 'UQ2']
+    assert queued[0].start_time == moment(1)
+
+    store.end_queued(middle, moment(5))
+    assert middle.end_time == moment(5)
+    _, queued, _ = store.open_entries('queue')
+    assert [entry.id for entry in queued] == [first.id, last.id]
+
+
+def test_pool(store):
+    first = store.start_pooled('pool', 'UO1', 'UP1')
+    second = store.start_pooled('pool', 'UO1', 'UP2')
+    third = store.start_pooled('pool', 'UO2', 'UP3')
+    store.start_pooled('pool other', 'UO1', 'UP4')
+
+    def pooled():
+        _, _, entries = store.open_entries('pool')
+        return [(entry.id, entry.owner_user_id, entry.user_id) for entry in entries]
+
+    # In the order they joined
+    assert pooled() == [(first.id, 'UO1', 'UP1'), (second.id, 'UO1', 'UP2'),
+                        (third.id, 'UO2', 'UP3')]
+    store.end_pooled(second, moment(1))
+    assert second.end_time == moment(1)
+    store.move_pool('pool', 'UO1', 'UO3')
+    assert pooled() == [(first.id, 'UO3', 'UP1'), (third.id, 'UO2', 'UP3')]
+    store.end_pool('pool', 'UO3', moment(2))
+    assert pooled() == [(third.id, 'UO2', 'UP3')]
+    _, _, others = store.open_entries('pool other')
+    assert [(entry.owner_user_id, entry.user_id) for entry in others] == [('UO1', 'UP4')]
+
+
+def test_history(store):
+    after = last_event_id(store)
+    store.record_event('history', 'on', 'UE1', None, 7, moment(1), 'hat on', 'C1:1.0')
+    store.record_event('history', 'pool move', 'UE2', 'UE1', None, moment(2), None, None)
+    events = list(store.events(after))
+    assert [event[1:] for event in events] == [
+        ('history', 'on', 'UE1', None, 7, to_epoch_us(moment(1)), 'hat on', 'C1:1.0'),
+        ('history', 'pool move', 'UE2', 'UE1', None, to_epoch_us(moment(2)), None, None)]
+    assert after < events[0].id < events[1].id
+    assert [event.id for event in store.events(events[0].id)] == [events[1].id]
+
+    assert store.count('history', 'UE1') == 0
+    store.increment('history', 'UE1')
+    store.increment('history', 'UE1', 2)
+    assert store.count('history', 'UE1') == 3
+    assert store.count('history', 'UE2') == 0
+
+
+def test_snapshots(store):
+    states = HatStates(store)
+    states.get('snapshots').take_hat('UN1')
+    event_id = last_event_id(store)
+    assert store.take_snapshot(states) == event_id
+    # Nothing has happened since
+    assert store.take_snapshot(states) is None
+    snapshot_id, rows = store.latest_snapshot()
+    assert snapshot_id == event_id
+    assert HatStates.from_rows(rows).get('snapshots').owner.user_id == 'UN1'
+
+    states.get('snapshots').give_up_hat()
+    assert [event.kind for event in store.events(event_id)] == ['off']
+    assert store.take_snapshot(states) > event_id
+
+
+def test_users(store):
+    after = last_user_id(store)
+    assert store.user_info('UU1') is None
+    store.save_user('UU1', 'one')
+    store.save_user('UU1', 'uno')
+    user_info = store.user_info('UU1')
+    assert (user_info.user_id, user_info.name, user_info.tip) == ('UU1', 'uno', 0)
+
+    store.save_users({'UU1': 'one', 'UU2': 'two'})
+    users = store.users_after(after)
+    assert [(user_id, name) for _, user_id, name in users] == [('UU1', 'one'), ('UU2', 'two')]
+    assert users[0][0] < users[1][0]
+    # A rename keeps the id
+    assert users[0][0] == user_info.id
+
+    store.tip('UU2')
+    store.tip('UU2')
+    store.tip('UU3')
+    assert store.user_info('UU2').tip == 2
+    # Tipping a user who was never saved does nothing
+    assert store.user_info('UU3') is None
+
+
+def test_receipts(store):
+    keys = []
+
+    def command(text):
+        keys.append(receipts.current_key())
+        return {'text': text, 'blocks': [text]}
+
+    with store.atomic():
+        first = store.run_once('receipts:1', command, 'first')
+    with store.atomic():
+        again = store.run_once('receipts:1', command, 'again')
+    assert first == {'text': 'first', 'blocks': ['first']}
+    assert again == first
+    assert keys == ['receipts:1']
+    assert receipts.current_key() is None
+
+    store.prune_receipts(START)
+    store.run_once('receipts:1', command, 'still a repeat')
+    assert len(keys) == 1
+    assert store.prune_receipts(datetime.now(tz=pytz.utc) + timedelta(minutes=1)) >= 1
+    store.run_once('receipts:1', command, 'after pruning')
+    assert len(keys) == 2
+
+
+def test_rollback(store):
+    events = last_event_id(store)
+    with pytest.raises(Boom):
+        with store.atomic():
+            hold = store.start_hold('rollback', 'UR1', moment(1))
+            store.end_hold(hold, moment(2))
+            store.start_hold('rollback', 'UR1', moment(3))
+            store.start_pooled('rollback', 'UR1', 'UR2')
+            store.increment('rollback', 'UR1')
+            store.record_event('rollback', 'on', 'UR1', None, None, moment(1), None, None)
+            store.save_user('UR1', 'one')
+            store.run_once('rollback:1', lambda: 'done')
+            raise Boom()
+    owners, _, pooled = store.open_entries('rollback')
+    assert (owners, pooled) == ([], [])
+    assert store.count('rollback', 'UR1') == 0
+    assert last_event_id(store) == events
+    assert store.user_info('UR1') is None
+    assert store.run_once('rollback:1', lambda: 'again') == 'again'
+
+
+def test_rollback_of_changes(store):
+    store.save_user('UR2', 'two')
+    store.increment('rollback changes', 'UR2')
+    store.start_pooled('rollback changes', 'UR3', 'UR4')
+    with pytest.raises(Boom):
+        with store.atomic():
+            store.save_user('UR2', 'renamed')
+            store.tip('UR2')
+            store.increment('rollback changes', 'UR2')
+            store.move_pool('rollback changes', 'UR3', 'UR5')
+            store.end_pool('rollback changes', 'UR5', moment(1))
+            raise Boom()
+    user_info = store.user_info('UR2')
+    assert (user_info.name, user_info.tip) == ('two', 0)
+    assert store.count('rollback changes', 'UR2') == 1
+    _, _, pooled = store.open_entries('rollback changes')
+    assert [(entry.owner_user_id, entry.user_id) for entry in pooled] == [('UR3', 'UR4')]
+
+
+def test_nested_transactions(store):
+    with store.atomic():
+        store.start_queued('nested', 'UR6', moment(1))
+        with pytest.raises(Boom):
+            with store.atomic():
+                store.start_queued('nested', 'UR7', moment(2))
+                raise Boom()
+    with pytest.raises(Boom):
+        with store.atomic():
+            with store.transaction():
+                store.start_queued('nested', 'UR8', moment(3))
+            raise Boom()
+    with store.transaction():
+        store.start_queued('nested', 'UR9', moment(4))
+    _, queued, _ = store.open_entries('nested')
+    assert [entry.user_id for entry in queued] == ['UR6', 'UR9']
+
+
+def test_hat_state(store):
+    events = last_event_id(store)
+    state = HatStates(store).get('state')
+    state.take_hat('US1')
+    state.enqueue('US2')
+    state.enqueue('US3')
+    state.add_to_pool('US1', 'US4')
+    state.remove_from_queue('US2')
+    state.give_up_hat()
+    state.change_pool_owner('US1', 'US3')
+    state.take_hat('US3')
+    assert state.check() == []
+
+    loaded = HatStates.load('state', store).get('state')
+    assert loaded.owner.user_id == 'US3'
+    assert [entry.user_id for entry in loaded.queue_entries()] == ['US3']
+    assert [entry.user_id for entry in loaded.pooled_users('US3')] == ['US4']
+    assert [event.kind for event in store.events(events)] == [
+        'on', 'queue', 'queue', 'pool', 'dequeue', 'off', 'pool move', 'on']
+    assert store.count(rollups.DAILY_DEPLOYS, rollups.daily_bucket('state')) == 2
+    assert store.count(rollups.USER_POOLS, 'US4') == 1